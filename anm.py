@@ -0,0 +1,158 @@
+import mmap
+import os
+import struct
+
+import numpy as np
+
+# Readers for COM3D2 binary files. Nothing in here needs Blender.
+
+# Channel ids in .anm files
+channel_rot = (100, 101, 102, 103) # Local rotation quaternion x, y, z, w
+channel_loc = (104, 105, 106) # Local location x, y, z
+
+class AnmFormatError(Exception):
+    pass
+
+class Reader:
+    # Cursor over an in-memory buffer with C# BinaryReader semantics
+    def __init__(self, buf):
+        self.buf = memoryview(buf)
+        self.pos = 0
+
+    def read(self, n):
+        if self.pos + n > len(self.buf):
+            raise AnmFormatError(f'Unexpected end of file at {self.pos}')
+        ret = self.buf[self.pos:self.pos + n]
+        self.pos += n
+        return ret
+
+    def byte(self):
+        return self.read(1)[0]
+
+    def int32(self):
+        return struct.unpack('<i', self.read(4))[0]
+
+    def floats(self, n):
+        return struct.unpack(f'<{n}f', self.read(4 * n))
+
+    def str(self):
+        # Length is 7-bit encoded
+        n = 0
+        shift = 0
+        while True:
+            b = self.byte()
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        return bytes(self.read(n)).decode('utf-8')
+
+class Track:
+    # Keys of one bone in a clip
+    def __init__(self, path):
+        self.path = path
+        self.name = path.split('/')[-1]
+        # Channel id -> (n, 4) array of time, value, in tangent, out tangent
+        self.channels = {}
+
+    def key_times(self):
+        if not self.channels:
+            return np.zeros(0, dtype=np.float32)
+        return np.unique(np.concatenate([k[:, 0] for k in self.channels.values()]))
+
+class Clip:
+    def __init__(self, version):
+        self.version = version
+        self.tracks = {}
+
+    def duration(self):
+        ret = 0.0
+        for t in self.tracks.values():
+            for k in t.channels.values():
+                if len(k):
+                    ret = max(ret, float(k[-1, 0]))
+        return ret
+
+def parse_anm(buf):
+    r = Reader(buf)
+    header = r.str()
+    if header != 'CM3D2_ANIM':
+        raise AnmFormatError(f'Not an anm file: {header!r}')
+    clip = Clip(r.int32())
+    channel_id = r.byte()
+    if channel_id != 1:
+        raise AnmFormatError(f'Expected bone path, got channel {channel_id}')
+    while channel_id == 1:
+        track = Track(r.str())
+        while True:
+            channel_id = r.byte()
+            if channel_id <= 1:
+                break
+            n = r.int32()
+            keys = np.frombuffer(r.read(16 * n), dtype='<f4').reshape(n, 4)
+            track.channels[channel_id] = keys
+        # Later tracks of the same bone win, same as the importer
+        clip.tracks[track.name] = track
+    # Anything after channel 0 is version specific trailer data
+    return clip
+
+def read_anm(fn, use_mmap=False):
+    # With use_mmap key arrays are views into the mapped file and are only
+    # paged in when a frame range samples them
+    with open(fn, 'rb') as f:
+        if not use_mmap:
+            return parse_anm(f.read())
+        if os.fstat(f.fileno()).st_size == 0:
+            raise AnmFormatError(f'Empty file: {fn}')
+        return parse_anm(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+class Skeleton:
+    # Rest hierarchy of a CM body in Unity space
+    def __init__(self, names, parents, loc, rot):
+        self.names = names
+        self.index = {n: i for i, n in enumerate(names)}
+        self.parents = np.asarray(parents, dtype=np.int32)
+        self.loc = np.asarray(loc, dtype=np.float64) # (n, 3) local location
+        self.rot = np.asarray(rot, dtype=np.float64) # (n, 4) local rotation, x y z w
+        self.order = fk_order(self.parents)
+
+def fk_order(parents):
+    # Bone indices sorted so that parents come before children
+    order = []
+    done = set()
+    for i in range(len(parents)):
+        chain = []
+        while i >= 0 and i not in done:
+            chain.append(i)
+            done.add(i)
+            i = parents[i]
+        order.extend(reversed(chain))
+    return np.asarray(order, dtype=np.int32)
+
+def parse_model_skeleton(buf):
+    # Only the bone section of a .model is read, meshes are skipped
+    r = Reader(buf)
+    header = r.str()
+    if header != 'CM3D2_MESH':
+        raise AnmFormatError(f'Not a model file: {header!r}')
+    version = r.int32()
+    r.str() # Model name
+    r.str() # Base bone name
+    n = r.int32()
+    names = []
+    for i in range(n):
+        names.append(r.str())
+        r.byte() # Scale flag
+    parents = [r.int32() for i in range(n)]
+    loc = []
+    rot = []
+    for i in range(n):
+        loc.append(r.floats(3))
+        rot.append(r.floats(4))
+        if version >= 2001 and r.byte():
+            r.floats(3) # Local scale
+    return Skeleton(names, parents, loc, rot)
+
+def read_model_skeleton(fn):
+    with open(fn, 'rb') as f:
+        return parse_model_skeleton(f.read())
@@ -0,0 +1,268 @@
+import argparse
+import glob
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import kktracks
+import scene
+from jobs import JobQueue, done
+from converted import ConvertedIndex
+from mapping import mapping_for_anm
+
+# Folder conversion spread over several background Blender processes.
+#
+#   python batch.py anms/18700 'anms/**/dance_*.anm' --blend scene.blend --out out --workers 8
+#
+# Importing this file has no side effects, main() is the command line.
+#
+# Each worker is a long running Blender that takes jobs from a shared
+# jobs.JobQueue over stdin and writes one .blend per clip holding just the KK
+# action. merge() then pulls those into a target .blend. Progress is kept in
+# convert_status.json in the output folder.
+# With --tracks workers write kktracks files instead and no action is kept.
+# With --scenes the clips of one scene are one job and are baked together.
+# With --preview every clip gets a quick <clip>.preview output first, then the
+# full pass replaces them.
+
+worker_fn = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.py')
+# Starts worker.py's reply line to a job
+reply_prefix = '@@job'
+# Preview actions and files are named like the clip's with this added. The
+# full conversion of a clip removes its preview.
+preview_suffix = '.preview'
+
+class ClipNameError(Exception):
+    pass
+
+def gen_by_ext(root_folder, extension, exclude=None):
+    if exclude is None:
+        exclude = set()
+    for cd, sd, sf in os.walk(root_folder):
+        for f in sf:
+            if f.endswith('.'+extension):
+                yield cd.replace('\\', '/') + '/' + f
+
+def find_anms(inputs):
+    # Folders are searched recursively, globs expanded, files taken as they are
+    ret = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            ret += gen_by_ext(pattern, 'anm')
+        elif glob.has_magic(pattern):
+            ret += sorted(f.replace('\\', '/') for f in glob.glob(pattern, recursive=True) if f.endswith('.anm'))
+        elif os.path.exists(pattern):
+            ret.append(pattern.replace('\\', '/'))
+        else:
+            raise FileNotFoundError(pattern)
+    return check_names(list(dict.fromkeys(ret)))
+
+def check_names(anm_fns):
+    # Actions and output files are named after the file name alone, clips
+    # with the same name in different folders would overwrite each other
+    by_name = {}
+    for f in anm_fns:
+        by_name.setdefault(action_name(f), []).append(f)
+    same = [fs for fs in by_name.values() if len(fs) > 1]
+    if same:
+        raise ClipNameError('Clips with the same file name: ' + '; '.join(', '.join(fs) for fs in same))
+    return anm_fns
+
+def action_name(anm_fn, preview=False):
+    return anm_fn.replace('\\', '/').split('/')[-1] + (preview_suffix if preview else '')
+
+def clip_output(out_dir, anm_fn, tracks=False, preview=False):
+    return os.path.join(out_dir, action_name(anm_fn, preview) + (kktracks.ext if tracks else '.blend'))
+
+def blender_cmd(blender, blend_fn, *args):
+    # Without --python-exit-code Blender exits with 0 when worker.py raises
+    return [blender, '-b', blend_fn, '--python-exit-code', '1', '-P', worker_fn, '--'] + list(args)
+
+def read_reply(proc):
+    # Passes Blender's output through, None if the worker died
+    for line in proc.stdout:
+        if line.startswith(reply_prefix):
+            return line[len(reply_prefix):].strip()
+        sys.stdout.write(line)
+    return None
+
+def run_worker(blender, blend_fn, queue, out_dir, flags, procs):
+    # Takes jobs until the queue is empty. A worker that dies fails its job
+    # and is restarted for the next one.
+    proc = None
+    while True:
+        job = queue.take()
+        if job is None:
+            break
+        if proc is None:
+            proc = subprocess.Popen(blender_cmd(blender, blend_fn, 'serve', out_dir, *flags),
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+            procs.append(proc)
+        try:
+            proc.stdin.write('\t'.join(f for f, m in job.clips) + '\n')
+            proc.stdin.flush()
+            reply = read_reply(proc)
+        except OSError:
+            reply = None
+        if reply == 'ok':
+            queue.finish(job)
+        elif reply is None:
+            queue.fail(job, f'worker exited with {proc.wait()}')
+            proc = None
+        else:
+            queue.fail(job, reply)
+    if proc is not None:
+        proc.stdin.close()
+        proc.wait()
+
+def run_pool(blender, blend_fn, queue, out_dir, workers, flags=()):
+    os.makedirs(out_dir, exist_ok=True)
+    procs = []
+    threads = [threading.Thread(target=run_worker, args=(blender, blend_fn, queue, out_dir, flags, procs), daemon=True)
+        for i in range(workers)]
+    for t in threads:
+        t.start()
+    try:
+        for t in threads:
+            while t.is_alive():
+                t.join(0.5)
+    except KeyboardInterrupt:
+        # Nothing new starts, running clips are abandoned
+        queue.cancel()
+        for p in procs:
+            p.kill()
+        raise
+
+def print_progress(status):
+    counts = status['counts']
+    print(f'[{counts["done"]}/{len(status["jobs"])}] {counts["running"]} running, {counts["failed"]} failed', flush=True)
+
+def merge(blender, target_fn, out_dir):
+    # Runs in its own Blender so the target file is saved by Blender itself
+    return subprocess.call(blender_cmd(blender, target_fn, 'merge', out_dir))
+
+def worker_flags(args):
+    # Options passed to worker.py serve
+    flags = []
+    if args.tracks:
+        flags.append('tracks')
+    if args.reduce:
+        flags.append('reduce')
+    if args.source_frames:
+        flags.append('source_frames')
+    if args.scenes:
+        flags.append('scenes')
+    if args.rigs:
+        flags.append('rigs=' + os.path.abspath(args.rigs))
+    if args.fps:
+        flags.append(f'fps={args.fps}')
+    if args.angle_tol is not None:
+        flags.append(f'angle_tol={args.angle_tol}')
+    if args.loc_tol is not None:
+        flags.append(f'loc_tol={args.loc_tol}')
+    if args.source_frames_only:
+        flags.append('source_frames_only')
+    if args.stride:
+        flags.append(f'stride={args.stride}')
+    return flags
+
+def tasks(args, blend_dir):
+    # [(clips, error)]: lists of (anm file, mapping file) converted together,
+    # and why the list cannot be converted, None if it can. See scene.jobs.
+    files = find_anms(args.inputs)
+    if args.scenes or args.rigs:
+        # Rig pairs by role, per scene or one clip per job
+        rigs = scene.load_rigs(args.rigs or os.path.join(blend_dir, scene.rigs_fn))
+        return scene.jobs(files, rigs, args.scenes)
+    return [([(f, os.path.join(blend_dir, mapping_for_anm(f)))], None) for f in files]
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Convert .anm files with parallel Blender workers')
+    parser.add_argument('inputs', nargs='+', help='Folders, globs or .anm files')
+    parser.add_argument('--blender', default='blender')
+    parser.add_argument('--blend', required=True, help='.blend with both armature pairs and main.py next to it')
+    parser.add_argument('--out', required=True, help='Folder for per-clip .blend files')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--merge-into', help='Also collect all actions into this .blend')
+    parser.add_argument('--tracks', action='store_true', help='Write kktracks files instead of .blend actions')
+    parser.add_argument('--reduce', action='store_true', help='Drop keys within --angle-tol and --loc-tol')
+    parser.add_argument('--angle-tol', type=float, help='Degrees, main.key_angle_tol if not given')
+    parser.add_argument('--loc-tol', type=float, help='main.key_loc_tol if not given')
+    parser.add_argument('--source-frames-only', action='store_true', help='With --reduce keep keys only on frames the clip has keys on')
+    parser.add_argument('--source-frames', action='store_true', help='Solve only frames the clips have keys on')
+    parser.add_argument('--scenes', action='store_true', help='Bake clips of one scene together, see scene.py')
+    parser.add_argument('--fps', type=int, help='Key at this rate instead of the scene rate')
+    parser.add_argument('--preview', action='store_true', help='Quick pass of core bones on every --stride-th frame first')
+    parser.add_argument('--stride', type=int, help='Frames apart previews are solved, main.preview_stride if not given')
+    parser.add_argument('--preview-only', action='store_true', help='Stop after the preview pass')
+    parser.add_argument('--rigs', help='Roles to mapping files and armature pairs, like scene_rigs.json')
+    parser.add_argument('--retries', type=int, default=1, help='Times a failed job is retried')
+    parser.add_argument('--status', help='Progress file, OUT/convert_status.json by default')
+    args = parser.parse_args(argv)
+    # Mapping files live next to the .blend like in main.py
+    blend_dir = os.path.dirname(os.path.abspath(args.blend))
+    # The preview stride does not change the full pass output
+    options = [f for f in worker_flags(args) if not f.startswith('stride=')]
+    converted = ConvertedIndex(os.path.join(args.out, 'converted_index.jsonl'), options)
+    todo = []
+    errors = []
+    for task, error in tasks(args, blend_dir):
+        if error is None:
+            outputs = [clip_output(args.out, f, args.tracks) for f, m in task]
+            if all(os.path.exists(out_fn) and converted.is_done(f, m) for out_fn, (f, m) in zip(outputs, task)):
+                continue
+            for out_fn in outputs:
+                if os.path.exists(out_fn):
+                    # Stale, removed so a failed reconversion does not look done
+                    os.remove(out_fn)
+        todo.append(task)
+        errors.append(error)
+    print(f'{sum(len(task) for task in todo)} clips to convert on {args.workers} workers')
+    os.makedirs(args.out, exist_ok=True)
+    # Previews of the whole list first, then the full pass over the same
+    # jobs replaces them one by one
+    passes = [False]
+    if args.preview_only:
+        passes = [True]
+    elif args.preview:
+        passes = [True, False]
+    # A failed job does not hold up the others or the next pass
+    ok = True
+    for preview in passes:
+        queue = run_pass(args, todo, errors, converted, preview)
+        for job in queue.jobs:
+            if job.state != done:
+                print(f'{job.state}: {[f for f, m in job.clips]} {job.error}')
+                ok = False
+    if not ok:
+        return 1
+    if args.merge_into and not args.tracks and not passes[-1]:
+        return merge(args.blender, args.merge_into, args.out)
+    return 0
+
+def run_pass(args, todo, errors, converted, preview=False):
+    flags = worker_flags(args) + (['preview'] if preview else [])
+    queue = JobQueue(todo, args.retries, args.status or os.path.join(args.out, 'convert_status.json'), print_progress, errors)
+    start = time.perf_counter()
+    try:
+        run_pool(args.blender, args.blend, queue, args.out, max(1, min(args.workers, len(queue.pending))), flags)
+    finally:
+        # Previews never count as converted
+        for job in queue.jobs:
+            if job.state != done or preview:
+                continue
+            for f, mapping_fn in job.clips:
+                converted.mark_done(f, mapping_fn)
+                preview_fn = clip_output(args.out, f, args.tracks, preview=True)
+                if os.path.exists(preview_fn):
+                    os.remove(preview_fn)
+        converted.compact()
+    seconds = time.perf_counter() - start
+    n_done = sum(len(job.clips) for job in queue.jobs if job.state == done)
+    print(f'{n_done} {"previews" if preview else "clips"} in {seconds:.1f} s, {n_done / max(seconds, 1e-9):.2f} clips/s')
+    return queue
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,306 @@
+import argparse
+import os
+import struct
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+import anm
+import kkrig
+import mapping
+import solver
+import tpose
+from kernel import *
+
+# Benchmarks for the headless transfer
+#
+#   python bench.py mapping_female.json --frames 300 1000 5000
+#   python bench.py mapping_female.json --model body001.model --anm a.anm b.anm
+#   blender -b -P bench.py -- mapping_female.json --eval-cache
+#
+# Without --model the CM skeleton is built from the T-pose basis and clips are
+# generated with random keys. Without the .kkrig.npz SaveTPoseBasis exports,
+# the KK rig is a flat one from the basis. Nothing outside this folder is
+# needed.
+# Everything runs without Blender except --eval-cache, which times main.py's
+# frame loop on mocked armatures.
+
+# Synthetic data
+
+def synthetic_skeleton(cm_basis):
+    # Parent of a bone is the earlier bone whose tail is closest to its head.
+    # Basis files list parents before children, like pose.bones does.
+    n = len(cm_basis.names)
+    to_unity = solver.unity_to_blender.T / (solver.cm_import_scale * solver.scale_cm_to_kk)
+    head = cm_basis.head @ to_unity.T
+    tail = cm_basis.tail @ to_unity.T
+    g_rot = conjugate(cm_basis.basis, solver.unity_to_blender.T)
+    parents = [-1]
+    for i in range(1, n):
+        parents.append(int(np.argmin(np.linalg.norm(tail[:i] - head[i], axis=-1))))
+    loc = np.empty((n, 3))
+    rot = np.empty((n, 3, 3))
+    for i, p in enumerate(parents):
+        if p < 0:
+            loc[i] = head[i]
+            rot[i] = g_rot[i]
+        else:
+            loc[i] = g_rot[p].T @ (head[i] - head[p])
+            rot[i] = g_rot[p].T @ g_rot[i]
+    return anm.Skeleton(list(cm_basis.names), parents, loc, matrix_to_quat(rot)[:, [1, 2, 3, 0]])
+
+def synthetic_rig(kk_basis):
+    # Every bone a root, rest rotations from the T-pose basis made orthonormal
+    u, s, vt = np.linalg.svd(kkrig.axis_permutation.T @ kk_basis.basis)
+    rest_rot = u @ vt
+    n = len(kk_basis.names)
+    return kkrig.KKRig(kk_basis.names, [-1] * n, rest_rot, kk_basis.head @ kkrig.axis_permutation, [True] * n)
+
+def anm_str(s):
+    b = s.encode('utf-8')
+    out = bytearray()
+    n = len(b)
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out) + b
+
+def synthetic_anm(skeleton, seconds, key_interval=1 / 30, seed=0):
+    # Every bone gets rotation keys wobbling around rest, the root also moves
+    rng = np.random.default_rng(seed)
+    times = np.arange(0, seconds + key_interval / 2, key_interval, dtype=np.float32)
+    out = [anm_str('CM3D2_ANIM'), struct.pack('<i', 1001)]
+    for b, name in enumerate(skeleton.names):
+        out.append(b'\x01' + anm_str(name))
+        noise = rng.normal(0, 0.05, (len(times), 4)).cumsum(0) * 0.1
+        q = skeleton.rot[b] + noise
+        q /= np.linalg.norm(q, axis=-1, keepdims=True)
+        channels = dict(zip(anm.channel_rot, q.T))
+        if skeleton.parents[b] < 0:
+            channels.update(zip(anm.channel_loc, (skeleton.loc[b] + noise[:, :3]).T))
+        for channel_id, values in channels.items():
+            keys = np.zeros((len(times), 4), dtype='<f4')
+            keys[:, 0] = times
+            keys[:, 1] = values
+            out.append(struct.pack('<Bi', channel_id, len(times)) + keys.tobytes())
+    out.append(b'\x00')
+    return b''.join(out)
+
+# Benchmarks. Each takes a clip and the frames to solve and returns the
+# number of frames it solved.
+
+class Setup:
+    def __init__(self, m, skeleton):
+        bases = tpose.load(m.tpose_basis)
+        self.m = m
+        self.skeleton = skeleton
+        self.cm_basis = bases[m.cm_basis_arm]
+        self.kk_basis = bases[m.kk_basis_arm]
+        self.rotations = [(op.cm, op.kk) for op in m.ops if op.op == 'rotation']
+        self.locations = [op for op in m.ops if op.op == 'location']
+        fingers = [op for op in m.ops if op.op == 'orientation' and 'Finger' in op.cm]
+        self.fingers = [op.cm for op in fingers]
+        # KK bones at rest, where reset_kk_arm leaves them
+        self.finger_btb = self.kk_basis.basis[[self.kk_basis.index[op.kk] for op in fingers]]
+        self.finger_rolls = np.array([op.roll or 0 for op in fingers])
+        # The rig SaveTPoseBasis exported, a flat one from the basis otherwise
+        rig_fn = kkrig.rig_fn(m.tpose_basis)
+        self.rig = kkrig.load(rig_fn) if os.path.exists(rig_fn) else synthetic_rig(self.kk_basis)
+
+    def pose(self, clip, frames):
+        return solver.cm_pose(clip, self.skeleton, self.cm_basis, frames)
+
+def bench_rotation(s, clip, frames):
+    pose = s.pose(clip, frames)
+    for cm, kk in s.rotations:
+        solver.transfer_rotation(pose, s.kk_basis, cm, kk)
+    return len(frames)
+
+def bench_location(s, clip, frames):
+    pose = s.pose(clip, frames)
+    kk_pose = kkrig.KKPose(s.rig, len(frames))
+    for op in s.locations:
+        if s.rig.supports(op):
+            solver.solve_op(pose, kk_pose, s.kk_basis, op)
+    return len(frames)
+
+def bench_fingers(s, clip, frames):
+    # All finger orientations in one kernel call, like solve_orientations
+    pose = s.pose(clip, frames)
+    cur = np.stack([pose.basis(cm) for cm in s.fingers], axis=1)
+    match_orientation(s.finger_btb, cur, s.finger_rolls)
+    return len(frames)
+
+def bench_keys(s, clip, frames):
+    # Rotations on the clip's own key frames only
+    frames = solver.key_frames(clip, 8)
+    pose = s.pose(clip, frames)
+    for cm, kk in s.rotations:
+        solver.transfer_rotation(pose, s.kk_basis, cm, kk)
+    return len(frames)
+
+def bench_full(s, clip, frames):
+    # From raw bytes, so parsing is included, then the whole mapping on the
+    # KK rig like kkrig.convert
+    clip = anm.parse_anm(clip.raw)
+    pose = s.pose(clip, frames)
+    solver.solve_mapping(pose, kkrig.KKPose(s.rig, len(frames)), s.kk_basis, s.m)
+    return len(frames)
+
+benchmarks = {
+    'rotation': bench_rotation,
+    'location': bench_location,
+    'fingers': bench_fingers,
+    'keys': bench_keys,
+    'full': bench_full,
+}
+
+def run(s, clips, repeat):
+    # Returns (benchmark, clip label, solved frames, solved frames per second), best of repeat
+    ret = []
+    for label, clip in clips:
+        frames = solver.clip_frames(clip)
+        for name, fun in benchmarks.items():
+            best = float('inf')
+            for i in range(repeat):
+                t = time.perf_counter()
+                n = fun(s, clip, frames)
+                best = min(best, time.perf_counter() - t)
+            ret.append((name, label, n, n / best))
+    return ret
+
+# main.py's frame loop: EvalCache snapshots, bound ops and transfer_level.
+# Armatures are mocked with the mapping's bones only and their snapshots come
+# from the T-pose basis, so the depsgraph is not part of the time.
+
+class MockPoseBone:
+    def __init__(self, name):
+        from mathutils import Quaternion, Vector
+        self.name = name
+        self.parent = None
+        self.constraints = ()
+        self.location = Vector()
+        self.rotation_quaternion = Quaternion()
+        self.props = {}
+
+    def __setitem__(self, key, value):
+        # Custom properties like IK_FK
+        self.props[key] = value
+
+class MockPoseBones(list):
+    # pose.bones, foreach_get reads the snapshot arrays
+    def __init__(self, names, snap):
+        super().__init__(MockPoseBone(n) for n in names)
+        self.snap = snap
+
+    def foreach_get(self, attr, arr):
+        arr[:] = self.snap[attr].ravel()
+
+    def foreach_set(self, attr, arr):
+        for pb, value in zip(self, np.reshape(arr, (len(self), -1))):
+            setattr(pb, attr, type(getattr(pb, attr))(value))
+
+class MockArmature:
+    def __init__(self, name, names, snap):
+        self.name = name
+        self.pose = SimpleNamespace(bones=MockPoseBones(names, snap))
+        self.animation_data = None
+
+    def evaluated_get(self, depsgraph):
+        return self
+
+class MockContext:
+    def __init__(self, armatures):
+        self.scene = SimpleNamespace(objects={ob.name: ob for ob in armatures},
+            frame_current=0, frame_current_final=0.0, render=SimpleNamespace(fps=solver.anm_fps))
+
+    def evaluated_depsgraph_get(self):
+        return None
+
+class MockOperator:
+    def report(self, level, message):
+        pass
+
+def mock_snapshot(basis, names, is_kk):
+    # Undoes what bone_anim_bases and bone_anim_vec_attr apply
+    idx = [basis.index[n] for n in names]
+    axes = basis.basis[idx]
+    head = basis.head[idx]
+    tail = basis.tail[idx]
+    if is_kk:
+        p = kkrig.axis_permutation
+        axes, head, tail = p.T @ axes, head @ p, tail @ p
+    else:
+        head, tail = head / solver.scale_cm_to_kk, tail / solver.scale_cm_to_kk
+    rotation = np.zeros((len(idx), 4))
+    rotation[:, 0] = 1
+    return {
+        'head': head, 'tail': tail,
+        'x_axis': axes[..., 0], 'y_axis': axes[..., 1], 'z_axis': axes[..., 2],
+        'rotation_quaternion': rotation,
+    }
+
+def bench_eval_cache(m, n_frames, repeat):
+    # Returns frames per second of PoseTransfer.bake_frame, best of repeat
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main as blender_main
+    bases = tpose.load(m.tpose_basis)
+    arms = [MockArmature(arm_name, names, mock_snapshot(bases[arm_name], names, is_kk))
+        for arm_name, names, is_kk in ((m.cm_arm, m.cm_bones(), False), (m.kk_arm, m.kk_bones(), True))]
+    C = MockContext(arms)
+    t = blender_main.ClipTransfer(MockOperator(), 'bench', blender_main.EvalCache(), True)
+    t.setup(C, m, 'bench')
+    best = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        for f in range(n_frames):
+            # A new frame, so every snapshot is fetched again
+            C.scene.frame_current_final = f + 0.5
+            t.bake_frame(C, f)
+        best = min(best, time.perf_counter() - start)
+        for keys in t.baked_keys.values():
+            keys.clear()
+    return n_frames / best
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the headless transfer')
+    parser.add_argument('mapping')
+    parser.add_argument('--model', help='CM body .model, synthetic skeleton if not given')
+    parser.add_argument('--anm', nargs='*', default=[], help='Recorded clips to run')
+    parser.add_argument('--frames', type=int, nargs='*', default=[300, 1000, 5000], help='Synthetic clip lengths')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--eval-cache', action='store_true', help="main.py's frame loop on mocked armatures, run in Blender")
+    args = parser.parse_args(argv)
+    m = mapping.load(args.mapping)
+    if args.eval_cache:
+        print(f'{"benchmark":<10}{"frames":>8}{"frames/s":>12}')
+        for n in args.frames:
+            print(f'{"eval_cache":<10}{n:>8}{bench_eval_cache(m, n, args.repeat):>12.0f}')
+        return 0
+    if args.model:
+        skeleton = anm.read_model_skeleton(args.model)
+    else:
+        skeleton = synthetic_skeleton(tpose.load(m.tpose_basis)[m.cm_basis_arm])
+    clips = []
+    for n in args.frames:
+        raw = synthetic_anm(skeleton, n / solver.anm_fps)
+        clips.append((f'synthetic {n}', raw))
+    for fn in args.anm:
+        with open(fn, 'rb') as f:
+            clips.append((fn, f.read()))
+    parsed = []
+    for label, raw in clips:
+        clip = anm.parse_anm(raw)
+        clip.raw = raw
+        parsed.append((label, clip))
+    print(f'{"benchmark":<10}{"clip":<24}{"frames":>8}{"frames/s":>12}')
+    for name, label, n, fps in run(Setup(m, skeleton), parsed, args.repeat):
+        print(f'{name:<10}{label:<24}{n:>8}{fps:>12.0f}')
+    return 0
+
+if __name__ == '__main__':
+    # Blender passes its own arguments before --
+    sys.exit(main(sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else sys.argv[1:]))
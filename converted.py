@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+
+import mapping
+import tpose
+
+# Persistent record of converted clips
+#
+# A clip counts as converted when its content hash, the hash of the T-pose
+# basis file, the hash of the mapping file and the options that change the
+# output all match what they were at conversion time. File hashes are reused while size and mtime are unchanged,
+# so a rerun over an unchanged library only stats files.
+#
+# The index is an append-only JSON lines file, the last line for a path wins.
+
+def file_sha1(fn):
+    h = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class ConvertedIndex:
+    def __init__(self, fn, options=()):
+        self.fn = fn
+        # Like batch.worker_flags, part of every key
+        self.options = list(options)
+        self.entries = {}
+        # Hashes of basis and mapping files, computed once per process
+        self.hashes = {}
+        if os.path.exists(fn):
+            with open(fn) as f:
+                for line in f:
+                    if line.strip():
+                        e = json.loads(line)
+                        self.entries[e['anm']] = e
+
+    def anm_hash(self, anm_fn):
+        st = os.stat(anm_fn)
+        e = self.entries.get(anm_fn)
+        if e is not None and e['size'] == st.st_size and e['mtime_ns'] == st.st_mtime_ns:
+            return e['sha1'], st
+        return file_sha1(anm_fn), st
+
+    def setup_key(self, mapping_fn):
+        mapping_fn = os.path.abspath(mapping_fn)
+        if mapping_fn not in self.hashes:
+            m = mapping.load(mapping_fn)
+            self.hashes[mapping_fn] = [file_sha1(tpose.resolve(m.tpose_basis)), file_sha1(mapping_fn)]
+        return self.hashes[mapping_fn]
+
+    def key(self, sha1, mapping_fn):
+        return [sha1] + self.setup_key(mapping_fn) + self.options
+
+    def is_done(self, anm_fn, mapping_fn):
+        e = self.entries.get(anm_fn)
+        if e is None:
+            return False
+        sha1, st = self.anm_hash(anm_fn)
+        return e['key'] == self.key(sha1, mapping_fn)
+
+    def mark_done(self, anm_fn, mapping_fn):
+        sha1, st = self.anm_hash(anm_fn)
+        e = {
+            'anm': anm_fn,
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'sha1': sha1,
+            'key': self.key(sha1, mapping_fn),
+        }
+        self.entries[anm_fn] = e
+        with open(self.fn, 'a') as f:
+            f.write(json.dumps(e) + '\n')
+
+    def compact(self):
+        # Rewrite with one line per clip
+        with open(self.fn + '.tmp', 'w') as f:
+            for e in self.entries.values():
+                f.write(json.dumps(e) + '\n')
+        os.replace(self.fn + '.tmp', self.fn)
@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+import anm
+import batch
+import solver
+
+# Clip corpus: many .anm files sampled once into one memory-mapped store
+#
+#   python corpus.py anms/ --out corpus/ --model body001.model
+#
+# corpus/rot.npy    (frames, bones, 4) float32 local rotations, w x y z
+# corpus/loc.npy    (frames, bones, 3) float32 local locations
+# corpus/offsets.npy  clip i is frames offsets[i]:offsets[i + 1]
+# corpus/clips.json   clip and bone names, fps
+#
+# Frames of all clips are stacked along the first axis. Corpus.clip returns
+# views into the mapped files, so sweeps over many clips read only the pages
+# they touch and parse nothing.
+
+class Corpus:
+    def __init__(self, folder):
+        with open(os.path.join(folder, 'clips.json')) as f:
+            meta = json.loads(f.read())
+        self.fps = meta['fps']
+        self.bones = meta['bones']
+        self.names = meta['clips']
+        self.files = meta['files']
+        # Clips are looked up by name or by the path they were ingested from
+        self.index = {n: i for i, n in enumerate(self.names)}
+        self.index.update((fn, i) for i, fn in enumerate(self.files))
+        self.offsets = np.load(os.path.join(folder, 'offsets.npy'))
+        self.rot = np.load(os.path.join(folder, 'rot.npy'), mmap_mode='r')
+        self.loc = np.load(os.path.join(folder, 'loc.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.names)
+
+    def clip(self, name_or_index):
+        # (rot, loc) views of every frame of one clip
+        i = self.index[name_or_index] if isinstance(name_or_index, str) else name_or_index
+        a, b = self.offsets[i], self.offsets[i + 1]
+        return self.rot[a:b], self.loc[a:b]
+
+    def pose(self, name_or_index, skeleton, cm_basis, rest_rot=None, fps=None):
+        # solver.CMPose of a clip. skeleton must be the one the corpus was built with.
+        # With fps the clip is resampled to that rate first, so only frames
+        # at the new rate are solved.
+        rot, loc = self.clip(name_or_index)
+        if fps is not None and fps != self.fps:
+            times = np.arange(len(rot)) / self.fps
+            rot, loc = solver.resample(times, rot, loc, np.arange(int(round(times[-1] * fps)) + 1) / fps)
+        return solver.local_pose(skeleton, cm_basis, rot, loc, rest_rot)
+
+def ingest(anm_fns, skeleton, folder, fps=solver.anm_fps):
+    # Two passes: clip lengths first so the stores can be allocated once.
+    # Clip names must be unique, see batch.check_names.
+    anm_fns = batch.check_names(list(anm_fns))
+    os.makedirs(folder, exist_ok=True)
+    lengths = []
+    for fn in anm_fns:
+        lengths.append(len(solver.clip_frames(anm.read_anm(fn, use_mmap=True), fps)))
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    n_bones = len(skeleton.names)
+    rot = np.lib.format.open_memmap(os.path.join(folder, 'rot.npy'), 'w+', np.float32, (int(offsets[-1]), n_bones, 4))
+    loc = np.lib.format.open_memmap(os.path.join(folder, 'loc.npy'), 'w+', np.float32, (int(offsets[-1]), n_bones, 3))
+    for i, fn in enumerate(anm_fns):
+        clip = anm.read_anm(fn, use_mmap=True)
+        frames = solver.clip_frames(clip, fps)
+        # Chunked like the streaming solver so memory stays flat for long clips
+        for j in range(0, len(frames), solver.chunk_size):
+            chunk = frames[j:j + solver.chunk_size]
+            r, l = solver.sample_clip(clip, skeleton, chunk / fps)
+            a = offsets[i] + j
+            rot[a:a + len(chunk)] = r
+            loc[a:a + len(chunk)] = l
+    rot.flush()
+    loc.flush()
+    del rot, loc
+    np.save(os.path.join(folder, 'offsets.npy'), offsets)
+    # Written last, a corpus without it is incomplete
+    with open(os.path.join(folder, 'clips.json'), 'w') as f:
+        f.write(json.dumps({
+            'fps': fps,
+            'bones': list(skeleton.names),
+            'clips': [batch.action_name(fn) for fn in anm_fns],
+            'files': list(anm_fns),
+        }))
+    return Corpus(folder)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Sample .anm files into a memory-mapped corpus')
+    parser.add_argument('inputs', nargs='+', help='Folders, globs or .anm files')
+    parser.add_argument('--out', required=True, help='Corpus folder')
+    parser.add_argument('--model', required=True, help='CM body .model the clips play on')
+    parser.add_argument('--fps', type=float, default=solver.anm_fps)
+    args = parser.parse_args(argv)
+    c = ingest(batch.find_anms(args.inputs), anm.read_model_skeleton(args.model), args.out, args.fps)
+    print(f'{len(c)} clips, {c.offsets[-1]} frames in {args.out}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
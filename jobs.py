@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+import time
+
+# Queue of conversion jobs shared by the Blender folder operator and batch.py
+#
+# A job is a list of clips converted together, one clip or one scene. Whoever
+# runs jobs calls take() for the next one and finish() or fail() when it is
+# over. Failed jobs go back to the queue until they used up their retries.
+# Every state change rewrites the status file and calls on_progress, so a
+# UI or a script can follow along without polling the runners. Jobs known to
+# be broken up front, e.g. a scene with no rig for one of its roles, are
+# passed with their error and start out failed.
+#
+# All methods can be called from several threads.
+
+queued = 'queued'
+running = 'running'
+done = 'done'
+failed = 'failed'
+cancelled = 'cancelled'
+
+class Job:
+    def __init__(self, job_id, clips):
+        self.id = job_id
+        self.clips = clips # [(anm file, mapping file)]
+        self.state = queued
+        self.attempts = 0
+        self.error = None
+        self.started = None
+        self.ended = None
+
+    def status(self):
+        return {
+            'id': self.id,
+            'clips': [anm_fn for anm_fn, mapping_fn in self.clips],
+            'state': self.state,
+            'attempts': self.attempts,
+            'error': self.error,
+            'seconds': None if self.started is None else (self.ended or time.time()) - self.started,
+        }
+
+class JobQueue:
+    def __init__(self, clip_lists, retries=1, status_fn=None, on_progress=None, errors=None):
+        self.jobs = [Job(i, clips) for i, clips in enumerate(clip_lists)]
+        for job, error in zip(self.jobs, errors or ()):
+            if error is not None:
+                job.state = failed
+                job.error = str(error)
+        self.retries = retries
+        self.status_fn = status_fn
+        self.on_progress = on_progress
+        self.pending = [job for job in self.jobs if job.state == queued]
+        self.cancelled = False
+        # Reentrant, changed() builds the status under the lock it writes under
+        self.lock = threading.RLock()
+        self.started = time.time()
+        self.changed()
+
+    def take(self):
+        # Next job to run, None when nothing is left to start
+        with self.lock:
+            if not self.pending:
+                return None
+            job = self.pending.pop(0)
+            job.state = running
+            job.attempts += 1
+            job.started = time.time()
+            job.ended = None
+        self.changed()
+        return job
+
+    def finish(self, job):
+        with self.lock:
+            job.state = done
+            job.error = None
+            job.ended = time.time()
+        self.changed()
+
+    def fail(self, job, error):
+        with self.lock:
+            job.error = str(error)
+            job.ended = time.time()
+            if job.state == cancelled:
+                # Stopped by cancel(), stays that way
+                pass
+            elif job.attempts <= self.retries and not self.cancelled:
+                job.state = queued
+                self.pending.append(job)
+            else:
+                job.state = failed
+        self.changed()
+
+    def cancel(self, running_jobs=()):
+        # Nothing new is handed out. Running jobs are left to their runner,
+        # except running_jobs, which the caller stopped itself.
+        with self.lock:
+            self.cancelled = True
+            for job in self.pending + [job for job in running_jobs if job.state == running]:
+                job.state = cancelled
+                job.ended = time.time()
+            self.pending = []
+        self.changed()
+
+    def counts(self):
+        ret = {s: 0 for s in (queued, running, done, failed, cancelled)}
+        for job in self.jobs:
+            ret[job.state] += 1
+        return ret
+
+    def is_finished(self):
+        counts = self.counts()
+        return counts[queued] == 0 and counts[running] == 0
+
+    def status(self):
+        with self.lock:
+            return {
+                'counts': self.counts(),
+                'seconds': time.time() - self.started,
+                'jobs': [job.status() for job in self.jobs],
+            }
+
+    def changed(self):
+        if self.status_fn is None and self.on_progress is None:
+            return
+        # One critical section, so an older snapshot never replaces a newer one
+        with self.lock:
+            status = self.status()
+            if self.status_fn is not None:
+                with open(self.status_fn + '.tmp', 'w') as f:
+                    f.write(json.dumps(status, indent=1))
+                os.replace(self.status_fn + '.tmp', self.status_fn)
+        if self.on_progress is not None:
+            self.on_progress(status)
@@ -0,0 +1,122 @@
+import numpy as np
+
+# Batched rotation helpers. Quaternions are w, x, y, z like mathutils.
+# Every function takes arrays with any number of leading dimensions.
+
+def quat_to_matrix(q):
+    q = q / np.linalg.norm(q, axis=-1, keepdims=True)
+    w, x, y, z = np.moveaxis(q, -1, 0)
+    ret = np.empty(q.shape[:-1] + (3, 3), dtype=q.dtype)
+    ret[..., 0, 0] = 1 - 2 * (y * y + z * z)
+    ret[..., 0, 1] = 2 * (x * y - z * w)
+    ret[..., 0, 2] = 2 * (x * z + y * w)
+    ret[..., 1, 0] = 2 * (x * y + z * w)
+    ret[..., 1, 1] = 1 - 2 * (x * x + z * z)
+    ret[..., 1, 2] = 2 * (y * z - x * w)
+    ret[..., 2, 0] = 2 * (x * z - y * w)
+    ret[..., 2, 1] = 2 * (y * z + x * w)
+    ret[..., 2, 2] = 1 - 2 * (x * x + y * y)
+    return ret
+
+def matrix_to_quat(m):
+    # Branchless version of the usual trace method, picks the largest pivot per item
+    m00, m01, m02 = m[..., 0, 0], m[..., 0, 1], m[..., 0, 2]
+    m10, m11, m12 = m[..., 1, 0], m[..., 1, 1], m[..., 1, 2]
+    m20, m21, m22 = m[..., 2, 0], m[..., 2, 1], m[..., 2, 2]
+    cand = np.stack([
+        np.stack([1 + m00 + m11 + m22, m21 - m12, m02 - m20, m10 - m01], -1),
+        np.stack([m21 - m12, 1 + m00 - m11 - m22, m01 + m10, m02 + m20], -1),
+        np.stack([m02 - m20, m01 + m10, 1 - m00 + m11 - m22, m12 + m21], -1),
+        np.stack([m10 - m01, m02 + m20, m12 + m21, 1 - m00 - m11 + m22], -1),
+    ], -2)
+    pivot = np.argmax(np.stack([cand[..., i, i] for i in range(4)], -1), axis=-1)
+    ret = np.take_along_axis(cand, pivot[..., None, None], axis=-2)[..., 0, :]
+    ret = ret / np.linalg.norm(ret, axis=-1, keepdims=True)
+    # Keep w positive so results are comparable to mathutils
+    return np.where(ret[..., :1] < 0, -ret, ret)
+
+def normalized(v):
+    # Unit vectors along the last axis, zero vectors stay zero like Vector.normalized()
+    n = np.linalg.norm(v, axis=-1, keepdims=True)
+    return np.divide(v, n, out=np.zeros(np.broadcast_shapes(v.shape, n.shape)), where=n > 0)
+
+def conjugate(m, basis):
+    # Express rotation m given in one frame in the frame reached by basis
+    return basis @ m @ basis.T
+
+def quat_multiply(a, b):
+    aw, ax, ay, az = np.moveaxis(a, -1, 0)
+    bw, bx, by, bz = np.moveaxis(b, -1, 0)
+    return np.stack([
+        aw * bw - ax * bx - ay * by - az * bz,
+        aw * bx + ax * bw + ay * bz - az * by,
+        aw * by - ax * bz + ay * bw + az * bx,
+        aw * bz + ax * by - ay * bx + az * bw,
+    ], -1)
+
+def axis_quat(angle, axis):
+    ret = np.zeros(np.shape(angle) + (4,))
+    ret[..., 0] = np.cos(angle / 2)
+    ret[..., 1 + axis] = np.sin(angle / 2)
+    return ret
+
+# Euler angles are x, y, z like mathutils.Euler, order 'YXZ' only:
+# Y is applied first, then X, then Z, so the matrix is Rz @ Rx @ Ry
+
+def matrix_to_euler_yxz(m):
+    # Of the two solutions the one with the smaller sum of absolute angles
+    # is picked, same as mathutils
+    cos_x = np.hypot(m[..., 0, 1], m[..., 1, 1])
+    x1 = np.arctan2(m[..., 2, 1], cos_x)
+    x2 = np.arctan2(m[..., 2, 1], -cos_x)
+    y1 = np.arctan2(-m[..., 2, 0], m[..., 2, 2])
+    y2 = np.arctan2(m[..., 2, 0], -m[..., 2, 2])
+    z1 = np.arctan2(-m[..., 0, 1], m[..., 1, 1])
+    z2 = np.arctan2(m[..., 0, 1], -m[..., 1, 1])
+    # Gimbal lock, X is +-90 degrees and only Y + Z is defined
+    locked = cos_x < 16 * np.finfo(m.dtype).eps
+    y_locked = np.arctan2(m[..., 0, 2], m[..., 0, 0])
+    e1 = np.stack([x1, np.where(locked, y_locked, y1), np.where(locked, 0, z1)], -1)
+    e2 = np.stack([x2, y2, z2], -1)
+    use_2 = ~locked & (np.abs(e2).sum(-1) < np.abs(e1).sum(-1))
+    return np.where(use_2[..., None], e2, e1)
+
+def euler_yxz_to_quat(e):
+    return quat_multiply(quat_multiply(axis_quat(e[..., 2], 2), axis_quat(e[..., 0], 0)), axis_quat(e[..., 1], 1))
+
+def transform_basis(anim_basis, rotation_quaternion):
+    # bone_transform_basis: the basis with the bone's own rotation taken out
+    return anim_basis @ np.swapaxes(quat_to_matrix(rotation_quaternion), -1, -2)
+
+def local_rotation(btb, global_rot):
+    # bone_rot_write: global rotation expressed in the bone's transform basis
+    return matrix_to_quat(np.linalg.inv(btb) @ global_rot @ btb)
+
+def match_orientation(btb, cur_rot_global, extra_roll=0):
+    # TransferPoseCommon.match_orientation for any number of bones and frames
+    e = matrix_to_euler_yxz(np.linalg.inv(btb) @ cur_rot_global)
+    e[..., 1] += extra_roll
+    return euler_yxz_to_quat(e)
+
+def match_leg_fk_roll(btb, cur_rot_global, override_roll=None):
+    e = matrix_to_euler_yxz(np.linalg.inv(btb) @ cur_rot_global)
+    if override_roll is not None:
+        # NaN keeps the solved roll, so one call can mix overridden and free bones
+        e[..., 1] = np.where(np.isnan(override_roll), e[..., 1], override_roll)
+    return euler_yxz_to_quat(e)
+
+def slerp(q0, q1, t):
+    # Shortest arc from q0 to q1, t broadcasts against the leading dimensions
+    t = np.asarray(t, dtype=np.float64)[..., None]
+    dot = (q0 * q1).sum(-1, keepdims=True)
+    q1 = np.where(dot < 0, -q1, q1)
+    dot = np.clip(np.abs(dot), 0, 1)
+    angle = np.arccos(dot)
+    sin = np.sin(angle)
+    # Nearly equal quaternions fall back to lerp, which is exact in the limit
+    near = sin < 1e-6
+    sin = np.where(near, 1, sin)
+    w0 = np.where(near, 1 - t, np.sin((1 - t) * angle) / sin)
+    w1 = np.where(near, t, np.sin(t * angle) / sin)
+    ret = w0 * q0 + w1 * q1
+    return ret / np.linalg.norm(ret, axis=-1, keepdims=True)
@@ -0,0 +1,237 @@
+import argparse
+import os
+import sys
+from math import radians
+
+import numpy as np
+
+import anm
+import batch
+import kktracks
+import mapping
+import solver
+import tpose
+from kernel import *
+
+# Rest hierarchy of the KK armature and forward kinematics on it without Blender
+#
+#   python kkrig.py mapping_female.json anms/ --model body001.model --out tracks/
+#
+# converts clips to kktracks files with no Blender at all, for mappings whose
+# ops the rig can evaluate.
+#
+# Exported once per rig by SaveTPoseBasis next to the basis file. Everything
+# is in armature space. Bones whose pose a constraint can change (the bone
+# itself, IK chains, or any ancestor of those) are not exact: FK of plain
+# parenting does not give their pose and callers must not rely on it.
+#
+# Pose matrix of a bone: M = M_parent @ rest_parent^-1 @ rest @ basis, where
+# basis is the pose bone's location and rotation_quaternion. KKPose answers
+# in transfer space like bone_anim_basis and bone_anim_head do in main.py.
+
+# Axis permutation bone_anim_basis applies to the KK armature
+axis_permutation = np.array(((1, 0, 0), (0, 0, -1), (0, 1, 0)), dtype=np.float64)
+
+class RigError(Exception):
+    pass
+
+class KKRig:
+    def __init__(self, names, parents, rest_rot, rest_head, exact):
+        self.names = list(names)
+        self.index = {n: i for i, n in enumerate(self.names)}
+        self.parents = np.asarray(parents, dtype=np.int32)
+        self.rest_rot = np.asarray(rest_rot, dtype=np.float64) # (n, 3, 3)
+        self.rest_head = np.asarray(rest_head, dtype=np.float64) # (n, 3)
+        self.exact = np.asarray(exact, dtype=bool)
+        # Rest transform relative to the parent's rest transform
+        self.rel_rot = self.rest_rot.copy()
+        self.rel_head = self.rest_head.copy()
+        for i, p in enumerate(self.parents):
+            if p >= 0:
+                self.rel_rot[i] = self.rest_rot[p].T @ self.rest_rot[i]
+                self.rel_head[i] = self.rest_rot[p].T @ (self.rest_head[i] - self.rest_head[p])
+        self.depth = np.zeros(len(self.names), dtype=np.int32)
+        for i in range(len(self.names)):
+            p = self.parents[i]
+            while p >= 0:
+                self.depth[i] += 1
+                p = self.parents[p]
+        # Parents before children
+        self.order = np.argsort(self.depth, kind='stable')
+
+    def supports(self, op):
+        # Reads of the op come out the same as Blender's
+        i = self.index.get(op.kk)
+        if i is None:
+            return False
+        if mapping.write_paths[op.op] == 'location':
+            return bool(self.exact[i])
+        p = self.parents[i]
+        return p < 0 or bool(self.exact[p])
+
+    def chain(self, names):
+        # Indices of the bones and all their ancestors, parents first
+        ret = set()
+        for n in names:
+            i = self.index[n]
+            while i >= 0 and i not in ret:
+                ret.add(i)
+                i = self.parents[i]
+        return sorted(ret, key=lambda i: self.depth[i])
+
+def rig_fn(tpose_basis_fn):
+    return os.path.splitext(tpose_basis_fn)[0] + '.kkrig.npz'
+
+def save(rig, fn):
+    with open(fn + '.tmp', 'wb') as f:
+        np.savez(f, names=np.array(rig.names), parents=rig.parents, rest_rot=rig.rest_rot,
+            rest_head=rig.rest_head, exact=rig.exact)
+    os.replace(fn + '.tmp', fn)
+    return fn
+
+def load(fn):
+    with np.load(fn) as f:
+        return KKRig([str(n) for n in f['names']], f['parents'], f['rest_rot'], f['rest_head'], f['exact'])
+
+class KKPose:
+    # Pose bone locations and rotations of the KK armature for a batch of
+    # frames, starting from the rest pose like reset_kk_arm leaves it.
+    # Pose matrices are evaluated on demand for the bones asked for.
+    def __init__(self, rig, n_frames):
+        self.rig = rig
+        n = len(rig.names)
+        self.location = np.zeros((n_frames, n, 3))
+        self.rotation_quaternion = np.zeros((n_frames, n, 4))
+        self.rotation_quaternion[..., 0] = 1
+        self.rot = None # (frames, n, 3, 3) pose rotations, armature space
+        self.head = None
+        self.valid = np.zeros(n, dtype=bool)
+
+    def set(self, bone_name, data_path, value):
+        i = self.rig.index[bone_name]
+        getattr(self, data_path)[:, i] = value
+        # The bone and everything below it moves
+        self.valid &= ~self.descendants(i)
+
+    def descendants(self, i):
+        ret = np.zeros(len(self.rig.names), dtype=bool)
+        ret[i] = True
+        for j in self.rig.order:
+            p = self.rig.parents[j]
+            if p >= 0 and ret[p]:
+                ret[j] = True
+        return ret
+
+    def evaluate(self, bone_names):
+        rig = self.rig
+        if self.rot is None:
+            n_frames, n = self.location.shape[:2]
+            self.rot = np.zeros((n_frames, n, 3, 3))
+            self.head = np.zeros((n_frames, n, 3))
+        for i in rig.chain(bone_names):
+            if self.valid[i]:
+                continue
+            p = rig.parents[i]
+            local_rot = rig.rel_rot[i] @ quat_to_matrix(self.rotation_quaternion[:, i])
+            local_head = rig.rel_head[i] + (rig.rel_rot[i] @ self.location[:, i, :, None])[..., 0]
+            if p < 0:
+                self.rot[:, i] = local_rot
+                self.head[:, i] = local_head
+            else:
+                self.rot[:, i] = self.rot[:, p] @ local_rot
+                self.head[:, i] = self.head[:, p] + (self.rot[:, p] @ local_head[..., None])[..., 0]
+            self.valid[i] = True
+
+    def transform_basis(self, bone_name):
+        # bone_transform_basis: the anim basis without the bone's own rotation
+        i = self.rig.index[bone_name]
+        p = self.rig.parents[i]
+        if p < 0:
+            ret = np.broadcast_to(self.rig.rel_rot[i], self.location.shape[:1] + (3, 3))
+        else:
+            self.evaluate([self.rig.names[p]])
+            ret = self.rot[:, p] @ self.rig.rel_rot[i]
+        return axis_permutation @ ret
+
+    def anim_basis(self, bone_name):
+        self.evaluate([bone_name])
+        return axis_permutation @ self.rot[:, self.rig.index[bone_name]]
+
+    def bone_head(self, bone_name):
+        self.evaluate([bone_name])
+        return self.head[:, self.rig.index[bone_name]] @ axis_permutation.T
+
+def sample_frames(clip, fps, stride=1):
+    # Every stride-th frame and the last one
+    frames = solver.clip_frames(clip, fps)
+    return np.union1d(frames[::stride], frames[-1:])
+
+def convert(anm_fn, skeleton, m, bases, rig, fps=solver.anm_fps, stride=1):
+    # Returns the clip's kktracks.Tracks and the ops left out
+    clip = anm.read_anm(anm_fn)
+    frames = sample_frames(clip, fps, stride)
+    pose = solver.cm_pose(clip, skeleton, bases[m.cm_basis_arm], frames, fps)
+    writes, skipped = solver.solve_mapping(pose, KKPose(rig, len(frames)), bases[m.kk_basis_arm], m)
+    tracks = kktracks.Tracks(m.kk_arm, fps)
+    for (bone_name, data_path), values in writes.items():
+        tracks.add(bone_name, data_path, frames, values)
+    return tracks, skipped
+
+def stream(anm_fn, out_fn, skeleton, m, bases, rig, fps=solver.anm_fps, stride=1, chunk_size=solver.chunk_size):
+    # Same result as convert, but the clip is mapped instead of read and
+    # parsed, solved and written solver.chunk_size frames at a time. Each
+    # frame is solved from the rest pose, so chunks do not depend on each
+    # other. Returns the ops left out.
+    clip = anm.read_anm(anm_fn, use_mmap=True)
+    writer = kktracks.TrackWriter(out_fn, m.kk_arm, fps)
+    skipped = []
+    try:
+        for frames, pose in solver.iter_cm_pose(clip, skeleton, bases[m.cm_basis_arm], sample_frames(clip, fps, stride), fps, chunk_size):
+            writes, skipped = solver.solve_mapping(pose, KKPose(rig, len(frames)), bases[m.kk_basis_arm], m)
+            for (bone_name, data_path), values in writes.items():
+                writer.add(bone_name, data_path, frames, values)
+    except BaseException:
+        writer.discard()
+        raise
+    writer.close()
+    return skipped
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Convert .anm files to kktracks without Blender')
+    parser.add_argument('mapping')
+    parser.add_argument('inputs', nargs='+', help='Folders, globs or .anm files')
+    parser.add_argument('--model', required=True, help='CM body .model the clips are for')
+    parser.add_argument('--out', required=True)
+    parser.add_argument('--fps', type=float, default=solver.anm_fps)
+    parser.add_argument('--preview', action='store_true', help='Core bones on every --stride-th frame into <clip>.preview files')
+    parser.add_argument('--stride', type=int, default=4)
+    parser.add_argument('--reduce', action='store_true', help='Drop keys within --angle-tol and --loc-tol')
+    parser.add_argument('--angle-tol', type=float, default=0.05, help='Degrees')
+    parser.add_argument('--loc-tol', type=float, default=0.0005)
+    args = parser.parse_args(argv)
+    m = mapping.load(args.mapping)
+    if args.preview:
+        m = m.preview()
+    bases = tpose.load(m.tpose_basis)
+    fn = rig_fn(m.tpose_basis)
+    if not os.path.exists(fn):
+        raise RigError(f'{fn} is missing, run SaveTPoseBasis with {args.mapping} first')
+    rig = load(fn)
+    skeleton = anm.read_model_skeleton(args.model)
+    os.makedirs(args.out, exist_ok=True)
+    stride = args.stride if args.preview else 1
+    for anm_fn in batch.find_anms(args.inputs):
+        out_fn = batch.clip_output(args.out, anm_fn, tracks=True, preview=args.preview)
+        if args.reduce:
+            # Reduction looks at whole tracks
+            tracks, skipped = convert(anm_fn, skeleton, m, bases, rig, args.fps, stride)
+            kktracks.save(kktracks.reduce(tracks, radians(args.angle_tol), args.loc_tol), out_fn)
+        else:
+            skipped = stream(anm_fn, out_fn, skeleton, m, bases, rig, args.fps, stride)
+        if skipped:
+            # Same for every clip, a Blender pass has to do these
+            print(f'{anm_fn}: skipped {", ".join(f"{op.op} {op.kk}" for op in skipped)}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
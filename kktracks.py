@@ -0,0 +1,208 @@
+import os
+import shutil
+import tempfile
+import zipfile
+
+import numpy as np
+
+from kernel import slerp
+
+# KK animation tracks stored outside Blender
+#
+# One .npz per clip with a track per (bone, data_path): key frames and values
+# as float32 arrays, e.g. (n,) frames and (n, 4) rotation_quaternion values.
+# Downstream tools read it with NumPy alone.
+#
+#   tracks = kktracks.load('clip.anm.kk.npz')
+#   frames, values = tracks.tracks[('Hips', 'rotation_quaternion')]
+
+format_version = 1
+ext = '.kk.npz'
+
+class TrackFormatError(Exception):
+    pass
+
+class Tracks:
+    def __init__(self, arm_name, fps, tracks=None):
+        self.arm_name = arm_name
+        self.fps = fps
+        # (bone_name, data_path) -> (frames, values)
+        self.tracks = {} if tracks is None else tracks
+
+    def add(self, bone_name, data_path, frames, values):
+        frames = np.asarray(frames, dtype=np.float32)
+        values = np.asarray(values, dtype=np.float32).reshape(len(frames), -1)
+        self.tracks[(bone_name, data_path)] = (frames, values)
+
+    def frame_range(self):
+        starts = [f[0] for f, v in self.tracks.values() if len(f)]
+        ends = [f[-1] for f, v in self.tracks.values() if len(f)]
+        if not starts:
+            return (0, 0)
+        return (min(starts), max(ends))
+
+def from_keys(arm_name, fps, keys):
+    # keys: (bone_name, data_path) -> {frame: value tuple}, as recorded by bake mode
+    ret = Tracks(arm_name, fps)
+    for (bone_name, data_path), by_frame in keys.items():
+        frames = sorted(by_frame)
+        ret.add(bone_name, data_path, frames, [by_frame[f] for f in frames])
+    return ret
+
+def save(tracks, fn, compress=False):
+    arrays = {
+        'version': np.array(format_version),
+        'arm': np.array(tracks.arm_name),
+        'fps': np.array(tracks.fps, dtype=np.float64),
+        'bones': np.array([b for b, p in tracks.tracks]),
+        'paths': np.array([p for b, p in tracks.tracks]),
+    }
+    for i, (frames, values) in enumerate(tracks.tracks.values()):
+        arrays[f'{i}_frames'] = frames
+        arrays[f'{i}_values'] = values
+    # Written under a temp name so readers never see a half written file
+    tmp_fn = fn + '.tmp'
+    with open(tmp_fn, 'wb') as f:
+        (np.savez_compressed if compress else np.savez)(f, **arrays)
+    os.replace(tmp_fn, fn)
+    return fn
+
+class TrackWriter:
+    # Writes a tracks file chunk by chunk, so memory is bounded by the chunk
+    # and not the clip. Each track is spilled to raw files next to fn and
+    # close() copies them into an .npz that load() reads like any other.
+    def __init__(self, fn, arm_name, fps):
+        self.fn = fn
+        self.arm_name = arm_name
+        self.fps = fps
+        self.spill_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(fn)))
+        # (bone_name, data_path) -> [spill file index, keys written, values per key]
+        self.tracks = {}
+
+    def add(self, bone_name, data_path, frames, values):
+        # Appends after the keys already written to the track
+        frames = np.asarray(frames, dtype='<f4')
+        values = np.asarray(values, dtype='<f4').reshape(len(frames), -1)
+        key = (bone_name, data_path)
+        if key not in self.tracks:
+            self.tracks[key] = [len(self.tracks), 0, values.shape[1]]
+        t = self.tracks[key]
+        with open(os.path.join(self.spill_dir, f'{t[0]}_frames'), 'ab') as f:
+            f.write(frames.tobytes())
+        with open(os.path.join(self.spill_dir, f'{t[0]}_values'), 'ab') as f:
+            f.write(values.tobytes())
+        t[1] += len(frames)
+
+    def close(self):
+        arrays = {
+            'version': np.array(format_version),
+            'arm': np.array(self.arm_name),
+            'fps': np.array(self.fps, dtype=np.float64),
+            'bones': np.array([b for b, p in self.tracks]),
+            'paths': np.array([p for b, p in self.tracks]),
+        }
+        tmp_fn = self.fn + '.tmp'
+        with zipfile.ZipFile(tmp_fn, 'w', allowZip64=True) as z:
+            for name, a in arrays.items():
+                with z.open(name + '.npy', 'w') as f:
+                    np.lib.format.write_array(f, a)
+            for i, n, width in self.tracks.values():
+                for name, shape in ((f'{i}_frames', (n,)), (f'{i}_values', (n, width))):
+                    with z.open(name + '.npy', 'w', force_zip64=True) as f:
+                        np.lib.format.write_array_header_1_0(f, {'descr': '<f4', 'fortran_order': False, 'shape': shape})
+                        with open(os.path.join(self.spill_dir, name), 'rb') as src:
+                            shutil.copyfileobj(src, f)
+        os.replace(tmp_fn, self.fn)
+        self.discard()
+        return self.fn
+
+    def discard(self):
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+def load(fn):
+    with np.load(fn) as f:
+        if int(f['version']) > format_version:
+            raise TrackFormatError(f'{fn}: track format {int(f["version"])} is newer than {format_version}')
+        ret = Tracks(str(f['arm']), float(f['fps']))
+        for i, (bone_name, data_path) in enumerate(zip(f['bones'], f['paths'])):
+            ret.tracks[(str(bone_name), str(data_path))] = (f[f'{i}_frames'], f[f'{i}_values'])
+    return ret
+
+# Key reduction
+#
+# Drops keys that linear interpolation between the remaining ones reproduces
+# within a tolerance, radians for rotation_quaternion and distance otherwise.
+# Split points are picked Douglas-Peucker style, worst frame first.
+
+def interpolation_error(frames, values, i, j, quat):
+    s = ((frames[i + 1:j] - frames[i]) / (frames[j] - frames[i]))[:, None]
+    approx = values[i] + (values[j] - values[i]) * s
+    actual = values[i + 1:j]
+    if not quat:
+        return np.linalg.norm(approx - actual, axis=-1)
+    # Quaternion curves are evaluated per channel and normalized
+    approx = approx / np.linalg.norm(approx, axis=-1, keepdims=True)
+    dot = np.abs((approx * actual).sum(-1)) / np.linalg.norm(actual, axis=-1)
+    return 2 * np.arccos(np.clip(dot, 0, 1))
+
+def reduce_keys(frames, values, tol, quat=False, candidates=None):
+    # Returns a mask of the keys to keep. First and last keys always stay.
+    # With candidates only those frames may become keys, errors are still
+    # measured on every frame.
+    frames = np.asarray(frames, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    n = len(frames)
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, -1]] = True
+    if n <= 2:
+        return keep
+    allowed = np.ones(n, dtype=bool) if candidates is None else np.isin(frames, candidates)
+    stack = [(0, n - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j - i < 2:
+            continue
+        err = interpolation_error(frames, values, i, j, quat)
+        if err.max() <= tol:
+            continue
+        err = np.where(allowed[i + 1:j], err, -1)
+        k = i + 1 + int(np.argmax(err))
+        if err[k - i - 1] < 0:
+            continue
+        keep[k] = True
+        stack += [(i, k), (k, j)]
+    return keep
+
+def reduce(tracks, angle_tol, loc_tol, candidates=None):
+    ret = Tracks(tracks.arm_name, tracks.fps)
+    for (bone_name, data_path), (frames, values) in tracks.tracks.items():
+        quat = data_path == 'rotation_quaternion'
+        keep = reduce_keys(frames, values, angle_tol if quat else loc_tol, quat, candidates)
+        ret.tracks[(bone_name, data_path)] = (frames[keep], values[keep])
+    return ret
+
+# Resampling
+
+def resample(tracks, fps):
+    # Every track on all frames of another rate over the same time span.
+    # Keys may be spaced any way, e.g. after solving only source key frames.
+    # Rotations are interpolated by SLERP, everything else linearly.
+    ret = Tracks(tracks.arm_name, fps)
+    start, end = tracks.frame_range()
+    scale = fps / tracks.fps
+    frames = np.arange(np.ceil(start * scale - 1e-6) + 0.0, np.floor(end * scale + 1e-6) + 1)
+    # In frames of the old rate
+    at = frames / scale
+    for (bone_name, data_path), (key_frames, values) in tracks.tracks.items():
+        values = values.astype(np.float64)
+        if len(key_frames) == 1:
+            ret.add(bone_name, data_path, frames, np.repeat(values, len(frames), 0))
+            continue
+        i = np.clip(np.searchsorted(key_frames, at, side='right') - 1, 0, len(key_frames) - 2)
+        s = np.clip((at - key_frames[i]) / (key_frames[i + 1] - key_frames[i]), 0, 1)
+        if data_path == 'rotation_quaternion':
+            out = slerp(values[i], values[i + 1], s)
+        else:
+            out = values[i] + (values[i + 1] - values[i]) * s[:, None]
+        ret.add(bone_name, data_path, frames, out)
+    return ret
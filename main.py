@@ -1,29 +1,57 @@
 import bpy
-import json
 import re
 import os
+import sys
+
+import numpy as np
 
 from mathutils import *
 from math import *
 
-# Dirty stuff
+# Helper modules live next to the .blend
+if bpy.path.abspath('//') not in sys.path:
+    sys.path.append(bpy.path.abspath('//'))
 
-op_history = (None, None)
+import kernel
+import kkrig
+import kktracks
+import mapping
+import scene
+import tpose
+from batch import action_name, find_anms
+from converted import ConvertedIndex
+from jobs import JobQueue
+from profiling import Profiler
+from solver import fill_gaps
 
 # Configs
 
 scale_cm_to_kk = 0.2
+# DEBUG reports are only formatted when this is on
+debug_log = False
+# Traces go to this folder next to the .blend when TransferAnimation.profile is set
+profile_dir = 'profiles'
+# Key reduction in bake mode, see kktracks.reduce
+key_angle_tol = radians(0.05)
+key_loc_tol = 0.0005
+# Only frames where the CM action has keys may stay keyed after reduction
+key_source_frames_only = False
+# With source_frames, frames between solved ones are interpolated by the
+# action, but never more than this many in a row
+max_key_gap = 8
+# Preview mode solves ops the mapping does not mark detail on every
+# preview_stride-th frame, into '<clip>.preview' actions the full pass removes.
+# The default of the operators' stride
+preview_stride = 4
 
-# Functions for serialization to JSON
+# Current clip's profiler, replaced by TransferAnimation for each clip
+profiler = Profiler(enabled=False)
 
-def matrix_to_python_list(mat):
-    return [
-        [mat[x][y] for y in range(3)]
-        for x in range(3)
-    ]
-    
-def vector_to_python_list(mat):
-    return list(mat)
+def debug(self, fmt, *args):
+    # Lazy DEBUG report, callables in args are called only when logging is on
+    if not debug_log:
+        return
+    self.report({'DEBUG'}, fmt.format(*(a() if callable(a) else a for a in args)))
 
 # Utility functions
 
@@ -42,146 +70,616 @@ def deformed(C, ob):
     ob = ob.evaluated_get(dg)
     return ob
 
-def deformed_bone(C, arm_name, bone_name):
-    return deformed(C, C.scene.objects[arm_name]).pose.bones[bone_name]
+class CachedBone:
+    # Read-only copy of the evaluated pose bone attributes used by the transfer
+    def __init__(self, snap, i):
+        self.head = Vector(snap['head'][i])
+        self.tail = Vector(snap['tail'][i])
+        self.x_axis = Vector(snap['x_axis'][i])
+        self.y_axis = Vector(snap['y_axis'][i])
+        self.z_axis = Vector(snap['z_axis'][i])
+        self.rotation_quaternion = Quaternion(snap['rotation_quaternion'][i])
 
-def bone(C, arm_name, bone_name):
-    return C.scene.objects[arm_name].pose.bones[bone_name]
+class EvalCache:
+    # Evaluated pose bones of each armature, fetched once per frame in bulk
+    # An armature's snapshot is dropped when one of its bones is written
+    snapshot_attrs = {
+        'head': 3,
+        'tail': 3,
+        'x_axis': 3,
+        'y_axis': 3,
+        'z_axis': 3,
+        'rotation_quaternion': 4,
+    }
+    
+    def __init__(self):
+        self.frame = None
+        self.snapshots = {}
+        self.bones = {}
+        self.index = {}
+        
+    def invalidate(self, arm_name):
+        self.snapshots.pop(arm_name, None)
+        self.bones.pop(arm_name, None)
+        
+    def snapshot(self, C, arm_name):
+        # With subframes, see transfer_clips
+        if C.scene.frame_current_final != self.frame:
+            self.frame = C.scene.frame_current_final
+            self.snapshots = {}
+            self.bones = {}
+        if arm_name in self.snapshots:
+            return self.snapshots[arm_name]
+        profiler.count('depsgraph evaluations')
+        with profiler.stage('depsgraph', arm=arm_name):
+            pose_bones = deformed(C, C.scene.objects[arm_name]).pose.bones
+            if arm_name not in self.index:
+                self.index[arm_name] = {pb.name: i for i, pb in enumerate(pose_bones)}
+            n = len(pose_bones)
+            snap = {}
+            for attr, size in self.snapshot_attrs.items():
+                arr = np.empty(n * size, dtype=np.float32)
+                pose_bones.foreach_get(attr, arr)
+                snap[attr] = arr.reshape(n, size)
+        self.snapshots[arm_name] = snap
+        self.bones[arm_name] = {}
+        return snap
+    
+    def bone(self, C, arm_name, i):
+        # i is the bone's index in pose.bones, see Rig
+        snap = self.snapshot(C, arm_name)
+        bones = self.bones[arm_name]
+        if i not in bones:
+            bones[i] = CachedBone(snap, i)
+        return bones[i]
 
-def bone_anim_vec_attr(self, C, arm_name, bone_name, vec_attr):
-    ret = deformed_bone(C, arm_name, bone_name)
+class Rig:
+    # An armature resolved once per clip. Bones are referred to by their
+    # index in pose.bones, the same index snapshots use, and pose bones are
+    # held directly so the frame loop looks nothing up by name.
+    __slots__ = ('name', 'ob', 'is_kk', 'names', 'index', 'pose_bones')
+
+    def __init__(self, ob, is_kk):
+        self.name = ob.name
+        self.ob = ob
+        self.is_kk = is_kk
+        self.pose_bones = list(ob.pose.bones)
+        self.names = [pb.name for pb in self.pose_bones]
+        self.index = {n: i for i, n in enumerate(self.names)}
+
+class BoundOp:
+    # A mapping.Op resolved against a Rig pair: bone indices, the KK pose
+    # bone it writes, T-pose matrices it reads and where its baked keys go
+    __slots__ = ('op', 'kk_name', 'kk', 'cm', 'cm_from', 'pb', 'data_path', 'lerp', 'roll', 'value',
+        'cm_tpose', 'cm_tpose_inv', 'kk_tpose', 'keys')
+
+def cached_bone(self, C, rig, b):
+    return self.eval_cache.bone(C, rig.name, b)
+
+def bone_anim_vec_attr(self, C, rig, b, vec_attr):
+    ret = cached_bone(self, C, rig, b)
     ret = getattr(ret, vec_attr)
-    if arm_name == self.cm_arm:
-        return ret * scale_cm_to_kk
-    if arm_name == self.kk_arm:
+    if rig.is_kk:
         # Permute axes
         return Vector((ret[0], -ret[2], ret[1])) 
+    return ret * scale_cm_to_kk
 
-def bone_anim_head(self, C, arm_name, bone_name):
-    return bone_anim_vec_attr(self, C, arm_name, bone_name, 'head')
+def bone_anim_head(self, C, rig, b):
+    return bone_anim_vec_attr(self, C, rig, b, 'head')
     
-def bone_anim_tail(self, C, arm_name, bone_name):
-    return bone_anim_vec_attr(self, C, arm_name, bone_name, 'tail')
+def bone_anim_tail(self, C, rig, b):
+    return bone_anim_vec_attr(self, C, rig, b, 'tail')
 
-def bone_anim_basis(self, C, arm_name, bone_name):
+def bone_anim_basis(self, C, rig, b):
     # Get basis vectors of the bone in global frame
-    ret = get_basis_matrix(deformed_bone(C, arm_name, bone_name))
-    if arm_name == self.kk_arm:
+    ret = get_basis_matrix(cached_bone(self, C, rig, b))
+    if rig.is_kk:
         ret = Matrix(((ret[0][0], ret[0][1], ret[0][2]),
         (-ret[2][0], -ret[2][1], -ret[2][2]),
         (ret[1][0], ret[1][1], ret[1][2])))
     return ret
 
-def bone_transform_basis(self, C, arm_name, bone_name):
+def bone_transform_basis(self, C, rig, b):
     # == bone_anim_basis when no rotation is applied on object
-    return bone_anim_basis(self, C, arm_name, bone_name) @ deformed_bone(C, arm_name, bone_name).rotation_quaternion.inverted().to_matrix()
+    return bone_anim_basis(self, C, rig, b) @ cached_bone(self, C, rig, b).rotation_quaternion.inverted().to_matrix()
+
+# Batched versions for many bones at once, as float64 arrays. idx are
+# indices in pose.bones
+
+def bone_anim_bases(self, C, arm_name, idx):
+    snap = self.eval_cache.snapshot(C, arm_name)
+    ret = np.stack([snap['x_axis'][idx], snap['y_axis'][idx], snap['z_axis'][idx]], axis=-1).astype(np.float64)
+    if arm_name == self.kk_arm:
+        ret = kk_axis_permutation @ ret
+    return ret
+
+def bone_transform_bases(self, C, arm_name, idx):
+    snap = self.eval_cache.snapshot(C, arm_name)
+    return kernel.transform_basis(bone_anim_bases(self, C, arm_name, idx), snap['rotation_quaternion'][idx].astype(np.float64))
+
+kk_axis_permutation = kkrig.axis_permutation
 
-def bone_set_loc(self, C, arm_name, bone_name, global_movement_vec):
+def bone_tpose_bases(self, C, arm_name, bone_names=None):
+    # Current pose of the armature as a tpose.TPoseBasis, read in one bulk pass
+    snap = self.eval_cache.snapshot(C, arm_name)
+    index = self.eval_cache.index[arm_name]
+    names = list(index) if bone_names is None else [n for n in index if n in set(bone_names)]
+    idx = [index[n] for n in names]
+    head = snap['head'][idx].astype(np.float64)
+    tail = snap['tail'][idx].astype(np.float64)
+    # Same as bone_anim_vec_attr
+    if arm_name == self.cm_arm:
+        head, tail = head * scale_cm_to_kk, tail * scale_cm_to_kk
+    if arm_name == self.kk_arm:
+        head, tail = head @ kk_axis_permutation.T, tail @ kk_axis_permutation.T
+    return tpose.TPoseBasis(names, bone_anim_bases(self, C, arm_name, idx), head, tail)
+
+def constraint_subtargets(ob, con):
+    # Bones of ob a constraint reads
+    ret = []
+    if getattr(con, 'target', None) == ob and getattr(con, 'subtarget', ''):
+        ret.append(con.subtarget)
+    if getattr(con, 'pole_target', None) == ob and getattr(con, 'pole_subtarget', ''):
+        ret.append(con.pole_subtarget)
+    for t in getattr(con, 'targets', ()):
+        if t.target == ob and t.subtarget:
+            ret.append(t.subtarget)
+    return ret
+
+def driver_subtargets(ob, fc):
+    # Bones of ob the variables of a driver read
+    ret = []
+    for var in fc.driver.variables:
+        for t in var.targets:
+            if t.id != ob:
+                continue
+            if t.bone_target:
+                ret.append(t.bone_target)
+            m = re.match(r'pose\.bones\["(.+?)"\]', t.data_path)
+            if m:
+                ret.append(m.group(1))
+    return ret
+
+def bone_dependencies(ob):
+    # Bone name -> all other bones whose pose can move it: parents,
+    # constraint targets, targets of IK chains it is part of, and bones
+    # the drivers on it read
+    direct = {pb.name: set() for pb in ob.pose.bones}
+    for pb in ob.pose.bones:
+        if pb.parent is not None:
+            direct[pb.name].add(pb.parent.name)
+        for con in pb.constraints:
+            targets = constraint_subtargets(ob, con)
+            chain = [pb]
+            if con.type == 'IK':
+                p = pb.parent
+                while p is not None and (con.chain_count == 0 or len(chain) < con.chain_count):
+                    chain.append(p)
+                    p = p.parent
+            for b in chain:
+                direct[b.name].update(targets)
+    if ob.animation_data is not None:
+        for fc in ob.animation_data.drivers:
+            m = re.match(r'pose\.bones\["(.+?)"\]', fc.data_path)
+            if m and m.group(1) in direct:
+                direct[m.group(1)].update(b for b in driver_subtargets(ob, fc) if b in direct)
+    ret = {}
+    def visit(name):
+        if name in ret:
+            return ret[name]
+        ret[name] = set() # Guards against cycles
+        deps = set()
+        for d in direct[name]:
+            deps.add(d)
+            deps |= visit(d)
+        deps.discard(name)
+        ret[name] = deps
+        return deps
+    for name in direct:
+        visit(name)
+    return ret
+
+def kk_rig(ob):
+    # Rest hierarchy for kkrig. A bone is exact when nothing but its parents
+    # moves it: no constraints, not in an IK chain, not driven, and its
+    # parent is exact.
+    moved = set()
+    for pb in ob.pose.bones:
+        for con in pb.constraints:
+            moved.add(pb.name)
+            if con.type == 'IK':
+                p = pb.parent
+                n = 1
+                while p is not None and (con.chain_count == 0 or n < con.chain_count):
+                    moved.add(p.name)
+                    p = p.parent
+                    n += 1
+        if not pb.bone.use_inherit_rotation or pb.bone.inherit_scale != 'FULL':
+            moved.add(pb.name)
+    if ob.animation_data is not None:
+        for fc in ob.animation_data.drivers:
+            m = re.match(r'pose\.bones\["(.+?)"\]', fc.data_path)
+            if m:
+                moved.add(m.group(1))
+    bones = list(ob.data.bones)
+    index = {b.name: i for i, b in enumerate(bones)}
+    parents = [-1 if b.parent is None else index[b.parent.name] for b in bones]
+    exact = []
+    # data.bones lists parents before children
+    for b, p in zip(bones, parents):
+        exact.append(b.name not in moved and (p < 0 or exact[p]))
+    rest_rot = np.array([b.matrix_local.to_3x3() for b in bones], dtype=np.float64).reshape(-1, 3, 3)
+    rest_head = np.array([b.head_local for b in bones], dtype=np.float64).reshape(-1, 3)
+    return kkrig.KKRig([b.name for b in bones], parents, rest_rot, rest_head, exact)
+
+# Level schedules per (kk_arm, mapping file). The rig does not change between clips
+schedules = {}
+
+def tpose_matrix(self, arm_name, bone_name, attr='basis'):
+    # attr is 'basis' or 'inv_basis', arm_name the name in the basis file.
+    # Matrices are built once per process
+    store = self.tpose_basis[arm_name]
+    key = (bone_name, attr)
+    if key not in store.memo:
+        store.memo[key] = Matrix(getattr(store, attr)[store.index[bone_name]].tolist())
+    return store.memo[key]
+
+def source_key_frames(C, arm_name):
+    # Frames keyed on any channel of the armature's action
+    act = C.scene.objects[arm_name].animation_data.action
+    frames = set()
+    for fc in act.fcurves:
+        co = np.empty(len(fc.keyframe_points) * 2, dtype=np.float32)
+        fc.keyframe_points.foreach_get('co', co)
+        frames.update(np.round(co[::2]).tolist())
+    return np.array(sorted(frames))
+
+def solve_frames(C, arm_name, frame_start, frame_end):
+    # Source key frames in range, both ends included, gaps filled up to max_key_gap
+    frames = source_key_frames(C, arm_name)
+    frames = frames[(frames >= frame_start) & (frames <= frame_end)]
+    return fill_gaps(np.append(frames, [frame_start, frame_end]), max_key_gap).tolist()
+
+def bone_keyframe(self, C, rig, op):
+    # Every write goes through here
+    self.eval_cache.invalidate(rig.name)
+    if not self.bake:
+        with profiler.stage('keyframe'):
+            # Actions play at the scene rate, key_frame may be in another
+            op.pb.keyframe_insert(op.data_path, frame=self.key_frame * C.scene.render.fps / self.key_fps)
+        return
+    # Recorded here and written in bulk after the last frame
+    # A later write in the same frame replaces the earlier one like keyframe_insert does
+    op.keys[self.key_frame] = tuple(getattr(op.pb, op.data_path))
+
+# Writes are (BoundOp, value) pairs
+
+def bone_loc_write(self, C, rig, op, global_movement_vec):
     # Location basis is self but with zero rotation
-    btb = bone_transform_basis(self, C, arm_name, bone_name)
-    C.scene.objects[arm_name].pose.bones[bone_name].location += btb.inverted() @ global_movement_vec 
-    C.scene.objects[arm_name].pose.bones[bone_name].keyframe_insert('location')
+    btb = bone_transform_basis(self, C, rig, op.kk)
+    return (op, op.pb.location + btb.inverted() @ global_movement_vec)
     
-def bone_set_rot(self, C, arm_name, bone_name, global_rotate_mat):
+def bone_rot_write(self, C, rig, op, global_rotate_mat):
     # Location basis is self but with zero rotation
-    btb = bone_transform_basis(self, C, arm_name, bone_name)
+    btb = bone_transform_basis(self, C, rig, op.kk)
     rot_local = btb.inverted() @ global_rotate_mat @ btb
-    rot_local = rot_local.to_quaternion()
-    C.scene.objects[arm_name].pose.bones[bone_name].rotation_quaternion = rot_local
-    C.scene.objects[arm_name].pose.bones[bone_name].keyframe_insert('rotation_quaternion')
-    
-class TransferPoseCommon(bpy.types.Operator):
-    cm_arm: bpy.props.StringProperty()
-    kk_arm: bpy.props.StringProperty()
-    json_fn: bpy.props.StringProperty()
+    return (op, rot_local.to_quaternion())
+
+def bone_write(self, C, rig, write):
+    op, value = write
+    setattr(op.pb, op.data_path, value)
+    bone_keyframe(self, C, rig, op)
+
+# Ops solved together per level with the NumPy kernel instead of per bone
+batched_ops = ('orientation', 'fk_roll')
+
+class PoseTransfer:
+    # Transfer of one armature pair. Mixed into TransferPoseCommon and
+    # ClipTransfer, one of which transfer_clips makes per clip.
+    # Needs eval_cache, bake and report, setup() does the rest.
 
     def load_tpose_basis(self,context, event):
         # Load T-Pose basis for armatures from external files
-        with open(bpy.path.abspath('//') + self.json_fn) as jf:
-            self.tpose_basis = json.loads(jf.read())
+        # Parsed once per process, a compiled .npz next to the json is used if present
+        with profiler.stage('load_basis'):
+            self.tpose_basis = tpose.load(self.json_fn)
             
     def check_transform_basis(self, C, event):
-        arm_name = self.kk_arm
-        bone_name = C.selected_pose_bones[0].name
-        self.report({'INFO'}, f'Bone basis: {bone_anim_basis(self, C, arm_name, bone_name)}')
-        btb = bone_transform_basis(self, C, arm_name, bone_name)
+        b = self.kk.index[C.selected_pose_bones[0].name]
+        self.report({'INFO'}, f'Bone basis: {bone_anim_basis(self, C, self.kk, b)}')
+        btb = bone_transform_basis(self, C, self.kk, b)
         self.report({'INFO'}, f'BTB: {btb}')
+    
+    # The transfer_* and match_* methods only read. They take a BoundOp and
+    # return a write (op, value) that transfer_level applies.
             
-    def transfer_location(self, cm_bone_name, kk_bone_name, lerp_amount=0):  
+    def transfer_location(self, op):  
         context = self.context      
-        cm_bone_loc = bone_anim_head(self, context, self.cm_arm, cm_bone_name).lerp(bone_anim_tail(self, context, self.cm_arm, cm_bone_name), lerp_amount)
-        self.report({'DEBUG'}, f'CM bone location: {cm_bone_loc}')
-        kk_bone_loc = bone_anim_head(self, context, self.kk_arm, kk_bone_name)
-        self.report({'DEBUG'}, f'KK bone location: {kk_bone_loc}')
-        btb = bone_transform_basis(self, context, self.kk_arm, kk_bone_name)
-        self.report({'DEBUG'}, f'BTB: {btb}')
+        cm_bone_loc = bone_anim_head(self, context, self.cm, op.cm).lerp(bone_anim_tail(self, context, self.cm, op.cm), op.lerp)
+        debug(self, 'CM bone location: {}', cm_bone_loc)
+        kk_bone_loc = bone_anim_head(self, context, self.kk, op.kk)
+        debug(self, 'KK bone location: {}', kk_bone_loc)
         # location update does not change btb
         # movement in btb = btb^-1 @ movement in global
         # movement in global = btb @ movement in btb
-        bone_set_loc(self, context, self.kk_arm, kk_bone_name, cm_bone_loc - kk_bone_loc)
+        return bone_loc_write(self, context, self.kk, op, cm_bone_loc - kk_bone_loc)
         
-    def transfer_rotation(self, cm_bone_name, kk_bone_name, add_local_rotation=None):
+    def transfer_rotation(self, op, add_local_rotation=None):
         context = self.context
-        t_pose_rot_global = Matrix(self.tpose_basis[self.cm_arm][cm_bone_name]['basis'])
-        self.report({'DEBUG'}, f'CM T-pose rotation: {t_pose_rot_global}')
-        cur_rot_global = bone_anim_basis(self, context, self.cm_arm, cm_bone_name)
-        self.report({'DEBUG'}, f'CM pose rotation: {cur_rot_global}')
-        kk_t_pose_rot_global = Matrix(self.tpose_basis[self.kk_arm][kk_bone_name]['basis'])
-        self.report({'DEBUG'}, f'KK T-pose rotation: {kk_t_pose_rot_global}')
+        t_pose_rot_global_inv = op.cm_tpose_inv
+        debug(self, 'CM T-pose rotation inverse: {}', t_pose_rot_global_inv)
+        cur_rot_global = bone_anim_basis(self, context, self.cm, op.cm)
+        debug(self, 'CM pose rotation: {}', cur_rot_global)
+        kk_t_pose_rot_global = op.kk_tpose
+        debug(self, 'KK T-pose rotation: {}', kk_t_pose_rot_global)
         # [cur_rot_global] = [T] [t_pose_rot_global]
         # [T] = [cur_rot_global] [t_pose_rot_global]^-1
         # [kk_rot_global] = [T] [kk_t_pose_rot_global]
         # [kk_rot_global] = [cur_rot_global] [t_pose_rot_global]^-1 [kk_t_pose_rot_global]
-        kk_rot_global = cur_rot_global @ t_pose_rot_global.inverted() @ kk_t_pose_rot_global
+        kk_rot_global = cur_rot_global @ t_pose_rot_global_inv @ kk_t_pose_rot_global
         
-        self.report({'DEBUG'}, f'KK pose rotation: {kk_rot_global}')
-        bone_set_rot(self, context, self.kk_arm, kk_bone_name, kk_rot_global)
+        debug(self, 'KK pose rotation: {}', kk_rot_global)
+        write = bone_rot_write(self, context, self.kk, op, kk_rot_global)
         if add_local_rotation is None:
-            return
-        rq = deformed_bone(bpy.context, self.kk_arm, kk_bone_name).rotation_quaternion
-        rq = rq @ add_local_rotation.to_quaternion()
-        bone(context, self.kk_arm, kk_bone_name).rotation_quaternion = rq
-        context.scene.objects[self.kk_arm].pose.bones[kk_bone_name].keyframe_insert('rotation_quaternion')
-    
-    def match_orientation(self, cm_bone_name, kk_bone_name, extra_roll=0):
-        # Rotates kk_bone_name such that they have the same basis
+            return write
+        return (op, write[1] @ add_local_rotation.to_quaternion())
+    
+    def match_orientation(self, op):
+        # Rotates the KK bone such that they have the same basis
         context = self.context
-        cur_rot_global = bone_anim_basis(self, context, self.cm_arm, cm_bone_name)
-        kk_btb = bone_transform_basis(self, context, self.kk_arm, kk_bone_name)
+        cur_rot_global = bone_anim_basis(self, context, self.cm, op.cm)
+        kk_btb = bone_transform_basis(self, context, self.kk, op.kk)
         rq = (kk_btb.inverted() @ cur_rot_global)
         rq = rq.to_euler('YXZ')
-        rq.y += extra_roll
+        rq.y += op.roll or 0
         rq = rq.to_quaternion()
-        self.report({'DEBUG'}, f'rq: {rq}')
-        context.scene.objects[self.kk_arm].pose.bones[kk_bone_name].rotation_quaternion = rq
-        context.scene.objects[self.kk_arm].pose.bones[kk_bone_name].keyframe_insert('rotation_quaternion')
+        debug(self, 'rq: {}', rq)
+        return (op, rq)
     
-    def match_leg_fk_roll(self, cm_bone_name, kk_bone_name, override_roll=None):
+    def match_leg_fk_roll(self, op):
         context = self.context
         # Match absolute orientation but use relative bone roll
-        t_pose_rot_global = Matrix(self.tpose_basis[self.cm_arm][cm_bone_name]['basis'])
-        self.report({'INFO'}, f'CM T-pose rotation: {t_pose_rot_global}')
-        cur_rot_global = bone_anim_basis(self, context, self.cm_arm, cm_bone_name)
-        self.report({'INFO'}, f'CM pose rotation: {cur_rot_global}')
+        t_pose_rot_global = op.cm_tpose
+        debug(self, 'CM T-pose rotation: {}', t_pose_rot_global)
+        cur_rot_global = bone_anim_basis(self, context, self.cm, op.cm)
+        debug(self, 'CM pose rotation: {}', cur_rot_global)
         # B_C = B_T @ A
         # A = B_T^-1 @ B_C        
-        kk_btb = bone_transform_basis(self, context, self.kk_arm, kk_bone_name)
-        self.report({'INFO'}, f'KK BTB: {kk_btb}')
+        kk_btb = bone_transform_basis(self, context, self.kk, op.kk)
+        debug(self, 'KK BTB: {}', kk_btb)
         kk_rot = (kk_btb.inverted() @ cur_rot_global).to_euler('YXZ')
-        if override_roll is not None:
-            kk_rot.y = override_roll
-        self.report({'INFO'}, f'Roll amount check: {kk_btb @ kk_rot.to_matrix()}')
-        #bone_set_rot(self, context, self.kk_arm, kk_bone_name, kk_rot.to_matrix())
-        context.scene.objects[self.kk_arm].pose.bones[kk_bone_name].rotation_quaternion = kk_rot.to_quaternion()
-        context.scene.objects[self.kk_arm].pose.bones[kk_bone_name].keyframe_insert('rotation_quaternion')
+        if op.roll is not None:
+            kk_rot.y = op.roll
+        debug(self, 'Roll amount check: {}', lambda: kk_btb @ kk_rot.to_matrix())
+        return (op, kk_rot.to_quaternion())
+    
+    def transfer_pole(self, op):
+        # Push an IK target away from the joint so the chain bends the same way
+        context = self.context
+        vec_a = cached_bone(self, context, self.cm, op.cm_from).y_axis
+        vec_b = cached_bone(self, context, self.cm, op.cm).y_axis
+        away_vec = (vec_a - vec_b).normalized()
+        debug(self, '{} {} {}', vec_a, vec_b, away_vec)
+        return bone_loc_write(self, context, self.kk, op, away_vec)
+    
+    def solve_orientations(self, batch):
+        # match_orientation and match_leg_fk_roll for a whole level in one kernel call
+        context = self.context
+        op_name, ops, cm_idx, kk_idx, rolls = batch
+        cur_rot_global = bone_anim_bases(self, context, self.cm_arm, cm_idx)
+        kk_btb = bone_transform_bases(self, context, self.kk_arm, kk_idx)
+        if op_name == 'orientation':
+            rq = kernel.match_orientation(kk_btb, cur_rot_global, rolls)
+        else:
+            # Rolls are overridden per op, NaN keeps the solved one
+            rq = kernel.match_leg_fk_roll(kk_btb, cur_rot_global, rolls)
+        debug(self, 'rq: {}', rq)
+        return [(op, Quaternion(q)) for op, q in zip(ops, rq)]
+    
+    def transfer_ik_target(self, op):
+        # transfer_location then transfer_pole, from one read. The location
+        # write leaves btb as it is, so the two movements just add up.
+        context = self.context
+        cm_bone_loc = bone_anim_head(self, context, self.cm, op.cm).lerp(bone_anim_tail(self, context, self.cm, op.cm), op.lerp)
+        kk_bone_loc = bone_anim_head(self, context, self.kk, op.kk)
+        vec_a = cached_bone(self, context, self.cm, op.cm_from).y_axis
+        vec_b = cached_bone(self, context, self.cm, op.cm).y_axis
+        away_vec = (vec_a - vec_b).normalized()
+        debug(self, 'IK target: {} away: {}', cm_bone_loc, away_vec)
+        return bone_loc_write(self, context, self.kk, op, cm_bone_loc - kk_bone_loc + away_vec)
+    
+    def solve_op(self, op):
+        if op.op == 'location':
+            return self.transfer_location(op)
+        if op.op == 'rotation':
+            return self.transfer_rotation(op)
+        if op.op == 'orientation':
+            return self.match_orientation(op)
+        if op.op == 'fk_roll':
+            return self.match_leg_fk_roll(op)
+        if op.op == 'pole':
+            return self.transfer_pole(op)
+        if op.op == 'ik_target':
+            return self.transfer_ik_target(op)
+        raise mapping.MappingError(f'Cannot solve op {op.op!r}')
+    
+    def transfer_level(self, context, level):
+        # Switches first, then all reads, then all writes
+        # so a level costs one depsgraph evaluation
+        switches, ops, batches = level
+        for op in switches:
+            op.pb['IK_FK'] = op.value
+        if switches:
+            self.eval_cache.invalidate(self.kk_arm)
+        writes = []
+        for op in ops:
+            with profiler.stage(op.op, kk=op.kk_name):
+                writes.append(self.solve_op(op))
+        for batch in batches:
+            with profiler.stage(batch[0], n=len(batch[1])):
+                writes.extend(self.solve_orientations(batch))
+        with profiler.stage('write'):
+            for write in writes:
+                bone_write(self, context, self.kk, write)
+    
+    def transfer_mapped(self, context, event):
+        for level in self.levels:
+            self.transfer_level(context, level)
+            yield
     
     def reset_kk_arm(self, context, event):
-        for pb in context.scene.objects[self.kk_arm].pose.bones:
-            pb.location = Vector((0,0,0))
-            pb.rotation_quaternion = Quaternion()
+        pose_bones = self.kk.ob.pose.bones
+        n = len(self.kk.pose_bones)
+        pose_bones.foreach_set('location', np.zeros(n * 3, dtype=np.float32))
+        pose_bones.foreach_set('rotation_quaternion', np.tile(np.array((1, 0, 0, 0), dtype=np.float32), n))
+        self.eval_cache.invalidate(self.kk_arm)
+    
+    def bind_op(self, op):
+        ret = BoundOp()
+        ret.op = op.op
+        ret.kk_name = op.kk
+        ret.kk = self.kk.index[op.kk]
+        ret.cm = -1 if op.cm is None else self.cm.index[op.cm]
+        ret.cm_from = -1 if op.cm_from is None else self.cm.index[op.cm_from]
+        ret.pb = self.kk.pose_bones[ret.kk]
+        ret.data_path = mapping.write_paths.get(op.op)
+        ret.lerp = op.lerp
+        ret.roll = op.roll
+        ret.value = op.value
+        ret.cm_tpose = ret.cm_tpose_inv = ret.kk_tpose = None
+        if op.op in ('rotation', 'fk_roll'):
+            ret.cm_tpose = tpose_matrix(self, self.mapping.cm_basis_arm, op.cm)
+            ret.cm_tpose_inv = tpose_matrix(self, self.mapping.cm_basis_arm, op.cm, 'inv_basis')
+        if op.op == 'rotation':
+            ret.kk_tpose = tpose_matrix(self, self.mapping.kk_basis_arm, op.kk)
+        # Ops writing the same channel share one key dict, later writes win
+        ret.keys = None if ret.data_path is None else self.baked_keys.setdefault((op.kk, ret.data_path), {})
+        return ret
+    
+    def bind_level(self, ops):
+        # (ik_fk switches, ops solved one by one, batches for solve_orientations)
+        bound = [self.bind_op(op) for op in ops]
+        switches = [op for op in bound if op.op == 'ik_fk']
+        singles = [op for op in bound if op.op != 'ik_fk' and op.op not in batched_ops]
+        batches = []
+        for op_name in batched_ops:
+            batch = [op for op in bound if op.op == op_name]
+            if not batch:
+                continue
+            if op_name == 'orientation':
+                rolls = np.array([op.roll or 0 for op in batch])
+            else:
+                rolls = np.array([np.nan if op.roll is None else op.roll for op in batch])
+            batches.append((op_name, batch,
+                np.array([op.cm for op in batch]), np.array([op.kk for op in batch]), rolls))
+        return (switches, singles, batches)
+    
+    def setup(self, context, m, mapping_fn, preview=False):
+        self.context = context
+        self.mapping = m
+        self.cm_arm = m.cm_arm
+        self.kk_arm = m.kk_arm
+        self.json_fn = m.tpose_basis
+        key = (self.kk_arm, mapping_fn, preview)
+        if key not in schedules:
+            deps = bone_dependencies(context.scene.objects[self.kk_arm])
+            schedules[key] = m.schedule(deps)
+            self.report({'INFO'}, f'{len(schedules[key])} evaluations per frame')
+        # Names are resolved here once per clip, the frame loop uses indices
+        self.load_tpose_basis(context, None)
+        self.cm = Rig(context.scene.objects[self.cm_arm], False)
+        self.kk = Rig(context.scene.objects[self.kk_arm], True)
+        self.baked_keys = {}
+        self.levels = [self.bind_level(ops) for ops in schedules[key]]
+        # Keys go on key_frame, in frames of key_fps. transfer_clips changes
+        # both when it solves on the frames of another rate.
+        self.key_frame = context.scene.frame_current
+        self.key_fps = context.scene.render.fps
+        # Suppose an animation is loaded on cm_arm
+        self.op_stack = [
+            self.reset_kk_arm,
+#            self.check_transform_basis,
+            self.transfer_mapped,
+        ]
+    
+    def bake_frame(self, context, key_frame):
+        # Current frame, all steps at once
+        self.key_frame = key_frame
+        for fun in self.op_stack:
+            ret = fun(context, None)
+            if ret is not None:
+                # Reads after a yield get a fresh depsgraph anyway
+                for _ in ret:
+                    pass
+    
+    def write_baked(self, context, tracks_fn='', reduce_keys=False, fps=0, angle_tol=None, loc_tol=None, source_frames_only=None):
+        # Reduction settings not given come from the configs
+        tracks = kktracks.from_keys(self.kk_arm, self.key_fps, {k: v for k, v in self.baked_keys.items() if v})
+        # Cleared in place, bound ops hold on to these dicts
+        for keys in self.baked_keys.values():
+            keys.clear()
+        if fps and fps != tracks.fps:
+            with profiler.stage('resample'):
+                tracks = kktracks.resample(tracks, fps)
+        if reduce_keys:
+            with profiler.stage('reduce_keys'):
+                if source_frames_only is None:
+                    source_frames_only = key_source_frames_only
+                candidates = None
+                if source_frames_only:
+                    # Source keys are scene frames, tracks may be at another rate
+                    candidates = np.unique(np.round(source_key_frames(context, self.cm_arm) * tracks.fps / context.scene.render.fps))
+                tracks = kktracks.reduce(tracks, key_angle_tol if angle_tol is None else angle_tol,
+                    key_loc_tol if loc_tol is None else loc_tol, candidates)
+        with profiler.stage('write_keys'):
+            if tracks_fn:
+                kktracks.save(tracks, tracks_fn)
+            else:
+                self.write_baked_keys(context, tracks, reduce_keys)
+        
+    def write_baked_keys(self, context, tracks, linear=False):
+        ob = context.scene.objects[self.kk_arm]
+        if ob.animation_data is None:
+            ob.animation_data_create()
+        act = ob.animation_data.action
+        if act is None:
+            act = bpy.data.actions.new(self.kk_arm)
+            ob.animation_data.action = act
+        # Actions play at the scene rate, keys of another rate are placed at
+        # the same time in scene frames
+        scale = context.scene.render.fps / tracks.fps
+        for (bone_name, data_path), (frames, values) in tracks.tracks.items():
+            frames = frames * scale
+            fc_path = f'pose.bones["{bone_name}"].{data_path}'
+            for i in range(values.shape[1]):
+                fc = act.fcurves.find(fc_path, index=i)
+                if fc is not None:
+                    act.fcurves.remove(fc)
+                fc = act.fcurves.new(fc_path, index=i, action_group=bone_name)
+                fc.keyframe_points.add(len(frames))
+                fc.keyframe_points.foreach_set('co', np.stack([frames, values[:, i]], -1).ravel())
+                if linear:
+                    # Tolerances hold for linear interpolation only
+                    for kp in fc.keyframe_points:
+                        kp.interpolation = 'LINEAR'
+                fc.update()
+
+class TransferPoseCommon(PoseTransfer, bpy.types.Operator):
+    # Bone mapping file next to the .blend, see mapping.py
+    mapping_fn: bpy.props.StringProperty()
+    # Bake mode runs all frames in execute and writes keyframes in bulk
+    bake: bpy.props.BoolProperty()
+    # The scene's frame range when not set
+    frame_start: bpy.props.IntProperty()
+    frame_end: bpy.props.IntProperty()
+    # Bake mode only: write the keys to this kktracks file instead of an action
+    tracks_fn: bpy.props.StringProperty()
+    # Bake mode only: drop keys linear interpolation reproduces within key_*_tol
+    reduce_keys: bpy.props.BoolProperty()
+    # Bake mode only: solve only frames the CM action has keys on, see max_key_gap
+    source_frames: bpy.props.BoolProperty()
             
     def modal(self, context, event):
-        global op_history
         self.context = context
         if event.type == 'ESC':
             self.report({'WARNING'}, 'Cancelled')
@@ -194,10 +692,9 @@ class TransferPoseCommon(bpy.types.Operator):
                 self.running_gen = None
                 self.current_state += 1
         if self.current_state >= len(self.op_stack):
-            op_history = (self.bl_idname, 'FINISHED')
             return {'FINISHED'}
         fun = self.op_stack[self.current_state]
-        self.report({'DEBUG'}, f'Running: {fun.__name__}')
+        debug(self, 'Running: {}', fun.__name__)
         ret = fun(context, event)
         if '__next__' in dir(ret):
             self.running_gen = ret
@@ -206,382 +703,48 @@ class TransferPoseCommon(bpy.types.Operator):
         return {'PASS_THROUGH'}
     
     def execute(self, context):
-        global op_history
-        op_history = (self.bl_idname, 'STARTED')
         self.context = context
-        # Suppose an animation is loaded on cm_arm
-        self.op_stack = [
-            self.reset_kk_arm,
-            self.load_tpose_basis,
-#            self.check_transform_basis,
-            self.transfer_torso,
-            self.transfer_left_leg,
-            self.transfer_right_leg,
-            self.transfer_spine,
-            self.transfer_shoulder,
-            self.transfer_left_arm,
-#            self.transfer_left_arm_fk,
-            self.transfer_right_arm,
-#            self.transfer_right_arm_fk,
-            self.transfer_fingers,
-        ]
+        self.eval_cache = EvalCache()
+        self.setup(context, mapping.load(bpy.path.abspath('//') + self.mapping_fn), self.mapping_fn)
         self.running_gen = None
         self.current_state = 0
-        
-
-class TransferPose(TransferPoseCommon):
-    bl_idname = "script.transfer_pose"
-    bl_label = "Transfer pose from CM to KK"
-    
-    def transfer_torso(self, context, event):
-        cm_bone_name = 'Bip01 Pelvis'
-        kk_bone_name = 'torso'
-        self.transfer_location(cm_bone_name, kk_bone_name)
-        self.transfer_rotation(cm_bone_name, kk_bone_name)
-        
-    def transfer_left_leg(self, context, event):
-        # Knee endpoint: 3DOF to Bip01 L Calf 0%
-        cm_bone_name = 'Bip01 L Calf'
-        kk_bone_name = 'thigh_ik_target.L'
-        self.transfer_location(cm_bone_name, kk_bone_name)
-        yield
-        # IK endpoint: 6DOF to Bip01 L Foot 50%
-        cm_bone_name = 'Bip01 L Foot'
-        kk_bone_name = 'foot_ik.L'
-        lerp_amount = 0.1
-        self.transfer_location(cm_bone_name, kk_bone_name, lerp_amount)
-        self.transfer_rotation(cm_bone_name, kk_bone_name)
-        
-    def transfer_left_leg_fk(self, context, event):
-        # Disabled as pelvis deformation is as janky as ik
-        cm_bone_name = 'Bip01 L Thigh'
-        kk_bone_name = 'thigh_fk.L'
-        #self.match_leg_fk_roll(cm_bone_name, kk_bone_name)
-        yield
-        cm_bone_name = 'Bip01 L Calf'
-        kk_bone_name = 'shin_fk.L'
-        #self.match_leg_fk_roll(cm_bone_name, kk_bone_name)
-        yield
-        # IK endpoint: 6DOF to Bip01 L Foot 50%
-        cm_bone_name = 'Bip01 L Foot'
-        kk_bone_name = 'foot_fk.L'
-        lerp_amount = 0.1
-        #self.match_leg_fk_roll(cm_bone_name, kk_bone_name)
-        
-    def transfer_shoulder(self, context, event):
-        cm_bone_name = 'Bip01 L Clavicle'
-        kk_bone_name = 'shoulder.L'
-        self.match_orientation(cm_bone_name, kk_bone_name, pi/2)
-        yield
-        cm_bone_name = 'Bip01 R Clavicle'
-        kk_bone_name = 'shoulder.R'
-        self.match_orientation(cm_bone_name, kk_bone_name, -pi/2)
-        
-    def transfer_right_leg(self, context, event):
-        cm_bone_name = 'Bip01 R Calf'
-        kk_bone_name = 'thigh_ik_target.R'
-        self.transfer_location(cm_bone_name, kk_bone_name)
-        yield
-        cm_bone_name = 'Bip01 R Foot'
-        kk_bone_name = 'foot_ik.R'
-        lerp_amount = 0.1
-        self.transfer_location(cm_bone_name, kk_bone_name, lerp_amount)
-        self.transfer_rotation(cm_bone_name, kk_bone_name)
+        if self.bake:
+            self.bake_frames(context)
+            return {'FINISHED'}
             
-    def transfer_left_arm_fk(self, context, event):
-        bone(context, self.kk_arm, 'upper_arm_parent.L')['IK_FK'] = 1
-        cm_bone_name = 'Bip01 L UpperArm'
-        kk_bone_name = 'upper_arm_fk.L'
-        self.match_orientation(cm_bone_name, kk_bone_name, pi/4)
-        yield
-        cm_bone_name = 'Bip01 L Forearm'
-        kk_bone_name = 'forearm_fk.L'
-        self.match_orientation(cm_bone_name, kk_bone_name, pi/4)
-        yield
-        cm_bone_name = 'Bip01 L Hand'
-        kk_bone_name = 'hand_fk.L'
-        self.match_orientation(cm_bone_name, kk_bone_name, pi)
-                    
-    def transfer_right_arm_fk(self, context, event):
-        bone(context, self.kk_arm, 'upper_arm_parent.R')['IK_FK'] = 1
-        cm_bone_name = 'Bip01 R UpperArm'
-        kk_bone_name = 'upper_arm_fk.R'
-        self.match_orientation(cm_bone_name, kk_bone_name, 3*pi/4)
-        yield
-        cm_bone_name = 'Bip01 R Forearm'
-        kk_bone_name = 'forearm_fk.R'
-        self.match_orientation(cm_bone_name, kk_bone_name, 3*pi/4)
-        yield
-        cm_bone_name = 'Bip01 R Hand'
-        kk_bone_name = 'hand_fk.R'
-        self.match_orientation(cm_bone_name, kk_bone_name, 0)
-        
-    def transfer_left_arm(self, context, event):
-        bone(context, self.kk_arm, 'upper_arm_parent.L')['IK_FK'] = 0
-        cm_bone_name = 'Bip01 L Forearm'
-        kk_bone_name = 'upper_arm_ik_target.L'
-        self.transfer_location(cm_bone_name, kk_bone_name)
-        # Move to joint position
-        yield
-        vec_a = deformed_bone(context, self.cm_arm, 'Bip01 L UpperArm').y_axis
-        vec_b = deformed_bone(context, self.cm_arm, 'Bip01 L Forearm').y_axis
-        away_vec = (vec_a - vec_b).normalized()
-        self.report({'DEBUG'}, f'{vec_a} {vec_b} {away_vec}')
-        bone_set_loc(self, context, self.kk_arm, kk_bone_name, away_vec)
-        # Tune IK position to point away
-        yield
-        cm_bone_name = 'Bip01 L Hand'
-        kk_bone_name = 'hand_ik.L'
-        self.transfer_location(cm_bone_name, kk_bone_name, 0.1)
-        self.match_orientation(cm_bone_name, kk_bone_name, pi)
-                            
-    def transfer_right_arm(self, context, event):
-        bone(context, self.kk_arm, 'upper_arm_parent.R')['IK_FK'] = 0
-        cm_bone_name = 'Bip01 R Forearm'
-        kk_bone_name = 'upper_arm_ik_target.R'
-        self.transfer_location(cm_bone_name, kk_bone_name)
-        # Move to joint position
-        yield
-        vec_a = deformed_bone(context, self.cm_arm, 'Bip01 R UpperArm').y_axis
-        vec_b = deformed_bone(context, self.cm_arm, 'Bip01 R Forearm').y_axis
-        away_vec = (vec_a - vec_b).normalized()
-        self.report({'DEBUG'}, f'{vec_a} {vec_b} {away_vec}')
-        bone_set_loc(self, context, self.kk_arm, kk_bone_name, away_vec)
-        # Tune IK position to point away
-        yield
-        cm_bone_name = 'Bip01 R Hand'
-        kk_bone_name = 'hand_ik.R'
-        self.transfer_location(cm_bone_name, kk_bone_name, 0.1)
-        self.match_orientation(cm_bone_name, kk_bone_name)
-        
-    def transfer_fingers(self, context, event):
-        add_roll = pi / 2
-        finger_list = ('thumb', 'f_index', 'f_middle', 'f_ring', 'f_pinky')
-        kk_finger_name_template = 'f_{}.{01-03}.{LR}'    
-        cm_finger_name = 'Bip01 {LR} Finger{0-4}{empty, 1, 2}'
-        for joint in range(3):
-            for side in 'LR':
-                for finger in range(5):
-                    kk_finger_name = f'{finger_list[finger]}.{joint+1:02d}.{side}'
-                    cm_finger_name = f'Bip01 {side} Finger{finger}'
-                    if joint > 0:
-                        cm_finger_name += f'{joint}'
-                    self.report({'DEBUG'}, f'{cm_finger_name} {kk_finger_name}')
-                    assert cm_finger_name in self.tpose_basis[self.cm_arm]
-                    assert kk_finger_name in self.tpose_basis[self.kk_arm]
-                    self.match_orientation(cm_finger_name, kk_finger_name, add_roll)
-            yield
-        self.match_orientation('Bip01 L Toe11', 'toe.L', add_roll)
-        self.match_orientation('Bip01 R Toe11', 'toe.R', add_roll)
-           
-    def transfer_spine(self, context, event):
-        cm_bone_name = 'Bip01 Spine0a'
-        kk_bone_name = 'spine_fk.003'
-        self.match_orientation(cm_bone_name, kk_bone_name, -pi/2)
-        yield
-        cm_bone_name = 'Bip01 Spine1'
-        kk_bone_name = 'spine_fk.004'
-        self.match_orientation(cm_bone_name, kk_bone_name, -pi/2)
-        yield
-        cm_bone_name = 'Bip01 Spine1a'
-        kk_bone_name = 'spine_fk.005'
-        self.match_orientation(cm_bone_name, kk_bone_name, -pi/2)
-        yield
-        cm_bone_name = 'Bip01 Neck'
-        kk_bone_name = 'neck'
-        self.match_orientation(cm_bone_name, kk_bone_name, -pi/2)
-        yield
-        cm_bone_name = 'Bip01 Head'
-        kk_bone_name = 'head'
-        self.match_orientation(cm_bone_name, kk_bone_name, -pi/2)
+    def bake_frames(self, context):
+        frame_start = self.frame_start if self.properties.is_property_set('frame_start') else context.scene.frame_start
+        frame_end = self.frame_end if self.properties.is_property_set('frame_end') else context.scene.frame_end
+        frames = range(frame_start, frame_end + 1)
+        if self.source_frames:
+            frames = solve_frames(context, self.cm_arm, frame_start, frame_end)
+        for frame in frames:
+            with profiler.stage('frame', frame=frame):
+                context.scene.frame_set(frame)
+                self.bake_frame(context, frame)
+        self.write_baked(context, self.tracks_fn, self.reduce_keys)
     
     def invoke(self, context, event):
-        self.json_fn = 'tpose_basis.json'
-        self.cm_arm = 'body001.armature'
-        self.kk_arm = 'combined.001'
+        if not self.mapping_fn:
+            self.mapping_fn = self.default_mapping_fn
+        if self.bake:
+            return self.execute(context)
         self.execute(context)
         
         context.window_manager.modal_handler_add(self)
         return {'RUNNING_MODAL'}
+
+class TransferPose(TransferPoseCommon):
+    bl_idname = "script.transfer_pose"
+    bl_label = "Transfer pose from CM to KK"
+    default_mapping_fn = 'mapping_female.json'
     
 bpy.utils.register_class(TransferPose)
 
-
-
 class TransferPoseMale(TransferPoseCommon):
     bl_idname = "script.transfer_pose_male"
     bl_label = "Transfer male pose from CM to KK"
-    
-    def transfer_torso(self, context, event):
-        cm_bone_name = 'ManBip Pelvis'
-        kk_bone_name = 'torso'
-        self.transfer_location(cm_bone_name, kk_bone_name)
-        self.transfer_rotation(cm_bone_name, kk_bone_name)
-        
-    def transfer_left_leg(self, context, event):
-        # Knee endpoint: 3DOF to Bip01 L Calf 0%
-        cm_bone_name = 'ManBip L Calf'
-        kk_bone_name = 'thigh_ik_target.L'
-        self.transfer_location(cm_bone_name, kk_bone_name)
-        yield
-        # IK endpoint: 6DOF to Bip01 L Foot 50%
-        cm_bone_name = 'ManBip L Foot'
-        kk_bone_name = 'foot_ik.L'
-        lerp_amount = 0.3
-        self.transfer_location(cm_bone_name, kk_bone_name, lerp_amount)
-        self.transfer_rotation(cm_bone_name, kk_bone_name)
-        
-    def transfer_left_leg_fk(self, context, event):
-        # Disabled as pelvis deformation is as janky as ik
-        cm_bone_name = 'ManBip L Thigh'
-        kk_bone_name = 'thigh_fk.L'
-        #self.match_leg_fk_roll(cm_bone_name, kk_bone_name)
-        yield
-        cm_bone_name = 'ManBip L Calf'
-        kk_bone_name = 'shin_fk.L'
-        #self.match_leg_fk_roll(cm_bone_name, kk_bone_name)
-        yield
-        # IK endpoint: 6DOF to Bip01 L Foot 50%
-        cm_bone_name = 'ManBip L Foot'
-        kk_bone_name = 'foot_fk.L'
-        lerp_amount = 0.1
-        #self.match_leg_fk_roll(cm_bone_name, kk_bone_name)
-            
-    def transfer_left_arm_fk(self, context, event):
-        bone(context, self.kk_arm, 'upper_arm_parent.L')['IK_FK'] = 1
-        cm_bone_name = 'ManBip L UpperArm'
-        kk_bone_name = 'upper_arm_fk.L'
-        self.match_orientation(cm_bone_name, kk_bone_name, pi/4)
-        yield
-        cm_bone_name = 'ManBip L Forearm'
-        kk_bone_name = 'forearm_fk.L'
-        self.match_orientation(cm_bone_name, kk_bone_name, pi/4)
-        yield
-        cm_bone_name = 'ManBip L Hand'
-        kk_bone_name = 'hand_fk.L'
-        self.match_orientation(cm_bone_name, kk_bone_name, pi)
-                    
-    def transfer_right_arm_fk(self, context, event):
-        bone(context, self.kk_arm, 'upper_arm_parent.R')['IK_FK'] = 1
-        cm_bone_name = 'ManBip R UpperArm'
-        kk_bone_name = 'upper_arm_fk.R'
-        self.match_orientation(cm_bone_name, kk_bone_name, 3*pi/4)
-        yield
-        cm_bone_name = 'ManBip R Forearm'
-        kk_bone_name = 'forearm_fk.R'
-        self.match_orientation(cm_bone_name, kk_bone_name, 3*pi/4)
-        yield
-        cm_bone_name = 'ManBip R Hand'
-        kk_bone_name = 'hand_fk.R'
-        self.match_orientation(cm_bone_name, kk_bone_name, 0)
-        
-    def transfer_shoulder(self, context, event):
-        cm_bone_name = 'ManBip L Clavicle'
-        kk_bone_name = 'shoulder.L'
-        self.match_orientation(cm_bone_name, kk_bone_name, pi/2)
-        yield
-        cm_bone_name = 'ManBip R Clavicle'
-        kk_bone_name = 'shoulder.R'
-        self.match_orientation(cm_bone_name, kk_bone_name, -pi/2)
-                
-    def transfer_right_leg(self, context, event):
-        cm_bone_name = 'ManBip R Calf'
-        kk_bone_name = 'thigh_ik_target.R'
-        self.transfer_location(cm_bone_name, kk_bone_name)
-        yield
-        cm_bone_name = 'ManBip R Foot'
-        kk_bone_name = 'foot_ik.R'
-        lerp_amount = 0.3
-        self.transfer_location(cm_bone_name, kk_bone_name, lerp_amount)
-        self.transfer_rotation(cm_bone_name, kk_bone_name)
-            
-    def transfer_left_arm(self, context, event):
-        bone(context, self.kk_arm, 'upper_arm_parent.L')['IK_FK'] = 0
-        cm_bone_name = 'ManBip L Forearm'
-        kk_bone_name = 'upper_arm_ik_target.L'
-        self.transfer_location(cm_bone_name, kk_bone_name)
-        # Move to joint position
-        yield
-        vec_a = deformed_bone(context, self.cm_arm, 'ManBip L UpperArm').y_axis
-        vec_b = deformed_bone(context, self.cm_arm, 'ManBip L Forearm').y_axis
-        away_vec = (vec_a - vec_b).normalized()
-        self.report({'DEBUG'}, f'{vec_a} {vec_b} {away_vec}')
-        bone_set_loc(self, context, self.kk_arm, kk_bone_name, away_vec)
-        # Tune IK position to point away
-        yield
-        cm_bone_name = 'ManBip L Hand'
-        kk_bone_name = 'hand_ik.L'
-        self.transfer_location(cm_bone_name, kk_bone_name, 0.3)
-        self.match_orientation(cm_bone_name, kk_bone_name, pi)
-                            
-    def transfer_right_arm(self, context, event):
-        bone(context, self.kk_arm, 'upper_arm_parent.R')['IK_FK'] = 0
-        cm_bone_name = 'ManBip R Forearm'
-        kk_bone_name = 'upper_arm_ik_target.R'
-        self.transfer_location(cm_bone_name, kk_bone_name)
-        # Move to joint position
-        yield
-        vec_a = deformed_bone(context, self.cm_arm, 'ManBip R UpperArm').y_axis
-        vec_b = deformed_bone(context, self.cm_arm, 'ManBip R Forearm').y_axis
-        away_vec = (vec_a - vec_b).normalized()
-        self.report({'DEBUG'}, f'{vec_a} {vec_b} {away_vec}')
-        bone_set_loc(self, context, self.kk_arm, kk_bone_name, away_vec)
-        # Tune IK position to point away
-        yield
-        cm_bone_name = 'ManBip R Hand'
-        kk_bone_name = 'hand_ik.R'
-        self.transfer_location(cm_bone_name, kk_bone_name, 0.3)
-        self.match_orientation(cm_bone_name, kk_bone_name)
-        
-    def transfer_fingers(self, context, event):
-        add_roll = pi / 2
-        finger_list = ('thumb', 'f_index', 'f_middle', 'f_ring', 'f_pinky')
-        kk_finger_name_template = 'f_{}.{01-03}.{LR}'    
-        cm_finger_name = 'ManBip {LR} Finger{0-4}{empty, 1, 2}'
-        for joint in range(3):
-            for side in 'LR':
-                for finger in range(5):
-                    kk_finger_name = f'{finger_list[finger]}.{joint+1:02d}.{side}'
-                    cm_finger_name = f'ManBip {side} Finger{finger}'
-                    if joint > 0:
-                        cm_finger_name += f'{joint}'
-                    self.report({'DEBUG'}, f'{cm_finger_name} {kk_finger_name}')
-                    assert cm_finger_name in self.tpose_basis[self.cm_arm]
-                    assert kk_finger_name in self.tpose_basis[self.kk_arm]
-                    self.match_orientation(cm_finger_name, kk_finger_name, add_roll)
-            yield
-        self.match_orientation('ManBip L Toe0', 'toe.L', add_roll)
-        self.match_orientation('ManBip R Toe0', 'toe.R', add_roll)
-            
-    def transfer_spine(self, context, event):
-        cm_bone_name = 'ManBip Spine'
-        kk_bone_name = 'spine_fk.003'
-        self.match_orientation(cm_bone_name, kk_bone_name, -pi/2)
-        yield
-        cm_bone_name = 'ManBip Spine1'
-        kk_bone_name = 'spine_fk.004'
-        self.match_orientation(cm_bone_name, kk_bone_name, -pi/2)
-        yield
-        cm_bone_name = 'ManBip Spine2'
-        kk_bone_name = 'spine_fk.005'
-        self.match_orientation(cm_bone_name, kk_bone_name, -pi/2)
-        yield
-        cm_bone_name = 'ManBip Neck'
-        kk_bone_name = 'neck'
-        self.match_orientation(cm_bone_name, kk_bone_name, -pi/2)
-        yield
-        cm_bone_name = 'ManBip Head'
-        kk_bone_name = 'head'
-        self.match_orientation(cm_bone_name, kk_bone_name, -pi/2)
-    
-    def invoke(self, context, event):
-        self.json_fn = 'tpose_basis_male.json'
-        self.cm_arm = 'mbody.armature.001'
-        self.kk_arm = 'combined'
-        self.execute(context)
-        
-        context.window_manager.modal_handler_add(self)
-        return {'RUNNING_MODAL'}
+    default_mapping_fn = 'mapping_male.json'
     
 bpy.utils.register_class(TransferPoseMale)
 
@@ -589,21 +752,30 @@ class SaveTPoseBasisCommon(bpy.types.Operator):
     cm_arm: bpy.props.StringProperty()
     kk_arm: bpy.props.StringProperty()
     json_fn: bpy.props.StringProperty()
+    # With a mapping file the armatures come from it and only the compiled
+    # .npz of its basis file is written, holding just the KK bones it uses
+    mapping_fn: bpy.props.StringProperty()
 
     def execute(self, context):
         # Suppose both models are in the same pose (T-Pose)
-        self.cm_arm = cm_arm
-        self.kk_arm = kk_arm
-        out_dict = {}
-        for arm in [self.cm_arm, self.kk_arm]:
-            out_dict[arm] = {}
-            for b in deformed(context, context.scene.objects[arm]).pose.bones:
-                out_dict[arm][b.name] = {}
-                out_dict[arm][b.name]['basis'] = matrix_to_python_list(bone_anim_basis(self, context, arm, b.name))
-                out_dict[arm][b.name]['head'] = vector_to_python_list(bone_anim_head(self, context, arm, b.name))
-                out_dict[arm][b.name]['tail'] = vector_to_python_list(bone_anim_tail(self, context, arm, b.name))
-        with open(bpy.path.abspath('//') + self.json_fn, "x") as jf:
-            jf.write(json.dumps(out_dict))
+        self.eval_cache = EvalCache()
+        if self.mapping_fn:
+            m = mapping.load(os.path.join(bpy.path.abspath('//'), self.mapping_fn))
+            self.cm_arm = m.cm_arm
+            self.kk_arm = m.kk_arm
+            bases = {
+                self.cm_arm: bone_tpose_bases(self, context, self.cm_arm),
+                self.kk_arm: bone_tpose_bases(self, context, self.kk_arm, m.kk_bones()),
+            }
+            out_fn = tpose.compiled_fn(m.tpose_basis)
+            tpose.save_npz(bases, out_fn)
+        else:
+            bases = {arm: bone_tpose_bases(self, context, arm) for arm in [self.cm_arm, self.kk_arm]}
+            out_fn = tpose.save_json(bases, bpy.path.abspath('//') + self.json_fn)
+        self.report({'INFO'}, f'Saved {out_fn}')
+        # Rest hierarchy for converting without Blender, whatever the pose
+        rig_fn = kkrig.save(kk_rig(context.scene.objects[self.kk_arm]), kkrig.rig_fn(out_fn))
+        self.report({'INFO'}, f'Saved {rig_fn}')
         return {'FINISHED'}
 
 class SaveTPoseBasis(SaveTPoseBasisCommon):
@@ -665,179 +837,319 @@ class CreateAction(bpy.types.Operator):
     
 bpy.utils.register_class(CreateAction)
     
+class ClipTransfer(PoseTransfer):
+    # Transfer of one clip, run by transfer_clips for an operator
+    def __init__(self, op, anm_fn, eval_cache, bake):
+        self.op = op
+        self.anm = anm_fn
+        self.bake = bake
+        # Shared, so a clip reading another one's armatures reuses its fetch
+        self.eval_cache = eval_cache
+        
+    def report(self, level, message):
+        self.op.report(level, f'{action_name(self.anm)}: {message}')
+
+def transfer_clips(op, context, clips, bake=True, tracks_dir='', reduce_keys=False, source_frames=False, fps=0, preview=False,
+        angle_tol=None, loc_tol=None, source_frames_only=None, stride=None):
+    # clips: [(anm file, mapping file, mapping.Mapping)], each on its own
+    # armature pair. All are solved in one frame loop.
+    # Yields after every frame so modal operators and timers can interleave
+    # UI updates. Without bake keyframes are inserted as frames are solved.
+    # With fps keys are written at that rate: solved right on its frames,
+    # between scene frames if need be, or with source_frames solved on the
+    # source keys and resampled when baking. kktracks files are at that rate,
+    # actions keep the scene rate and get keys at the same times instead.
+    # With preview only core bones are solved on every stride-th frame,
+    # preview_stride if not given, into a preview action. Without, a clip's
+    # preview is dropped once its full action is written.
+    # angle_tol (radians), loc_tol and source_frames_only override the key
+    # reduction configs.
+    if fps and source_frames and not bake:
+        # Resampling happens when baking
+        raise mapping.MappingError('fps with source_frames needs bake')
+    eval_cache = EvalCache()
+    transfers = []
+    frame_end = 0
+    for anm_fn, mapping_fn, m in clips:
+        bpy.ops.script.load_animation(cm_arm=m.cm_arm, cm_anm=anm_fn)
+        # The importer sets the scene range to the clip
+        frame_end = max(frame_end, context.scene.frame_end)
+        if preview:
+            m = m.preview()
+        bpy.ops.script.create_action(arm=m.kk_arm, action_name=action_name(anm_fn, preview))
+        t = ClipTransfer(op, anm_fn, eval_cache, bake)
+        t.action = action_name(anm_fn, preview)
+        t.setup(context, m, mapping_fn, preview)
+        transfers.append(t)
+    context.scene.frame_end = frame_end
+    frames = set(range(frame_end + 1))
+    if source_frames:
+        frames = set()
+        for t in transfers:
+            frames.update(solve_frames(context, t.cm_arm, 0, frame_end))
+    # (key frame, scene frame)
+    steps = [(f, f) for f in sorted(frames)]
+    scene_fps = context.scene.render.fps
+    if fps and fps != scene_fps and not source_frames:
+        steps = [(k, k * scene_fps / fps) for k in range(int(round(frame_end * fps / scene_fps)) + 1)]
+        for t in transfers:
+            t.key_fps = fps
+    if preview:
+        # Last frame kept so the preview covers the whole clip
+        stride = stride or preview_stride
+        steps = steps[::stride] + ([steps[-1]] if (len(steps) - 1) % stride else [])
+    for key_frame, frame in steps:
+        with profiler.stage('frame', frame=frame):
+            context.scene.frame_set(int(frame), subframe=frame - int(frame))
+            for t in transfers:
+                t.bake_frame(context, key_frame)
+        yield key_frame
+    if bake:
+        for t in transfers:
+            tracks_fn = ''
+            if tracks_dir:
+                tracks_fn = os.path.join(tracks_dir, t.action + kktracks.ext)
+            t.write_baked(context, tracks_fn, reduce_keys, fps, angle_tol, loc_tol, source_frames_only)
+    if not preview:
+        # Only now, a failed full pass keeps the preview
+        for t in transfers:
+            if action_name(t.anm, True) in bpy.data.actions:
+                bpy.data.actions.remove(bpy.data.actions[action_name(t.anm, True)])
+
+def dump_profile(op, name):
+    if not profiler.enabled:
+        return
+    out_dir = bpy.path.abspath('//') + profile_dir
+    os.makedirs(out_dir, exist_ok=True)
+    profiler.dump(os.path.join(out_dir, name + '.trace.json'))
+    op.report({'INFO'}, profiler.summary())
+
+def clip_mapping(anm_fn):
+    mapping_fn = bpy.path.abspath('//') + mapping.mapping_for_anm(anm_fn)
+    return (anm_fn, mapping_fn, mapping.load(mapping_fn))
+
+def scene_mappings(anm_fns, rigs_fn=''):
+    rigs = scene.load_rigs(rigs_fn or bpy.path.abspath('//') + scene.rigs_fn)
+    ret = []
+    for anm_fn in anm_fns:
+        key, role = scene.split_role(anm_fn)
+        mapping_fn, m = scene.rig_for(rigs, anm_fn, role)
+        ret.append((anm_fn, mapping_fn, m))
+    return ret
+
 class TransferAnimation(bpy.types.Operator):
     bl_idname = 'script.transfer_animation'
     bl_label = 'Transfer animation'
                 
     anm: bpy.props.StringProperty()
+    bake: bpy.props.BoolProperty()
+    # Bake mode only: write <clip>.kk.npz here instead of keyframing an action
+    tracks_dir: bpy.props.StringProperty()
+    reduce_keys: bpy.props.BoolProperty()
+    # Key reduction tolerances, degrees and distance
+    angle_tol: bpy.props.FloatProperty(default=degrees(key_angle_tol))
+    loc_tol: bpy.props.FloatProperty(default=key_loc_tol)
+    # Reduced keys only stay on frames the clip has keys on
+    source_frames_only: bpy.props.BoolProperty(default=key_source_frames_only)
+    # Only solve frames the clip has keys on, the action interpolates the rest
+    source_frames: bpy.props.BoolProperty()
+    # Key at this many frames per second instead of the scene rate, see transfer_clips
+    fps: bpy.props.IntProperty()
+    # Core bones on every stride-th frame into a '<clip>.preview' action
+    preview: bpy.props.BoolProperty()
+    stride: bpy.props.IntProperty(default=preview_stride, min=1)
+    # Write a Chrome trace of the clip to profile_dir and report a summary
+    profile: bpy.props.BoolProperty()
     
     def modal(self, context, event):
-        global op_history
-        self.context = context
-        if context.scene.frame_current > context.scene.frame_end:
-            op_history = (self.bl_idname, 'FINISHED')
-            return {'FINISHED'}
         if event.type == 'ESC':
+            context.window_manager.event_timer_remove(self.timer)
             self.report({'WARNING'}, 'Cancelled')
             return {'CANCELLED'}
-        if self.next_subop_i >= len(self.subop_list):
-            context.scene.frame_current += 1
-            self.report({'INFO'}, f'Frame {context.scene.frame_current}')
-            self.next_subop_i = 0
-            return {'PASS_THROUGH'}
-        if self.running_subop is None:
-            # Start subop
-            subop = self.subop_list[self.next_subop_i]
-            self.report({'DEBUG'}, f'SUBOP {subop}')
-            self.running_subop = subop
-            ret = subop[0]('INVOKE_DEFAULT')
-            assert ret == {'RUNNING_MODAL'}
-            return {'PASS_THROUGH'}
-        # Running subop until it ends
-#        ret = self.running_subop.modal(context, event)
-        if op_history[1] == 'FINISHED':
-            self.report({'DEBUG'}, f'{self.running_subop} {op_history}')
-            self.running_subop = None
-            self.next_subop_i += 1
+        if event.type != 'TIMER':
             return {'PASS_THROUGH'}
+        try:
+            frame = next(self.steps)
+            self.report({'INFO'}, f'Frame {frame}')
+        except StopIteration:
+            context.window_manager.event_timer_remove(self.timer)
+            dump_profile(self, action_name(self.anm))
+            return {'FINISHED'}
         return {'PASS_THROUGH'}
 
     def execute(self, context):
-        self.context = context
-        self.is_male = re.search('[^a-z]m[^a-z]', self.anm) is not None
-        if self.is_male:
-            self.cm_arm = 'mbody.armature.001'
-            self.kk_arm = 'combined'
-            self.transfer_pose = (bpy.ops.script.transfer_pose_male,
-                {
-                'json_fn': 'tpose_basis_male.json',
-                'cm_arm': self.cm_arm,
-                'kk_arm': self.kk_arm
-            })
-        else:
-            self.cm_arm = 'body001.armature'
-            self.kk_arm = 'combined.001'
-            self.transfer_pose = (bpy.ops.script.transfer_pose,
-                {
-                'json_fn': 'tpose_basis.json',
-                'cm_arm': self.cm_arm,
-                'kk_arm': self.kk_arm
-            })
-        
-        self.running_subop = None
-        self.subop_list = [self.transfer_pose]
-        self.next_subop_i = 0
-        
-        # Load animation
-        bpy.ops.script.load_animation(
-            cm_arm=self.cm_arm,
-            cm_anm=self.anm
-        )
-
-        # Create new animation
-        bpy.ops.script.create_action(
-            arm=self.kk_arm,
-            action_name=self.anm.replace('\\','/').split('/')[-1]
-        )
-        
-        context.scene.frame_current = 0
+        global profiler
+        if self.fps and self.source_frames and not self.bake:
+            # See transfer_clips
+            self.report({'ERROR'}, 'fps with source_frames needs bake')
+            return {'CANCELLED'}
+        profiler = Profiler(enabled=self.profile)
+        self.steps = transfer_clips(self, context, [clip_mapping(self.anm)], self.bake,
+            self.tracks_dir, self.reduce_keys, self.source_frames, self.fps, self.preview,
+            radians(self.angle_tol), self.loc_tol, self.source_frames_only, self.stride)
+        if self.bake:
+            # Whole frame range in one call instead of one modal tick per frame
+            for _ in self.steps:
+                pass
+            dump_profile(self, action_name(self.anm))
+            return {'FINISHED'}
 
     def invoke(self, context, event):
-        self.execute(context)
-        
+        if self.bake:
+            return self.execute(context)
+        if self.execute(context) == {'CANCELLED'}:
+            return {'CANCELLED'}
+        # Stepped by a timer, not by however many events the UI happens to send
+        self.timer = context.window_manager.event_timer_add(0.001, window=context.window)
         context.window_manager.modal_handler_add(self)
         return {'RUNNING_MODAL'}
     
 bpy.utils.register_class(TransferAnimation)
 
+class TransferScene(bpy.types.Operator):
+    # Bakes the clips of all characters of a scene in one frame loop, see scene.py
+    bl_idname = 'script.transfer_scene'
+    bl_label = 'Transfer scene'
+    
+    # Clips separated by newlines
+    anms: bpy.props.StringProperty()
+    # scene_rigs.json next to the .blend if not given
+    rigs_fn: bpy.props.StringProperty()
+    tracks_dir: bpy.props.StringProperty()
+    reduce_keys: bpy.props.BoolProperty()
+    angle_tol: bpy.props.FloatProperty(default=degrees(key_angle_tol))
+    loc_tol: bpy.props.FloatProperty(default=key_loc_tol)
+    source_frames_only: bpy.props.BoolProperty(default=key_source_frames_only)
+    source_frames: bpy.props.BoolProperty()
+    fps: bpy.props.IntProperty()
+    preview: bpy.props.BoolProperty()
+    stride: bpy.props.IntProperty(default=preview_stride, min=1)
+    profile: bpy.props.BoolProperty()
+    
+    def execute(self, context):
+        global profiler
+        profiler = Profiler(enabled=self.profile)
+        clips = scene_mappings(self.anms.splitlines(), self.rigs_fn)
+        for _ in transfer_clips(self, context, clips, True, self.tracks_dir, self.reduce_keys, self.source_frames, self.fps, self.preview,
+                radians(self.angle_tol), self.loc_tol, self.source_frames_only, self.stride):
+            pass
+        dump_profile(self, action_name(clips[0][0]) + '.scene')
+        return {'FINISHED'}
 
-def gen_by_ext(root_folder, extension, exclude=None):
-    if exclude is None:
-        exclude = set()
-    for cd, sd, sf in os.walk(root_folder):
-        for f in sf:
-            if f.endswith('.'+extension):
-                yield cd.replace('\\', '/') + '/' + f
+bpy.utils.register_class(TransferScene)
 
 class TransferAnimationsFromFolder(bpy.types.Operator):
+    # Converts a folder through a jobs.JobQueue. A timer steps the running job
+    # one frame per tick, progress goes to the status bar and status_fn.
     bl_idname = 'script.transfer_animation_from_folder'
     bl_label = 'Transfer animation from folder'
                 
     folder: bpy.props.StringProperty()
+    bake: bpy.props.BoolProperty()
+    profile: bpy.props.BoolProperty()
+    # Bake the clips of each scene together like TransferScene
+    scenes: bpy.props.BoolProperty()
+    retries: bpy.props.IntProperty(default=1)
+    status_fn: bpy.props.StringProperty(default='//convert_status.json')
+    # Preview every job first, then run the full pass over the same jobs
+    preview: bpy.props.BoolProperty()
+    stride: bpy.props.IntProperty(default=preview_stride, min=1)
     
     def modal(self, context, event):
-        global op_history
-        self.context = context
-        if self.no_new_tasks():
-            return {'FINISHED'}
         if event.type == 'ESC':
+            # The running job stops here too
+            self.queue.cancel([self.job] if self.job is not None else [])
+            self.end(context)
             self.report({'WARNING'}, 'Cancelled')
             return {'CANCELLED'}
-        if self.running_task is None:
-            self.start_new_task()
+        if event.type != 'TIMER':
             return {'PASS_THROUGH'}
-        else:
-            return self.check_task()
-
-    def no_new_tasks(self):
-        if self.next_task is None:
+        if self.job is None:
+            self.job = self.queue.take()
+            if self.job is None and self.preview_pass:
+                # Full pass, no new folder scan
+                self.preview_pass = False
+                self.queue = JobQueue(self.groups, self.retries, bpy.path.abspath(self.status_fn), self.progress, self.errors)
+                self.job = self.queue.take()
+            if self.job is None:
+                self.end(context)
+                return {'FINISHED'}
             try:
-                self.next_task = next(self.file_gen)
-                return False
-            except StopIteration:
-                return True
-        return False
-
-    def start_new_task(self):
-        if self.next_task is None:
-            self.no_new_tasks()
-        # self.next_task must have something here
-        # Start task here
-        assert self.running_task is None
-        # Start task here
-        self.report({'INFO'}, f'Anm file: {self.next_task}')
+                # SceneError or MappingError of one job fails only that job
+                self.start_job(context)
+            except Exception as e:
+                self.fail_job(e)
+            return {'PASS_THROUGH'}
         try:
-            action_name = self.next_task.replace('\\', '/').split('/')[-1]
-            bpy.data.actions[action_name]
-            self.running_task = None
-            # If no exception thrown, this anm clip is already processed
-            # Consume the task
-            self.next_task = None
-            return
-        except KeyError:
-            pass
-        self.running_task = bpy.ops.script.transfer_animation(
-            'INVOKE_DEFAULT',
-            anm=self.next_task
-            )
-        # Consume self.next_task after it is used
-        self.next_task = None
-        assert self.running_task == {'RUNNING_MODAL'}
-
-    def check_task(self):
-        global op_history
-        if op_history[0] == 'SCRIPT_OT_transfer_animation':
-            if op_history[1] != 'FINISHED':
-                return {op_history[1]}
-            # Task is finished
-            # Unset running task
-            self.running_task = None
-        # Continue existing task
+            next(self.steps)
+        except StopIteration:
+            dump_profile(self, action_name(self.job.clips[0][0], self.preview_pass))
+            if not self.preview_pass:
+                for anm_fn, mapping_fn in self.job.clips:
+                    self.converted.mark_done(anm_fn, mapping_fn)
+            self.queue.finish(self.job)
+            self.job = None
+        except Exception as e:
+            self.fail_job(e)
         return {'PASS_THROUGH'}
 
+    def fail_job(self, e):
+        self.report({'ERROR'}, f'{self.job.clips}: {e!r}')
+        self.queue.fail(self.job, repr(e))
+        self.job = None
+
+    def start_job(self, context):
+        global profiler
+        profiler = Profiler(enabled=self.profile)
+        self.report({'INFO'}, f'Anm files: {[anm_fn for anm_fn, mapping_fn in self.job.clips]}')
+        if self.scenes:
+            clips = scene_mappings([anm_fn for anm_fn, mapping_fn in self.job.clips])
+        else:
+            clips = [clip_mapping(anm_fn) for anm_fn, mapping_fn in self.job.clips]
+        self.steps = transfer_clips(self, context, clips, self.bake, preview=self.preview_pass, stride=self.stride)
+
+    def tasks(self):
+        # (clip list, error) left to convert, clip, basis, mapping or options
+        # changed since the last run. Scenes that cannot convert fail on their own,
+        # see scene.jobs.
+        files = find_anms([self.folder])
+        if self.scenes:
+            groups = scene.jobs(files, scene.load_rigs(bpy.path.abspath('//') + scene.rigs_fn))
+        else:
+            groups = [([(anm_fn, bpy.path.abspath('//') + mapping.mapping_for_anm(anm_fn))], None) for anm_fn in files]
+        # The actions live in this .blend, a clip is only done while its
+        # action is still there
+        return [(g, e) for g, e in groups if e is not None or not all(
+            self.converted.is_done(*c) and action_name(c[0]) in bpy.data.actions for c in g)]
+
+    def progress(self, status):
+        counts = status['counts']
+        bpy.context.workspace.status_text_set(f'Converted {counts["done"]}/{len(status["jobs"])}, {counts["failed"]} failed')
+
+    def end(self, context):
+        context.window_manager.event_timer_remove(self.timer)
+        context.workspace.status_text_set(None)
+
     def execute(self, context):
         self.context = context
-        self.file_gen = gen_by_ext(self.folder, 'anm')
-        self.next_task = next(self.file_gen)
-        self.running_task = None
+        options = [name for name in ('bake', 'scenes') if getattr(self, name)]
+        self.converted = ConvertedIndex(bpy.path.abspath('//') + 'converted_index.jsonl', options)
+        tasks = self.tasks()
+        self.groups = [g for g, e in tasks]
+        self.errors = [e for g, e in tasks]
+        self.queue = JobQueue(self.groups, self.retries, bpy.path.abspath(self.status_fn), self.progress, self.errors)
+        self.preview_pass = self.preview
+        self.job = None
 
     def invoke(self, context, event):
         self.execute(context)
-        
+        self.timer = context.window_manager.event_timer_add(0.001, window=context.window)
         context.window_manager.modal_handler_add(self)
         return {'RUNNING_MODAL'}
     
 bpy.utils.register_class(TransferAnimationsFromFolder)
-bpy.ops.script.transfer_animation_from_folder('INVOKE_DEFAULT', folder=r'C:\Users\anon\Desktop\kkanim\anms\18700')
+
+# Running or importing this file only registers the operators. Convert folders
+# with script.transfer_animation_from_folder from F3 or with batch.py.
 
 # [act.__setattr__('use_fake_user', True) for act in bpy.data.actions if act.name.endswith('.anm')]
\ No newline at end of file
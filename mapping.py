@@ -0,0 +1,144 @@
+import json
+import os
+import re
+from math import radians
+
+# Declarative bone mapping between a CM rig and a KK rig
+#
+# A mapping file names both armatures, the T-pose basis file and a list of
+# ops. Each op writes one KK bone:
+#   location     move kk head onto cm head, lerp towards cm tail by lerp
+#   rotation     kk rotation = cm rotation relative to T-pose, needs kk T-pose basis
+#   orientation  give kk the orientation of cm, plus roll degrees around Y
+#   fk_roll      like orientation but roll is replaced instead of added
+#   pole         push kk away from the joint between cm_from and cm
+#   ik_target    location and pole in one write: kk goes to the joint, lerp
+#                towards cm tail, pushed away from the bend
+#   ik_fk        set the IK_FK switch on kk to value
+# Ops marked detail (fingers, toes) are left out of previews, see preview().
+# Ops with a lower level run first. Ops in one level must not read what
+# another op in the same level writes. Given the dependency graph of the KK
+# rig, schedule() merges levels further where nothing depends on a write.
+
+ops_using_cm = ('location', 'rotation', 'orientation', 'fk_roll', 'pole', 'ik_target')
+ops_all = ops_using_cm + ('ik_fk',)
+# Pose bone property each op writes
+write_paths = {
+    'location': 'location',
+    'pole': 'location',
+    'ik_target': 'location',
+    'rotation': 'rotation_quaternion',
+    'orientation': 'rotation_quaternion',
+    'fk_roll': 'rotation_quaternion',
+}
+
+class MappingError(Exception):
+    pass
+
+class Op:
+    def __init__(self, op, kk, cm=None, cm_from=None, lerp=0, roll=None, value=None, level=0, detail=False):
+        if op not in ops_all:
+            raise MappingError(f'Unknown op {op!r} on {kk}')
+        if op in ops_using_cm and cm is None:
+            raise MappingError(f'Op {op!r} on {kk} needs a cm bone')
+        if op in ('pole', 'ik_target') and cm_from is None:
+            raise MappingError(f'Op {op} on {kk} needs cm_from')
+        self.op = op
+        self.kk = kk
+        self.cm = cm
+        self.cm_from = cm_from
+        self.lerp = lerp
+        # Stored in degrees, used in radians
+        self.roll = None if roll is None else radians(roll)
+        self.value = value
+        self.level = level
+        self.detail = detail
+
+    def cm_bones(self):
+        return [b for b in (self.cm, self.cm_from) if b is not None]
+
+class Mapping:
+    def __init__(self, cm_arm, kk_arm, tpose_basis, ops, basis_arms=None):
+        self.cm_arm = cm_arm
+        self.kk_arm = kk_arm
+        self.tpose_basis = tpose_basis
+        self.ops = ops
+        # Armature names the basis file is keyed by, the file's own cm_arm and
+        # kk_arm even when with_arms drives another pair
+        self.cm_basis_arm, self.kk_basis_arm = basis_arms or (cm_arm, kk_arm)
+
+    def levels(self):
+        # Ops grouped by level, file order kept inside a level
+        ret = {}
+        for op in self.ops:
+            ret.setdefault(op.level, []).append(op)
+        return [ret[k] for k in sorted(ret)]
+
+    def schedule(self, deps):
+        # deps: kk bone -> set of other kk bones whose pose moves it
+        # Returns ops grouped into as few levels as possible, such that every op
+        # reads the same values it would read when run in declared order.
+        # IK_FK switches are not tracked by deps. They run first in their level,
+        # so a switch goes after every op declared before it and no later op
+        # moves above it.
+        ops = [op for level in self.levels() for op in level]
+        placed = []
+        floor = 0
+        for op in ops:
+            if op.op == 'ik_fk':
+                floor = max([floor] + [l + 1 for prev, l in placed if prev.op != 'ik_fk'])
+                placed.append((op, floor))
+                continue
+            level = floor
+            reads = deps.get(op.kk, ())
+            for prev, prev_level in placed:
+                if prev.op == 'ik_fk':
+                    continue
+                if prev.kk in reads:
+                    # Reads what prev wrote
+                    level = max(level, prev_level + 1)
+                elif prev.kk == op.kk and write_paths[prev.op] == write_paths[op.op]:
+                    # Writes are relative to the current value
+                    level = max(level, prev_level + 1)
+                elif op.kk in deps.get(prev.kk, ()):
+                    # prev must still see the value before this write
+                    level = max(level, prev_level)
+            placed.append((op, level))
+        ret = [[] for i in range(1 + max((l for op, l in placed), default=0))]
+        for op, level in placed:
+            ret[level].append(op)
+        return ret
+
+    def with_arms(self, cm_arm=None, kk_arm=None):
+        # Same ops for another armature pair, e.g. a second character in a scene
+        return Mapping(cm_arm or self.cm_arm, kk_arm or self.kk_arm, self.tpose_basis, self.ops,
+            (self.cm_basis_arm, self.kk_basis_arm))
+
+    def preview(self):
+        # Core bones only: torso, spine, head and limbs
+        return Mapping(self.cm_arm, self.kk_arm, self.tpose_basis, [op for op in self.ops if not op.detail],
+            (self.cm_basis_arm, self.kk_basis_arm))
+
+    def kk_bones(self):
+        return list(dict.fromkeys(op.kk for op in self.ops))
+
+    def cm_bones(self):
+        return list(dict.fromkeys(b for op in self.ops for b in op.cm_bones()))
+
+def from_dict(d, base_dir=''):
+    return Mapping(
+        d['cm_arm'],
+        d['kk_arm'],
+        os.path.join(base_dir, d['tpose_basis']),
+        [Op(**op) for op in d['ops']],
+    )
+
+def load(fn):
+    with open(fn) as f:
+        return from_dict(json.loads(f.read()), os.path.dirname(os.path.abspath(fn)))
+
+def mapping_for_anm(anm_fn):
+    # Male clips have a lone m in their name
+    if re.search('[^a-z]m[^a-z]', anm_fn) is not None:
+        return 'mapping_male.json'
+    return 'mapping_female.json'
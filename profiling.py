@@ -0,0 +1,86 @@
+import json
+import time
+
+# Stage timings and counters for one clip
+#
+#   with profiler.stage('depsgraph'):
+#       ...
+#   profiler.count('depsgraph evaluations')
+#
+# A disabled profiler hands out one shared no-op stage, so instrumented code
+# costs a method call and nothing else when profiling is off.
+
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+null_stage = NullStage()
+
+class Stage:
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.events.append((self.name, self.start, time.perf_counter_ns() - self.start, self.args))
+        return False
+
+class Profiler:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.events = [] # (name, start ns, duration ns, args)
+        self.counters = {}
+        self.origin = time.perf_counter_ns()
+
+    def stage(self, name, **args):
+        if not self.enabled:
+            return null_stage
+        return Stage(self, name, args)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def totals(self):
+        # name -> (calls, total ns)
+        ret = {}
+        for name, start, dur, args in self.events:
+            calls, total = ret.get(name, (0, 0))
+            ret[name] = (calls + 1, total + dur)
+        return ret
+
+    def summary(self):
+        lines = [f'{"stage":<24}{"calls":>10}{"total ms":>12}{"mean us":>12}']
+        for name, (calls, total) in sorted(self.totals().items(), key=lambda x: -x[1][1]):
+            lines.append(f'{name:<24}{calls:>10}{total / 1e6:>12.1f}{total / calls / 1e3:>12.1f}')
+        for name, n in sorted(self.counters.items()):
+            lines.append(f'{name:<24}{n:>10}')
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        # Load in chrome://tracing or Perfetto
+        events = [{
+            'name': name,
+            'ph': 'X',
+            'ts': (start - self.origin) / 1e3,
+            'dur': dur / 1e3,
+            'pid': 0,
+            'tid': 0,
+            'args': args,
+        } for name, start, dur, args in self.events]
+        end = (time.perf_counter_ns() - self.origin) / 1e3
+        for name, n in self.counters.items():
+            events.append({'name': name, 'ph': 'C', 'ts': end, 'pid': 0, 'args': {name: n}})
+        return {'traceEvents': events}
+
+    def dump(self, fn):
+        with open(fn, 'w') as f:
+            f.write(json.dumps(self.chrome_trace()))
@@ -0,0 +1,105 @@
+import json
+import os
+import re
+
+import mapping
+
+# Scenes: clips of several characters that play together
+#
+# COM3D2 names the clips of one scene alike, with a role token per character:
+#   h_kiss_f.anm, h_kiss_m.anm        one woman, one man
+#   dance_f1_01.anm, dance_f2_01.anm  two women
+# The clip name with the role token taken out is the scene key.
+#
+# scene_rigs.json next to the .blend gives the mapping for each role and, for
+# extra characters, the armature pair it drives. The mapping's T-pose basis
+# serves the other pair too:
+#   {
+#     "f": "mapping_female.json",
+#     "m": "mapping_male.json",
+#     "f2": {"mapping": "mapping_female.json", "cm_arm": "body001.armature.001", "kk_arm": "combined.002"}
+#   }
+
+rigs_fn = 'scene_rigs.json'
+default_rigs = {
+    'f': 'mapping_female.json',
+    'm': 'mapping_male.json',
+}
+
+role_re = re.compile('(?<![a-z0-9])([fm])([0-9]?)(?![a-z0-9])')
+
+class SceneError(Exception):
+    pass
+
+def split_role(anm_fn):
+    # (scene key, role). f1 and f are the same role. Clips without a token are
+    # their own scene with role f, like mapping_for_anm treats them.
+    folder, name = os.path.split(anm_fn.replace('\\', '/'))
+    matches = list(role_re.finditer(name.lower()))
+    if not matches:
+        return anm_fn, 'f'
+    m = matches[-1]
+    role = m.group(1) + (m.group(2) if m.group(2) not in ('', '1') else '')
+    return folder + '/' + name[:m.start()] + '*' + name[m.end():], role
+
+def group_roles(anm_fns):
+    # scene key -> [(role, anm_fn)], in order of first appearance
+    ret = {}
+    for fn in anm_fns:
+        key, role = split_role(fn)
+        ret.setdefault(key, []).append((role, fn))
+    return ret
+
+def roles(clips):
+    # {role: anm_fn} of one scene's [(role, anm_fn)]
+    ret = {}
+    for role, fn in clips:
+        if role in ret:
+            raise SceneError(f'{fn} and {ret[role]} both play role {role}')
+        ret[role] = fn
+    return ret
+
+def group(anm_fns):
+    # scene key -> {role: anm_fn}, in order of first appearance
+    return {key: roles(clips) for key, clips in group_roles(anm_fns).items()}
+
+def load_rigs(fn):
+    # role -> Mapping. Mapping files are relative to the rigs file.
+    base_dir = os.path.dirname(os.path.abspath(fn))
+    rigs = default_rigs
+    if os.path.exists(fn):
+        with open(fn) as f:
+            rigs = json.loads(f.read())
+    ret = {}
+    loaded = {}
+    for role, rig in rigs.items():
+        if isinstance(rig, str):
+            rig = {'mapping': rig}
+        mapping_fn = os.path.join(base_dir, rig['mapping'])
+        if mapping_fn not in loaded:
+            loaded[mapping_fn] = mapping.load(mapping_fn)
+        ret[role] = (mapping_fn, loaded[mapping_fn].with_arms(rig.get('cm_arm'), rig.get('kk_arm')))
+    return ret
+
+def rig_for(rigs, anm_fn, role):
+    if role not in rigs:
+        raise SceneError(f'No rig for role {role} of {anm_fn}, add it to {rigs_fn}')
+    return rigs[role]
+
+def jobs(anm_fns, rigs, scenes=True):
+    # [(clips, error)], clips being [(anm_fn, mapping_fn)] converted together:
+    # the clips of a scene, or each clip alone without scenes. A scene that
+    # cannot convert, a role played twice or one without a rig, has its
+    # SceneError message as error and None mapping files, so only that job
+    # fails and not the whole folder.
+    if scenes:
+        groups = list(group_roles(anm_fns).values())
+    else:
+        groups = [[(split_role(fn)[1], fn)] for fn in anm_fns]
+    ret = []
+    for clips in groups:
+        try:
+            ret.append(([(fn, rig_for(rigs, fn, role)[0]) for role, fn in roles(clips).items()], None))
+        except SceneError as e:
+            ret.append(([(fn, None) for role, fn in clips], str(e)))
+    return ret
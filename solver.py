@@ -0,0 +1,229 @@
+import numpy as np
+
+import anm
+import mapping
+from kernel import *
+
+# Headless version of TransferPoseCommon. Works on whole clips at once.
+#
+# Spaces:
+# - Unity: local space of .anm and .model data
+# - Transfer: the space bone_anim_basis works in, the same as tpose_basis.json
+#
+# cm_basis and kk_basis are tpose.TPoseBasis objects.
+
+# Configs
+
+anm_fps = 60 # Frames per second of .anm key times
+cm_import_scale = 5 # Scale the converter applies when importing CM bodies
+scale_cm_to_kk = 0.2
+# Unity (left handed, Y up) to Blender (right handed, Z up)
+unity_to_blender = np.array((
+    (-1, 0, 0),
+    (0, 0, -1),
+    (0, 1, 0),
+    ), dtype=np.float64)
+
+def clip_frames(clip, fps=anm_fps):
+    return np.arange(int(round(clip.duration() * fps)) + 1)
+
+def fill_gaps(frames, max_gap):
+    # Adds evenly spaced frames so no two consecutive ones are more than max_gap apart
+    frames = np.unique(np.asarray(frames, dtype=np.int64))
+    if not max_gap or len(frames) < 2:
+        return frames
+    extra = []
+    for a, d in zip(frames[:-1], np.diff(frames)):
+        if d > max_gap:
+            k = -(-d // max_gap)
+            extra.append(a + np.round(np.arange(1, k) * d / k).astype(np.int64))
+    return np.unique(np.concatenate([frames] + extra))
+
+def key_frames(clip, max_gap=None, fps=anm_fps):
+    # Frames the clip has keys on, plus the first and last frame
+    last = clip_frames(clip, fps)[-1]
+    times = [t.key_times() for t in clip.tracks.values()]
+    frames = np.round(np.concatenate(times + [np.zeros(1)]) * fps).astype(np.int64)
+    return fill_gaps(np.append(np.clip(frames, 0, last), last), max_gap)
+
+def sample_channel(keys, times):
+    # Hermite interpolation between keys, constant outside the key range
+    t = keys[:, 0].astype(np.float64)
+    v = keys[:, 1].astype(np.float64)
+    if len(t) == 1:
+        return np.full(times.shape, v[0])
+    i = np.clip(np.searchsorted(t, times, side='right') - 1, 0, len(t) - 2)
+    dt = t[i + 1] - t[i]
+    dt_safe = np.where(dt > 0, dt, 1)
+    s = np.clip((times - t[i]) / dt_safe, 0, 1)
+    s2 = s * s
+    s3 = s2 * s
+    m0 = keys[i, 3] * dt
+    m1 = keys[i + 1, 2] * dt
+    return ((2 * s3 - 3 * s2 + 1) * v[i] + (s3 - 2 * s2 + s) * m0
+        + (-2 * s3 + 3 * s2) * v[i + 1] + (s3 - s2) * m1)
+
+def sample_clip(clip, skeleton, times):
+    # Local rotations (w x y z) and locations of every skeleton bone at times
+    n_frames = len(times)
+    rot = np.empty((n_frames, len(skeleton.names), 4))
+    rot[:] = skeleton.rot[:, [3, 0, 1, 2]]
+    loc = np.empty((n_frames, len(skeleton.names), 3))
+    loc[:] = skeleton.loc
+    for track in clip.tracks.values():
+        b = skeleton.index.get(track.name)
+        if b is None:
+            continue
+        if all(c in track.channels for c in anm.channel_rot):
+            for j, c in zip((1, 2, 3, 0), anm.channel_rot):
+                rot[:, b, j] = sample_channel(track.channels[c], times)
+        for j, c in enumerate(anm.channel_loc):
+            if c in track.channels:
+                loc[:, b, j] = sample_channel(track.channels[c], times)
+    return rot, loc
+
+def resample(times, rot, loc, target_times):
+    # Sampled local poses at times, any spacing, to target_times: SLERP for
+    # rotations (w x y z) and linear for locations, all bones at once.
+    # Constant outside the sampled range like sample_channel.
+    times = np.asarray(times, dtype=np.float64)
+    target_times = np.asarray(target_times, dtype=np.float64)
+    rot = np.asarray(rot, dtype=np.float64)
+    loc = np.asarray(loc, dtype=np.float64)
+    if len(times) == 1:
+        return np.repeat(rot, len(target_times), 0), np.repeat(loc, len(target_times), 0)
+    i = np.clip(np.searchsorted(times, target_times, side='right') - 1, 0, len(times) - 2)
+    s = np.clip((target_times - times[i]) / (times[i + 1] - times[i]), 0, 1)[:, None]
+    return slerp(rot[i], rot[i + 1], s), loc[i] + (loc[i + 1] - loc[i]) * s[..., None]
+
+def forward_kinematics(skeleton, rot, loc):
+    # Global rotation matrices and positions in Unity space
+    local = quat_to_matrix(rot)
+    g_rot = np.empty_like(local)
+    g_loc = np.empty_like(loc)
+    for b in skeleton.order:
+        p = skeleton.parents[b]
+        if p < 0:
+            g_rot[..., b, :, :] = local[..., b, :, :]
+            g_loc[..., b, :] = loc[..., b, :]
+        else:
+            g_rot[..., b, :, :] = g_rot[..., p, :, :] @ local[..., b, :, :]
+            g_loc[..., b, :] = g_loc[..., p, :] + (g_rot[..., p, :, :] @ loc[..., b, :, None])[..., 0]
+    return g_rot, g_loc
+
+class CMPose:
+    # Posed CM armature in transfer space for a batch of frames
+    def __init__(self, skeleton, cm_basis, delta, head):
+        self.skeleton = skeleton
+        self.cm_basis = cm_basis
+        self.delta = delta # (frames, bones, 3, 3) rotation from T-pose
+        self.head = head # (frames, bones, 3)
+
+    def basis(self, cm_bone_name):
+        # Same as bone_anim_basis on the CM armature
+        b = self.skeleton.index[cm_bone_name]
+        return self.delta[:, b] @ self.cm_basis.basis[self.cm_basis.index[cm_bone_name]]
+
+    def bone_head(self, cm_bone_name):
+        return self.head[:, self.skeleton.index[cm_bone_name]]
+
+    def bone_tail(self, cm_bone_name):
+        # Bones are rigid so the T-pose head to tail vector just rotates
+        b = self.skeleton.index[cm_bone_name]
+        i = self.cm_basis.index[cm_bone_name]
+        offset = self.cm_basis.tail[i] - self.cm_basis.head[i]
+        return self.head[:, b] + (self.delta[:, b] @ offset[:, None])[..., 0]
+
+def rest_rotation(skeleton):
+    # T-pose is the rest pose of the skeleton
+    rest_rot, rest_loc = forward_kinematics(skeleton, skeleton.rot[:, [3, 0, 1, 2]], skeleton.loc)
+    return rest_rot
+
+def cm_pose(clip, skeleton, cm_basis, frames, fps=anm_fps, rest_rot=None):
+    rot, loc = sample_clip(clip, skeleton, np.asarray(frames, dtype=np.float64) / fps)
+    return local_pose(skeleton, cm_basis, rot, loc, rest_rot)
+
+def local_pose(skeleton, cm_basis, rot, loc, rest_rot=None):
+    # From sampled local rotations (w x y z) and locations, e.g. a corpus clip
+    if rest_rot is None:
+        rest_rot = rest_rotation(skeleton)
+    rot = np.asarray(rot, dtype=np.float64)
+    loc = np.asarray(loc, dtype=np.float64)
+    g_rot, g_loc = forward_kinematics(skeleton, rot, loc)
+    # [T] = [cur_rot_global] [t_pose_rot_global]^-1, moved into transfer space
+    delta = conjugate(g_rot @ np.swapaxes(rest_rot, -1, -2), unity_to_blender)
+    head = (g_loc @ unity_to_blender.T) * (cm_import_scale * scale_cm_to_kk)
+    return CMPose(skeleton, cm_basis, delta, head)
+
+def transfer_rotation(pose, kk_basis, cm_bone_name, kk_bone_name):
+    # [kk_rot_global] = [T] [kk_t_pose_rot_global] for every frame
+    b = pose.skeleton.index[cm_bone_name]
+    return pose.delta[:, b] @ kk_basis.basis[kk_basis.index[kk_bone_name]]
+
+def ik_target(pose, cm_bone_name, cm_from_bone_name, lerp=0):
+    # Where the ik_target op puts the KK bone, in transfer space, every frame:
+    # the joint pushed one unit away from the bend
+    head = pose.bone_head(cm_bone_name)
+    joint = head + (pose.bone_tail(cm_bone_name) - head) * lerp
+    away = pose.basis(cm_from_bone_name)[..., :, 1] - pose.basis(cm_bone_name)[..., :, 1]
+    return joint + normalized(away)
+
+# Streaming. Memory is bounded by chunk_size whatever the clip length and the
+# first chunk is ready before later frames are sampled. kkrig.stream solves
+# the chunks and writes them with kktracks.TrackWriter.
+
+chunk_size = 256
+
+def iter_cm_pose(clip, skeleton, cm_basis, frames=None, fps=anm_fps, chunk_size=chunk_size):
+    if frames is None:
+        frames = clip_frames(clip, fps)
+    frames = np.asarray(frames)
+    rest_rot = rest_rotation(skeleton)
+    for i in range(0, len(frames), chunk_size):
+        chunk = frames[i:i + chunk_size]
+        yield chunk, cm_pose(clip, skeleton, cm_basis, chunk, fps, rest_rot)
+
+# Whole mapping without Blender, on a kkrig.KKPose for the KK side
+
+def solve_op(pose, kk_pose, kk_basis, op):
+    # Same write as PoseTransfer.solve_op, for every frame at once
+    if op.op in ('location', 'pole', 'ik_target'):
+        if op.op == 'location':
+            head = pose.bone_head(op.cm)
+            move = head + (pose.bone_tail(op.cm) - head) * op.lerp - kk_pose.bone_head(op.kk)
+        elif op.op == 'pole':
+            away = pose.basis(op.cm_from)[..., :, 1] - pose.basis(op.cm)[..., :, 1]
+            move = normalized(away)
+        else:
+            move = ik_target(pose, op.cm, op.cm_from, op.lerp) - kk_pose.bone_head(op.kk)
+        # Location writes leave btb as it is
+        btb = kk_pose.transform_basis(op.kk)
+        i = kk_pose.rig.index[op.kk]
+        return kk_pose.location[:, i] + (np.linalg.inv(btb) @ move[..., None])[..., 0]
+    btb = kk_pose.transform_basis(op.kk)
+    if op.op == 'rotation':
+        return local_rotation(btb, transfer_rotation(pose, kk_basis, op.cm, op.kk))
+    if op.op == 'orientation':
+        return match_orientation(btb, pose.basis(op.cm), op.roll or 0)
+    return match_leg_fk_roll(btb, pose.basis(op.cm), np.nan if op.roll is None else op.roll)
+
+def solve_mapping(pose, kk_pose, kk_basis, m):
+    # Runs the mapping's levels like transfer_mapped: all reads of a level
+    # before its writes. Returns (bone_name, data_path) -> (frames, n) values
+    # of the writes and the ops left out because the rig cannot evaluate them.
+    # ik_fk switches only change constraints, which kk_pose does not model.
+    writes = {}
+    skipped = []
+    for ops in m.levels():
+        level = []
+        for op in ops:
+            if op.op == 'ik_fk':
+                continue
+            if not kk_pose.rig.supports(op):
+                skipped.append(op)
+                continue
+            level.append((op.kk, mapping.write_paths[op.op], solve_op(pose, kk_pose, kk_basis, op)))
+        for bone_name, data_path, value in level:
+            kk_pose.set(bone_name, data_path, value)
+            writes[(bone_name, data_path)] = value
+    return writes, skipped
@@ -0,0 +1,28 @@
+import pytest
+
+import batch
+
+def touch(fn):
+    fn.parent.mkdir(parents=True, exist_ok=True)
+    fn.write_bytes(b'')
+    return fn
+
+def test_find_anms(tmp_path):
+    touch(tmp_path / 'a' / 'x.anm')
+    touch(tmp_path / 'a' / 'y.anm')
+    touch(tmp_path / 'a' / 'notes.txt')
+    found = batch.find_anms([str(tmp_path / 'a'), str(tmp_path / 'a' / 'x.anm')])
+    assert sorted(batch.action_name(f) for f in found) == ['x.anm', 'y.anm']
+
+def test_find_anms_same_name(tmp_path):
+    touch(tmp_path / 'a' / 'x.anm')
+    touch(tmp_path / 'b' / 'x.anm')
+    with pytest.raises(batch.ClipNameError):
+        batch.find_anms([str(tmp_path)])
+
+def test_blender_cmd_fails_on_script_errors():
+    cmd = batch.blender_cmd('blender', 'scene.blend', 'merge', 'out')
+    # Options after -P would not apply to the script
+    assert cmd.index('--python-exit-code') < cmd.index('-P')
+    assert cmd[cmd.index('--python-exit-code') + 1] == '1'
+    assert cmd[cmd.index('--') + 1:] == ['merge', 'out']
@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+import converted
+
+@pytest.fixture
+def files(tmp_path):
+    anm_fn = tmp_path / 'clip.anm'
+    anm_fn.write_bytes(b'clip')
+    basis_fn = tmp_path / 'basis.json'
+    basis_fn.write_text('{}')
+    mapping_fn = tmp_path / 'mapping.json'
+    mapping_fn.write_text(json.dumps({'cm_arm': 'cm', 'kk_arm': 'kk', 'tpose_basis': 'basis.json', 'ops': []}))
+    return str(anm_fn), basis_fn, str(mapping_fn), str(tmp_path / 'index.jsonl')
+
+def counted_sha1(monkeypatch):
+    # Files hashed through converted.file_sha1
+    hashed = []
+    file_sha1 = converted.file_sha1
+    def counting(fn):
+        hashed.append(fn)
+        return file_sha1(fn)
+    monkeypatch.setattr(converted, 'file_sha1', counting)
+    return hashed
+
+def test_done_after_rerun(files, monkeypatch):
+    anm_fn, basis_fn, mapping_fn, index_fn = files
+    index = converted.ConvertedIndex(index_fn)
+    assert not index.is_done(anm_fn, mapping_fn)
+    index.mark_done(anm_fn, mapping_fn)
+    hashed = counted_sha1(monkeypatch)
+    index = converted.ConvertedIndex(index_fn)
+    assert index.is_done(anm_fn, mapping_fn)
+    assert index.is_done(anm_fn, mapping_fn)
+    # Same size and mtime, the clip hash is reused, basis and mapping once
+    assert anm_fn not in hashed and len(hashed) == 2
+
+@pytest.mark.parametrize('changed', ['anm', 'basis', 'mapping'])
+def test_changed_file_invalidates(files, changed):
+    anm_fn, basis_fn, mapping_fn, index_fn = files
+    converted.ConvertedIndex(index_fn).mark_done(anm_fn, mapping_fn)
+    if changed == 'anm':
+        with open(anm_fn, 'wb') as f:
+            f.write(b'other clip')
+    elif changed == 'basis':
+        basis_fn.write_text('{"a": 1}')
+    else:
+        with open(mapping_fn, 'a') as f:
+            f.write('\n')
+    assert not converted.ConvertedIndex(index_fn).is_done(anm_fn, mapping_fn)
+
+def test_options_invalidate(files):
+    anm_fn, basis_fn, mapping_fn, index_fn = files
+    converted.ConvertedIndex(index_fn, ['tracks']).mark_done(anm_fn, mapping_fn)
+    assert converted.ConvertedIndex(index_fn, ['tracks']).is_done(anm_fn, mapping_fn)
+    assert not converted.ConvertedIndex(index_fn).is_done(anm_fn, mapping_fn)
+    assert not converted.ConvertedIndex(index_fn, ['tracks', 'reduce']).is_done(anm_fn, mapping_fn)
+
+def test_compact(files):
+    anm_fn, basis_fn, mapping_fn, index_fn = files
+    index = converted.ConvertedIndex(index_fn)
+    for i in range(3):
+        index.mark_done(anm_fn, mapping_fn)
+    with open(index_fn) as f:
+        assert len(f.readlines()) == 3
+    index.compact()
+    with open(index_fn) as f:
+        assert len(f.readlines()) == 1
+    assert converted.ConvertedIndex(index_fn).is_done(anm_fn, mapping_fn)
@@ -0,0 +1,76 @@
+import json
+import threading
+
+import jobs
+
+def test_errors_start_failed(tmp_path):
+    status_fn = str(tmp_path / 'status.json')
+    q = jobs.JobQueue([[('a', 'm')], [('b', None)], [('c', 'm')]], 0, status_fn, errors=[None, 'no rig', None])
+    assert [q.take().id, q.take().id, q.take()] == [0, 2, None]
+    assert q.jobs[1].state == jobs.failed and q.jobs[1].attempts == 0
+    with open(status_fn) as f:
+        assert json.loads(f.read())['jobs'][1]['error'] == 'no rig'
+
+def clip_lists(n):
+    return [[(f'{i}.anm', 'mapping.json')] for i in range(n)]
+
+def test_retry():
+    q = jobs.JobQueue(clip_lists(2), retries=1)
+    a = q.take()
+    q.fail(a, 'crashed')
+    # Retried after the other job
+    b = q.take()
+    assert b.id == 1 and a.state == jobs.queued
+    q.finish(b)
+    assert q.take() is a and a.attempts == 2
+    q.fail(a, 'crashed again')
+    assert a.state == jobs.failed and a.error == 'crashed again'
+    assert q.take() is None and q.is_finished()
+    assert q.counts()[jobs.failed] == 1 and q.counts()[jobs.done] == 1
+
+def test_retry_success_clears_error():
+    q = jobs.JobQueue(clip_lists(1), retries=2)
+    q.fail(q.take(), 'crashed')
+    job = q.take()
+    q.finish(job)
+    assert job.state == jobs.done and job.error is None and job.attempts == 2
+
+def test_cancel():
+    progress = []
+    q = jobs.JobQueue(clip_lists(3), on_progress=progress.append)
+    running = q.take()
+    q.cancel()
+    assert q.take() is None
+    assert [job.state for job in q.jobs] == [jobs.running, jobs.cancelled, jobs.cancelled]
+    assert not q.is_finished()
+    # A runner failing its job after a cancel does not requeue it
+    q.fail(running, 'stopped')
+    assert running.state == jobs.failed and q.is_finished()
+    assert progress[-1]['counts'][jobs.cancelled] == 2
+
+def test_cancel_running():
+    q = jobs.JobQueue(clip_lists(2))
+    job = q.take()
+    q.cancel([job])
+    assert [j.state for j in q.jobs] == [jobs.cancelled, jobs.cancelled]
+    assert q.is_finished()
+    # Not requeued or turned into a failure by a late fail
+    q.fail(job, 'stopped')
+    assert job.state == jobs.cancelled and q.take() is None
+
+def test_status_file_from_threads(tmp_path):
+    # The last write is the final state, whatever order the workers end in
+    status_fn = str(tmp_path / 'status.json')
+    q = jobs.JobQueue(clip_lists(200), 0, status_fn)
+    def work():
+        job = q.take()
+        while job is not None:
+            q.finish(job)
+            job = q.take()
+    workers = [threading.Thread(target=work) for i in range(8)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    with open(status_fn) as f:
+        assert json.loads(f.read())['counts']['done'] == 200
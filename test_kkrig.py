@@ -0,0 +1,85 @@
+import numpy as np
+
+import bench
+import kkrig
+import kktracks
+import mapping
+import tpose
+from kernel import *
+
+def test_anim_basis_at_rest():
+    m = mapping.load('mapping_female.json')
+    kk_basis = tpose.load(m.tpose_basis)[m.kk_arm]
+    rig = bench.synthetic_rig(kk_basis)
+    pose = kkrig.KKPose(rig, 2)
+    name = kk_basis.names[3]
+    np.testing.assert_allclose(pose.anim_basis(name)[0], kkrig.axis_permutation @ rig.rest_rot[3], atol=1e-12)
+    np.testing.assert_allclose(pose.bone_head(name)[1], kk_basis.head[3], atol=1e-6)
+
+def test_stream_matches_convert(tmp_path):
+    m = mapping.load('mapping_female.json')
+    bases = tpose.load(m.tpose_basis)
+    skeleton = bench.synthetic_skeleton(bases[m.cm_arm])
+    anm_fn = tmp_path / 'clip.anm'
+    anm_fn.write_bytes(bench.synthetic_anm(skeleton, 1))
+    rig = bench.synthetic_rig(bases[m.kk_arm])
+    tracks, skipped = kkrig.convert(str(anm_fn), skeleton, m, bases, rig, 30, stride=2)
+    out_fn = str(tmp_path / 'clip.anm.kk.npz')
+    assert kkrig.stream(str(anm_fn), out_fn, skeleton, m, bases, rig, 30, stride=2, chunk_size=4) == skipped
+    streamed = kktracks.load(out_fn)
+    assert list(streamed.tracks) == list(tracks.tracks)
+    for key, (frames, values) in tracks.tracks.items():
+        np.testing.assert_array_equal(streamed.tracks[key][0], frames)
+        np.testing.assert_allclose(streamed.tracks[key][1], values, atol=1e-6)
+
+def chain_rig():
+    # root -> arm -> hand, rest rotations turned about different axes
+    rest_rot = np.stack([quat_to_matrix(axis_quat(a, i)) for a, i in ((0.3, 2), (np.pi / 2, 0), (-0.4, 1))])
+    rest_head = np.array([(0, 0, 1.0), (0, 0, 2), (0, 1, 2)])
+    return kkrig.KKRig(['root', 'arm', 'hand'], [-1, 0, 1], rest_rot, rest_head, [True] * 3)
+
+def matrix4(rot, loc):
+    ret = np.eye(4)
+    ret[:3, :3] = rot
+    ret[:3, 3] = loc
+    return ret
+
+def test_chain_pose():
+    rig = chain_rig()
+    pose = kkrig.KKPose(rig, 1)
+    rotations = [axis_quat(a, i) for a, i in ((0.5, 0), (0.7, 2), (-0.2, 1))]
+    locations = [(0.1, 0, 0), (0, 0.2, 0), (0, 0, 0.3)]
+    for name, q, loc in zip(rig.names, rotations, locations):
+        pose.set(name, 'rotation_quaternion', q)
+        pose.set(name, 'location', loc)
+    # M = M_parent @ rest_parent^-1 @ rest @ basis, with 4x4 matrices
+    rest = [matrix4(r, h) for r, h in zip(rig.rest_rot, rig.rest_head)]
+    basis = [matrix4(quat_to_matrix(q), loc) for q, loc in zip(rotations, locations)]
+    m_root = rest[0] @ basis[0]
+    m_arm = m_root @ np.linalg.inv(rest[0]) @ rest[1] @ basis[1]
+    m_hand = m_arm @ np.linalg.inv(rest[1]) @ rest[2] @ basis[2]
+    p = kkrig.axis_permutation
+    for name, m in (('root', m_root), ('arm', m_arm), ('hand', m_hand)):
+        np.testing.assert_allclose(pose.bone_head(name)[0], m[:3, 3] @ p.T, atol=1e-12)
+        np.testing.assert_allclose(pose.anim_basis(name)[0], p @ m[:3, :3], atol=1e-12)
+    # Without the bone's own rotation
+    btb = m_arm @ np.linalg.inv(rest[1]) @ rest[2]
+    np.testing.assert_allclose(pose.transform_basis('hand')[0], p @ btb[:3, :3], atol=1e-12)
+    np.testing.assert_allclose(pose.transform_basis('root')[0], p @ rig.rest_rot[0], atol=1e-12)
+
+def test_chain_rest_head():
+    # At rest the hand is where the rig puts it, in transfer space
+    pose = kkrig.KKPose(chain_rig(), 1)
+    np.testing.assert_allclose(pose.bone_head('hand')[0], (0, -2, 1), atol=1e-12)
+
+def test_set_invalidates_descendants():
+    rig = chain_rig()
+    pose = kkrig.KKPose(rig, 1)
+    pose.evaluate(['hand'])
+    assert pose.valid.all()
+    before = pose.bone_head('hand').copy()
+    pose.set('arm', 'rotation_quaternion', axis_quat(0.5, 0))
+    np.testing.assert_array_equal(pose.valid, (True, False, False))
+    assert not np.allclose(pose.bone_head('hand'), before)
+    pose.set('hand', 'location', (0, 0, 1))
+    np.testing.assert_array_equal(pose.valid, (True, True, False))
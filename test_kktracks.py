@@ -0,0 +1,87 @@
+import numpy as np
+
+import kktracks
+
+def sample_tracks():
+    t = kktracks.Tracks('kk', 30)
+    frames = np.arange(10)
+    t.add('a', 'location', frames, np.random.default_rng(0).normal(size=(10, 3)))
+    t.add('b', 'rotation_quaternion', frames[::2], np.tile((1, 0, 0, 0), (5, 1)))
+    return t
+
+def test_save_load(tmp_path):
+    t = sample_tracks()
+    back = kktracks.load(kktracks.save(t, str(tmp_path / 'x.kk.npz')))
+    assert (back.arm_name, back.fps) == ('kk', 30)
+    for key, (frames, values) in t.tracks.items():
+        np.testing.assert_array_equal(back.tracks[key][0], frames)
+        np.testing.assert_array_equal(back.tracks[key][1], values)
+
+def test_writer_matches_save(tmp_path):
+    t = sample_tracks()
+    w = kktracks.TrackWriter(str(tmp_path / 'x.kk.npz'), 'kk', 30)
+    for lo, hi in ((0, 3), (3, 7), (7, 10)):
+        for key, (frames, values) in t.tracks.items():
+            keep = (frames >= lo) & (frames < hi)
+            if keep.any():
+                w.add(*key, frames[keep], values[keep])
+    back = kktracks.load(w.close())
+    assert list(back.tracks) == list(t.tracks)
+    for key, (frames, values) in t.tracks.items():
+        np.testing.assert_array_equal(back.tracks[key][0], frames)
+        np.testing.assert_array_equal(back.tracks[key][1], values)
+    # Only the output is left
+    assert [p.name for p in tmp_path.iterdir()] == ['x.kk.npz']
+
+def test_resample_halves_frames():
+    t = kktracks.resample(sample_tracks(), 15)
+    frames, values = t.tracks[('a', 'location')]
+    np.testing.assert_array_equal(frames, np.arange(5))
+    np.testing.assert_allclose(values, sample_tracks().tracks[('a', 'location')][1][::2], atol=1e-6)
+
+# Key reduction
+
+def interpolate(key_frames, key_values, frames, quat):
+    # What the action plays between the kept keys, per channel like Blender
+    out = np.stack([np.interp(frames, key_frames, c) for c in key_values.T], axis=-1)
+    if quat:
+        out /= np.linalg.norm(out, axis=-1, keepdims=True)
+    return out
+
+def smooth_track(quat, seed=0):
+    frames = np.arange(60.0)
+    noise = np.random.default_rng(seed).normal(0, 0.05, (60, 4)).cumsum(0)
+    if not quat:
+        return frames, noise[:, :3]
+    q = np.array((1.0, 0, 0, 0)) + noise * 0.2
+    return frames, q / np.linalg.norm(q, axis=-1, keepdims=True)
+
+def test_reduce_static_track():
+    t = kktracks.reduce(sample_tracks(), 0.01, 0.01)
+    frames, values = t.tracks[('b', 'rotation_quaternion')]
+    np.testing.assert_array_equal(frames, (0, 8))
+    np.testing.assert_array_equal(values, [(1, 0, 0, 0)] * 2)
+
+def test_reduce_within_tolerance():
+    for quat, tol in ((False, 0.02), (True, np.radians(0.5))):
+        frames, values = smooth_track(quat)
+        keep = kktracks.reduce_keys(frames, values, tol, quat)
+        assert keep[0] and keep[-1] and 2 < keep.sum() < len(frames)
+        approx = interpolate(frames[keep], values[keep], frames, quat)
+        if quat:
+            err = 2 * np.arccos(np.clip(np.abs((approx * values).sum(-1)), 0, 1))
+        else:
+            err = np.linalg.norm(approx - values, axis=-1)
+        assert err.max() <= tol + 1e-9
+        # Kept keys are played exactly
+        assert err[keep].max() < 1e-6
+
+def test_reduce_candidates():
+    frames, values = smooth_track(False)
+    candidates = frames[::5]
+    # Without candidates other frames are picked
+    assert not set(frames[kktracks.reduce_keys(frames, values, 0.02)]) <= set(candidates)
+    keep = kktracks.reduce_keys(frames, values, 0.02, candidates=candidates)
+    kept = frames[keep]
+    assert set(kept[1:-1]) <= set(candidates)
+    assert kept[0] == frames[0] and kept[-1] == frames[-1]
@@ -0,0 +1,54 @@
+import mapping
+
+def make(ops):
+    return mapping.Mapping('cm', 'kk', '', [mapping.Op(**op) for op in ops])
+
+def names(levels):
+    return [[(op.op, op.kk) for op in level] for level in levels]
+
+def test_schedule_independent_ops_share_a_level():
+    m = make([
+        {'op': 'rotation', 'kk': 'a', 'cm': 'A'},
+        {'op': 'rotation', 'kk': 'b', 'cm': 'B'},
+    ])
+    assert names(m.schedule({'a': set(), 'b': set()})) == [[('rotation', 'a'), ('rotation', 'b')]]
+
+def test_schedule_follows_deps():
+    m = make([
+        {'op': 'rotation', 'kk': 'child', 'cm': 'C'},
+        {'op': 'rotation', 'kk': 'parent', 'cm': 'P'},
+        {'op': 'location', 'kk': 'parent', 'cm': 'P'},
+        {'op': 'rotation', 'kk': 'child', 'cm': 'C', 'level': 1},
+    ])
+    deps = {'child': {'parent'}, 'parent': set()}
+    assert names(m.schedule(deps)) == [
+        # child's first write must still see parent before it moves
+        [('rotation', 'child'), ('rotation', 'parent'), ('location', 'parent')],
+        [('rotation', 'child')],
+    ]
+
+def test_schedule_same_path_writes_stay_ordered():
+    m = make([
+        {'op': 'orientation', 'kk': 'a', 'cm': 'A'},
+        {'op': 'fk_roll', 'kk': 'a', 'cm': 'A'},
+    ])
+    assert len(m.schedule({'a': set()})) == 2
+
+def test_schedule_keeps_switch_order():
+    m = make([
+        {'op': 'ik_fk', 'kk': 'switch.L', 'value': 0},
+        {'op': 'rotation', 'kk': 'a', 'cm': 'A'},
+        {'op': 'ik_fk', 'kk': 'switch.R', 'value': 1},
+        {'op': 'rotation', 'kk': 'b', 'cm': 'B'},
+    ])
+    assert names(m.schedule({'a': set(), 'b': set()})) == [
+        [('ik_fk', 'switch.L'), ('rotation', 'a')],
+        [('ik_fk', 'switch.R'), ('rotation', 'b')],
+    ]
+
+def test_schedule_shipped_mappings():
+    for fn in ('mapping_female.json', 'mapping_male.json'):
+        m = mapping.load(fn)
+        levels = m.schedule({})
+        assert [op for level in levels for op in level if op.op == 'ik_fk'] == [op for op in m.ops if op.op == 'ik_fk']
+        assert all(op.op == 'ik_fk' for op in levels[0][:2])
@@ -0,0 +1,62 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import bench
+import kkrig
+import scene
+import tpose
+
+rigs = {'f': ('female.json', None), 'm': ('male.json', None)}
+
+def test_split_role():
+    assert scene.split_role('a/h_kiss_f.anm') == ('a/h_kiss_*.anm', 'f')
+    assert scene.split_role('a/dance_f1_01.anm') == ('a/dance_*_01.anm', 'f')
+    assert scene.split_role('a/dance_f2_01.anm') == ('a/dance_*_01.anm', 'f2')
+    assert scene.split_role('a/idle.anm') == ('a/idle.anm', 'f')
+
+def test_group_same_role():
+    with pytest.raises(scene.SceneError):
+        scene.group(['x_f.anm', 'x_f1.anm'])
+
+def test_jobs():
+    jobs = scene.jobs(['h_kiss_f.anm', 'x_f.anm', 'h_kiss_m.anm', 'x_f1.anm', 'd_f2.anm'], rigs)
+    assert jobs[0] == ([('h_kiss_f.anm', 'female.json'), ('h_kiss_m.anm', 'male.json')], None)
+    # Broken scenes fail on their own
+    clips, error = jobs[1]
+    assert clips == [('x_f.anm', None), ('x_f1.anm', None)]
+    assert 'both play role f' in error
+    clips, error = jobs[2]
+    assert clips == [('d_f2.anm', None)] and 'No rig for role f2' in error
+
+def test_jobs_one_clip_each():
+    jobs = scene.jobs(['h_kiss_f.anm', 'h_kiss_m.anm', 'd_f2.anm'], rigs, scenes=False)
+    assert [error is None for clips, error in jobs] == [True, True, False]
+    assert jobs[1][0] == [('h_kiss_m.anm', 'male.json')]
+
+def test_load_rigs_override(tmp_path):
+    # An extra character drives other armatures with the female mapping's
+    # T-pose basis, still keyed by the mapping file's own armature names
+    rigs_fn = tmp_path / scene.rigs_fn
+    rigs_fn.write_text(json.dumps({
+        'f': os.path.abspath('mapping_female.json'),
+        'f2': {'mapping': os.path.abspath('mapping_female.json'), 'cm_arm': 'body001.armature.001', 'kk_arm': 'combined.002'},
+    }))
+    loaded = scene.load_rigs(str(rigs_fn))
+    f, f2 = loaded['f'][1], loaded['f2'][1]
+    assert (f2.cm_arm, f2.kk_arm) == ('body001.armature.001', 'combined.002')
+    assert (f2.cm_basis_arm, f2.kk_basis_arm) == (f.cm_arm, f.kk_arm)
+    assert f2.preview().kk_basis_arm == f.kk_arm
+    # Bound like kkrig.convert does, same solve onto the other armature
+    bases = tpose.load(f2.tpose_basis)
+    skeleton = bench.synthetic_skeleton(bases[f2.cm_basis_arm])
+    anm_fn = tmp_path / 'clip.anm'
+    anm_fn.write_bytes(bench.synthetic_anm(skeleton, 0.2))
+    rig = bench.synthetic_rig(bases[f2.kk_basis_arm])
+    tracks, skipped = kkrig.convert(str(anm_fn), skeleton, f2, bases, rig)
+    expected, skipped = kkrig.convert(str(anm_fn), skeleton, f, bases, rig)
+    assert tracks.arm_name == 'combined.002'
+    for key, (frames, values) in expected.tracks.items():
+        np.testing.assert_array_equal(tracks.tracks[key][1], values)
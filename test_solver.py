@@ -0,0 +1,207 @@
+import struct
+
+import numpy as np
+import pytest
+
+import anm
+import batch
+import bench
+import corpus
+import mapping
+import solver
+import tpose
+from kernel import *
+
+# Headless parts only, run with python -m pytest next to this file
+
+@pytest.fixture(scope='module')
+def bases():
+    m = mapping.load('mapping_female.json')
+    return m, tpose.load(m.tpose_basis)
+
+@pytest.fixture(scope='module')
+def skeleton(bases):
+    m, b = bases
+    return bench.synthetic_skeleton(b[m.cm_arm])
+
+def random_quats(n, seed=0):
+    q = np.random.default_rng(seed).normal(size=(n, 4))
+    return q / np.linalg.norm(q, axis=-1, keepdims=True)
+
+def same_rotation(a, b):
+    # Quaternions q and -q are the same rotation
+    return np.abs(np.abs((a * b).sum(-1)) - 1).max()
+
+# .anm parsing and sampling
+
+def anm_bytes(tracks):
+    # tracks: [(bone path, {channel id: (n, 4) keys})]
+    out = [bench.anm_str('CM3D2_ANIM'), struct.pack('<i', 1001)]
+    for path, channels in tracks:
+        out.append(b'\x01' + bench.anm_str(path))
+        for channel_id, keys in channels.items():
+            keys = np.asarray(keys, dtype='<f4')
+            out.append(struct.pack('<Bi', channel_id, len(keys)) + keys.tobytes())
+    out.append(b'\x00')
+    return b''.join(out)
+
+def test_anm_round_trip():
+    keys = np.array([(0, 0.5, 0, 0), (0.5, 1, 0.1, -0.1), (1, -2, 0, 0)], dtype=np.float32)
+    clip = anm.parse_anm(anm_bytes([('Bip01/Bip01 Pelvis', {104: keys, 105: keys[:1]})]))
+    assert clip.version == 1001
+    track = clip.tracks['Bip01 Pelvis']
+    assert track.path == 'Bip01/Bip01 Pelvis'
+    np.testing.assert_array_equal(track.channels[104], keys)
+    np.testing.assert_array_equal(track.channels[105], keys[:1])
+    assert clip.duration() == 1
+
+def test_anm_rejects_other_files():
+    with pytest.raises(anm.AnmFormatError):
+        anm.parse_anm(bench.anm_str('CM3D2_MESH') + b'\0' * 8)
+    with pytest.raises(anm.AnmFormatError):
+        anm.parse_anm(anm_bytes([('Bip01', {104: np.zeros((2, 4))})])[:-20])
+
+def test_synthetic_clip_parses(skeleton):
+    clip = anm.parse_anm(bench.synthetic_anm(skeleton, 1))
+    assert set(clip.tracks) == set(skeleton.names)
+    assert len(solver.clip_frames(clip)) == solver.anm_fps + 1
+    root = clip.tracks[skeleton.names[0]]
+    assert all(c in root.channels for c in anm.channel_rot + anm.channel_loc)
+
+def test_sample_channel():
+    keys = np.array([(0, 1, 0, 0), (1, 3, 0, 0)], dtype=np.float32)
+    # Key values at key times, flat tangents give a smoothstep between
+    np.testing.assert_allclose(solver.sample_channel(keys, np.array([0, 1])), [1, 3])
+    np.testing.assert_allclose(solver.sample_channel(keys, np.array([0.5])), [2])
+    np.testing.assert_allclose(solver.sample_channel(keys, np.array([0.25])), [1 + 2 * (3 * 0.25 ** 2 - 2 * 0.25 ** 3)])
+    # Constant outside the keys
+    np.testing.assert_allclose(solver.sample_channel(keys, np.array([-1, 2])), [1, 3])
+    np.testing.assert_allclose(solver.sample_channel(keys[:1], np.array([0, 5])), [1, 1])
+
+# Key frames
+
+def test_fill_gaps():
+    frames = solver.fill_gaps([0, 3, 20, 21], 5)
+    assert frames[0] == 0 and frames[-1] == 21
+    assert set((0, 3, 20, 21)) <= set(frames)
+    assert np.diff(frames).max() <= 5
+    # 17 frames apart take ceil(17 / 5) = 4 even steps
+    np.testing.assert_array_equal(frames, (0, 3, 7, 11, 16, 20, 21))
+
+def test_fill_gaps_without_max_gap():
+    for max_gap in (0, None):
+        np.testing.assert_array_equal(solver.fill_gaps([10, 0, 40, 10], max_gap), (0, 10, 40))
+
+def test_key_frames():
+    keys = np.array([(0.1, 0, 0, 0), (0.5, 0, 0, 0), (1, 0, 0, 0)], dtype=np.float32)
+    clip = anm.parse_anm(anm_bytes([('Bip01', {100: keys})]))
+    # First and last frame are kept even without keys there
+    np.testing.assert_array_equal(solver.key_frames(clip), (0, 6, 30, 60))
+    np.testing.assert_array_equal(solver.key_frames(clip, 0), (0, 6, 30, 60))
+    frames = solver.key_frames(clip, 8)
+    assert frames[0] == 0 and frames[-1] == 60 and np.diff(frames).max() <= 8
+    assert set((6, 30)) <= set(frames)
+    np.testing.assert_array_equal(solver.key_frames(clip, fps=30), (0, 3, 15, 30))
+
+# Rotation kernels
+
+def test_quat_matrix_round_trip():
+    q = random_quats(200)
+    m = quat_to_matrix(q)
+    np.testing.assert_allclose(m @ np.swapaxes(m, -1, -2), np.broadcast_to(np.eye(3), m.shape), atol=1e-12)
+    np.testing.assert_allclose(np.linalg.det(m), 1)
+    back = matrix_to_quat(m)
+    assert (back[:, 0] >= 0).all()
+    assert same_rotation(back, q) < 1e-12
+
+def test_quat_multiply_matches_matrices():
+    a, b = random_quats(50, 1), random_quats(50, 2)
+    np.testing.assert_allclose(quat_to_matrix(quat_multiply(a, b)), quat_to_matrix(a) @ quat_to_matrix(b), atol=1e-12)
+
+def test_euler_yxz_round_trip():
+    e = np.random.default_rng(3).uniform(-np.pi / 2 + 0.01, np.pi / 2 - 0.01, (200, 3))
+    m = quat_to_matrix(euler_yxz_to_quat(e))
+    # Rz @ Rx @ Ry
+    rx, ry, rz = (quat_to_matrix(axis_quat(e[:, i], i)) for i in range(3))
+    np.testing.assert_allclose(m, rz @ rx @ ry, atol=1e-12)
+    np.testing.assert_allclose(matrix_to_euler_yxz(m), e, atol=1e-9)
+
+def test_euler_yxz_gimbal_lock():
+    # X at +-90 degrees, only Y + Z is defined but the rotation must survive
+    e = np.array([(np.pi / 2, 0.3, -0.2), (-np.pi / 2, 1.0, 0.4), (np.pi / 2, 0, 0)])
+    m = quat_to_matrix(euler_yxz_to_quat(e))
+    back = matrix_to_euler_yxz(m)
+    assert np.isfinite(back).all()
+    np.testing.assert_allclose(quat_to_matrix(euler_yxz_to_quat(back)), m, atol=1e-9)
+
+def test_match_leg_fk_roll_override():
+    btb = quat_to_matrix(random_quats(4, 4))
+    cur = quat_to_matrix(random_quats(4, 5))
+    free = match_leg_fk_roll(btb, cur)
+    mixed = match_leg_fk_roll(btb, cur, np.array([np.nan, 0.5, np.nan, -1]))
+    assert same_rotation(mixed[[0, 2]], free[[0, 2]]) < 1e-12
+    np.testing.assert_allclose(matrix_to_euler_yxz(quat_to_matrix(mixed[[1, 3]]))[:, 1], [0.5, -1], atol=1e-9)
+
+def test_slerp():
+    a, b = random_quats(50, 6), random_quats(50, 7)
+    assert same_rotation(slerp(a, b, 0), a) < 1e-12
+    assert same_rotation(slerp(a, b, 1), b) < 1e-12
+    mid = slerp(a, b, 0.5)
+    np.testing.assert_allclose(np.abs((mid * a).sum(-1)), np.abs((mid * b).sum(-1)), atol=1e-12)
+    # Equal inputs take the lerp branch
+    assert same_rotation(slerp(a, a, 0.3), a) < 1e-12
+
+# Poses
+
+def test_forward_kinematics_chain():
+    sk = anm.Skeleton(['a', 'b'], [-1, 0], [(1, 0, 0), (0, 2, 0)], [(0, 0, 0, 1), (0, 0, 0, 1)])
+    rot = np.stack([axis_quat(np.pi / 2, 2), axis_quat(0.0, 2)])
+    g_rot, g_loc = solver.forward_kinematics(sk, rot, sk.loc)
+    # Child offset is turned by the parent's 90 degrees around Z
+    np.testing.assert_allclose(g_loc[1], (-1, 0, 0), atol=1e-12)
+    np.testing.assert_allclose(g_rot[1], g_rot[0], atol=1e-12)
+
+def test_rest_clip_gives_identity_delta(skeleton, bases):
+    m, b = bases
+    clip = anm.Clip(1001)
+    pose = solver.cm_pose(clip, skeleton, b[m.cm_arm], np.arange(3))
+    np.testing.assert_allclose(pose.delta, np.broadcast_to(np.eye(3), pose.delta.shape), atol=1e-9)
+
+def test_corpus_matches_cm_pose(skeleton, bases, tmp_path):
+    m, b = bases
+    fns = []
+    for i, seconds in enumerate((0.5, 1)):
+        fn = tmp_path / f'clip{i}.anm'
+        fn.write_bytes(bench.synthetic_anm(skeleton, seconds, seed=i))
+        fns.append(str(fn))
+    c = corpus.ingest(fns, skeleton, str(tmp_path / 'corpus'))
+    for fn in fns:
+        clip = anm.read_anm(fn)
+        direct = solver.cm_pose(clip, skeleton, b[m.cm_arm], solver.clip_frames(clip))
+        stored = c.pose(batch.action_name(fn), skeleton, b[m.cm_arm])
+        # The corpus stores float32
+        np.testing.assert_allclose(stored.delta, direct.delta, atol=1e-5)
+        np.testing.assert_allclose(stored.head, direct.head, atol=1e-5)
+
+def test_corpus_refuses_same_names(skeleton, tmp_path):
+    fns = []
+    for folder in ('a', 'b'):
+        (tmp_path / folder).mkdir()
+        fn = tmp_path / folder / 'clip.anm'
+        fn.write_bytes(bench.synthetic_anm(skeleton, 0.1))
+        fns.append(str(fn))
+    with pytest.raises(batch.ClipNameError):
+        corpus.ingest(fns, skeleton, str(tmp_path / 'corpus'))
+    c = corpus.ingest(fns[:1], skeleton, str(tmp_path / 'corpus'))
+    assert c.index['clip.anm'] == c.index[fns[0]] == 0
+
+def test_normalized():
+    v = np.array([(3.0, 0, 4), (0, 0, 0)])
+    np.testing.assert_array_equal(normalized(v), [(0.6, 0, 0.8), (0, 0, 0)])
+
+def test_ik_target_straight_arm(skeleton, bases):
+    # Both bones along the same axis: no bend, no push, like Vector.normalized()
+    m, b = bases
+    pose = solver.cm_pose(anm.Clip(1001), skeleton, b[m.cm_arm], np.arange(2))
+    name = skeleton.names[1]
+    np.testing.assert_allclose(solver.ik_target(pose, name, name), pose.bone_head(name))
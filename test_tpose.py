@@ -0,0 +1,17 @@
+import os
+import sys
+
+import tpose
+
+def fake_blender(tmp_path):
+    # Stands in for a Blender whose -P script raises
+    fn = tmp_path / 'blender'
+    fn.write_text(f'#!{sys.executable}\n'
+        'import sys\n'
+        'sys.exit(int(sys.argv[sys.argv.index("--python-exit-code") + 1]) if "--python-exit-code" in sys.argv else 0)\n')
+    os.chmod(fn, 0o755)
+    return str(fn)
+
+def test_generate_reports_failures(tmp_path, capsys):
+    assert tpose.main(['--blend', 'tpose.blend', '--blender', fake_blender(tmp_path), 'mapping_female.json']) == 1
+    assert capsys.readouterr().out.strip() == 'mapping_female.json: failed'
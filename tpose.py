@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+import mapping
+
+# Compiled T-pose basis store
+#
+# tpose_basis.json is big and slow to parse. compile_json turns it into a .npz
+# next to it holding basis, inverse basis, head and tail per bone as arrays.
+# load() reads either format once per process and hands out the same objects.
+
+class TPoseBasis:
+    # T-pose of one armature as arrays indexed by bone
+    def __init__(self, names, basis, head, tail, inv_basis=None):
+        self.names = list(names)
+        self.index = {n: i for i, n in enumerate(self.names)}
+        self.basis = np.asarray(basis, dtype=np.float64)
+        if inv_basis is None:
+            inv_basis = np.linalg.inv(self.basis)
+        self.inv_basis = np.asarray(inv_basis, dtype=np.float64)
+        self.head = np.asarray(head, dtype=np.float64)
+        self.tail = np.asarray(tail, dtype=np.float64)
+        # Per-bone objects callers derive from the arrays, e.g. mathutils matrices
+        self.memo = {}
+
+    def subset(self, names):
+        idx = [self.index[n] for n in names if n in self.index]
+        return TPoseBasis(
+            [self.names[i] for i in idx],
+            self.basis[idx],
+            self.head[idx],
+            self.tail[idx],
+            self.inv_basis[idx],
+        )
+
+def from_json(json_fn):
+    with open(json_fn) as jf:
+        arms = json.loads(jf.read())
+    ret = {}
+    for arm_name, bones in arms.items():
+        names = list(bones)
+        ret[arm_name] = TPoseBasis(
+            names,
+            [bones[n]['basis'] for n in names],
+            [bones[n]['head'] for n in names],
+            [bones[n]['tail'] for n in names],
+        )
+    return ret
+
+def save_json(bases, json_fn):
+    out = {}
+    for arm_name, b in bases.items():
+        out[arm_name] = {n: {
+            'basis': b.basis[i].tolist(),
+            'head': b.head[i].tolist(),
+            'tail': b.tail[i].tolist(),
+        } for i, n in enumerate(b.names)}
+    with open(json_fn + '.tmp', 'w') as jf:
+        jf.write(json.dumps(out))
+    os.replace(json_fn + '.tmp', json_fn)
+    return json_fn
+
+def save_npz(bases, npz_fn):
+    arrays = {'arms': np.array(list(bases))}
+    for i, b in enumerate(bases.values()):
+        arrays[f'{i}_names'] = np.array(b.names)
+        arrays[f'{i}_basis'] = b.basis
+        arrays[f'{i}_inv_basis'] = b.inv_basis
+        arrays[f'{i}_head'] = b.head
+        arrays[f'{i}_tail'] = b.tail
+    # Written under a temp name, load() may be reading it from another process
+    with open(npz_fn + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(npz_fn + '.tmp', npz_fn)
+
+def from_npz(npz_fn):
+    ret = {}
+    with np.load(npz_fn) as f:
+        for i, arm_name in enumerate(f['arms']):
+            ret[str(arm_name)] = TPoseBasis(
+                [str(n) for n in f[f'{i}_names']],
+                f[f'{i}_basis'],
+                f[f'{i}_head'],
+                f[f'{i}_tail'],
+                f[f'{i}_inv_basis'],
+            )
+    return ret
+
+def compiled_fn(json_fn):
+    return os.path.splitext(json_fn)[0] + '.npz'
+
+def compile_json(json_fn, npz_fn=None, kk_arm=None, keep=None):
+    # kk_arm is trimmed to the bones in keep, other armatures are stored whole
+    if npz_fn is None:
+        npz_fn = compiled_fn(json_fn)
+    bases = from_json(json_fn)
+    if kk_arm is not None and keep is not None:
+        bases[kk_arm] = bases[kk_arm].subset(keep)
+    save_npz(bases, npz_fn)
+    return npz_fn
+
+# Process wide cache: path -> (mtime, bases)
+loaded = {}
+
+def resolve(fn):
+    # The file load() reads: an up to date compiled file next to a .json wins
+    fn = os.path.abspath(fn)
+    if fn.endswith('.json'):
+        # Generated from a mapping there may be no JSON at all
+        npz_fn = compiled_fn(fn)
+        if os.path.exists(npz_fn) and (not os.path.exists(fn) or os.path.getmtime(npz_fn) >= os.path.getmtime(fn)):
+            return npz_fn
+    return fn
+
+def load(fn):
+    fn = resolve(fn)
+    mtime = os.path.getmtime(fn)
+    if fn in loaded and loaded[fn][0] == mtime:
+        return loaded[fn][1]
+    bases = from_npz(fn) if fn.endswith('.npz') else from_json(fn)
+    loaded[fn] = (mtime, bases)
+    return bases
+
+def generate(blender, blend_fn, mapping_fns):
+    # One background Blender per mapping, all running at once. Each writes the
+    # compiled basis of its mapping straight from the posed armatures.
+    import batch # batch -> converted -> tpose
+    # Exit codes are non-zero when save_tpose_basis raises, see blender_cmd
+    procs = [subprocess.Popen(batch.blender_cmd(blender, blend_fn, 'tpose', os.path.abspath(fn))) for fn in mapping_fns]
+    return [p.wait() for p in procs]
+
+def main(argv):
+    # python tpose.py mapping_female.json
+    #   Compiles the basis file of a mapping, keeping only KK bones it writes
+    # python tpose.py --blend tpose.blend mapping_female.json mapping_male.json
+    #   Generates the compiled bases from armatures posed in T-pose
+    parser = argparse.ArgumentParser(description='Compile or generate T-pose basis files')
+    parser.add_argument('mapping', nargs='+')
+    parser.add_argument('--blend', help='Generate from this .blend instead of compiling the JSON')
+    parser.add_argument('--blender', default='blender')
+    args = parser.parse_args(argv)
+    if args.blend:
+        codes = generate(args.blender, args.blend, args.mapping)
+        for fn, code in zip(args.mapping, codes):
+            print(f'{fn}: {"failed" if code else compiled_fn(mapping.load(fn).tpose_basis)}')
+        return int(any(codes))
+    for fn in args.mapping:
+        m = mapping.load(fn)
+        print(compile_json(m.tpose_basis, kk_arm=m.kk_basis_arm, keep=m.kk_bones()))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,94 @@
+import bpy
+import os
+import sys
+
+# Runs inside background Blender, started by batch.py
+#   blender -b scene.blend -P worker.py -- serve out_dir [tracks] [reduce] [source_frames] [scenes] [rigs=scene_rigs.json] [fps=30] [preview] [stride=4]
+#       [angle_tol=0.05] [loc_tol=0.0005] [source_frames_only]
+#   blender -b target.blend -P worker.py -- merge out_dir
+#   blender -b tpose.blend -P worker.py -- tpose mapping.json, started by tpose.py
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import main # Registers the operators
+from batch import action_name, clip_output, preview_suffix, reply_prefix
+
+def convert(clips, out_dir, flags):
+    # One job: a clip, or the clips of a scene when scenes is in flags
+    tracks = 'tracks' in flags
+    preview = 'preview' in flags
+    options = {
+        'reduce_keys': 'reduce' in flags,
+        'source_frames': 'source_frames' in flags,
+        'preview': preview,
+    }
+    if 'source_frames_only' in flags:
+        options['source_frames_only'] = True
+    for name, parse in (('angle_tol', float), ('loc_tol', float), ('stride', int)):
+        values = [f[len(name) + 1:] for f in flags if f.startswith(name + '=')]
+        if values:
+            options[name] = parse(values[0])
+    fps = [f[len('fps='):] for f in flags if f.startswith('fps=')]
+    if fps:
+        options['fps'] = int(fps[0])
+    if tracks:
+        # kktracks.save writes atomically itself
+        options['tracks_dir'] = out_dir
+    before = set(bpy.data.actions)
+    rigs = [f[len('rigs='):] for f in flags if f.startswith('rigs=')]
+    if 'scenes' in flags or rigs:
+        # Armature pairs by role
+        bpy.ops.script.transfer_scene(anms='\n'.join(clips), rigs_fn=''.join(rigs), **options)
+    else:
+        bpy.ops.script.transfer_animation(anm=clips[0], bake=True, **options)
+    if not tracks:
+        for anm_fn in clips:
+            out_fn = clip_output(out_dir, anm_fn, preview=preview)
+            act = bpy.data.actions[action_name(anm_fn, preview)]
+            # Write to a temp name so a killed worker never leaves a half written clip
+            bpy.data.libraries.write(out_fn + '.tmp', {act}, fake_user=True)
+            os.replace(out_fn + '.tmp', out_fn)
+    # Drop the KK actions and the imported CM actions to keep memory flat
+    for a in set(bpy.data.actions) - before:
+        bpy.data.actions.remove(a)
+
+def serve(out_dir, *flags):
+    # Jobs come on stdin, one per line with clips separated by tabs. Each gets
+    # one reply line, everything else on stdout is Blender's own output.
+    for line in sys.stdin:
+        clips = line.rstrip('\n').split('\t')
+        try:
+            convert(clips, out_dir, flags)
+            reply = 'ok'
+        except Exception as e:
+            reply = f'error {e!r}'.replace('\n', ' ')
+        print(f'{reply_prefix} {reply}', flush=True)
+
+def merge(out_dir):
+    for fn in sorted(os.listdir(out_dir)):
+        if not fn.endswith('.blend'):
+            continue
+        fn = os.path.join(out_dir, fn)
+        with bpy.data.libraries.load(fn) as (data_from, data_to):
+            names = list(data_from.actions)
+        # Converted clips replace actions of the same name and their previews
+        for name in names:
+            for old in (name, name + preview_suffix):
+                if old in bpy.data.actions:
+                    bpy.data.actions.remove(bpy.data.actions[old])
+        with bpy.data.libraries.load(fn) as (data_from, data_to):
+            data_to.actions = names
+        for act in data_to.actions:
+            act.use_fake_user = True
+    bpy.ops.wm.save_mainfile()
+
+def save_tpose(mapping_fn):
+    bpy.ops.script.save_tpose_basis(mapping_fn=mapping_fn)
+
+argv = sys.argv[sys.argv.index('--') + 1:]
+if argv[0] == 'serve':
+    serve(*argv[1:])
+elif argv[0] == 'merge':
+    merge(*argv[1:])
+elif argv[0] == 'tpose':
+    save_tpose(*argv[1:])